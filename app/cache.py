@@ -0,0 +1,104 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import redis
+from fastapi.logger import logger
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with an optional per-entry TTL."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RedisCache:
+    """Shared cache tier backed by redis.
+
+    Values are raw bytes. Redis errors are logged and treated as misses so
+    an unavailable redis never breaks the request that is using the cache.
+    """
+
+    def __init__(self, client: redis.Redis, prefix: str, ttl: int = 0) -> None:
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str, ttl: int = 0) -> "RedisCache":
+        client = redis.Redis.from_url(
+            url, socket_timeout=1, socket_connect_timeout=1
+        )
+        return cls(client, prefix, ttl)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        try:
+            return self.client.mget([self._key(key) for key in keys])
+        except redis.RedisError as e:
+            logger.warning(f"redis cache read failed: {e}")
+            return [None] * len(keys)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        if not items:
+            return
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for key, value in items.items():
+                pipeline.set(self._key(key), value, ex=self.ttl or None)
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning(f"redis cache write failed: {e}")
+
+    def incr(self, key: str) -> Optional[int]:
+        try:
+            return self.client.incr(self._key(key))
+        except redis.RedisError as e:
+            logger.warning(f"redis cache write failed: {e}")
+            return None
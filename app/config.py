@@ -13,6 +13,10 @@ class AppConfig:
             "ELASTICSEARCH_URL",
             "http://localhost:9200"
         )
+        # elasticsearch or numpy, the in-process store of
+        # app.store.numpy_vector_store, persisted in numpy_store_path
+        self.vector_store = os.environ.get("VECTOR_STORE", "elasticsearch")
+        self.numpy_store_path = os.environ.get("NUMPY_STORE_PATH", "")
         self.embedding_type = os.environ.get("EMBEDDING_TYPE", "sagemaker")
         self.sagemaker = {
             "endpoint_name": os.environ.get(
@@ -52,6 +56,45 @@ class AppConfig:
             ),
             "aws_key": os.environ.get("SAGE_MAKER_AWS_KEY"),
             "aws_secret": os.environ.get("SAGE_MAKER_AWS_SECRET"),
+            "max_concurrency": int(
+                os.environ.get("SAGEMAKER_MAX_CONCURRENCY", "1")
+            ),
+            "max_retries": int(
+                os.environ.get("SAGEMAKER_MAX_RETRIES", "5")
+            ),
+            "retry_deadline": float(
+                os.environ.get("SAGEMAKER_RETRY_DEADLINE", "120")
+            ),
+            "query_max_retries": int(
+                os.environ.get("SAGEMAKER_QUERY_MAX_RETRIES", "2")
+            ),
+            "query_retry_deadline": float(
+                os.environ.get("SAGEMAKER_QUERY_RETRY_DEADLINE", "5")
+            ),
+            "connect_timeout": float(
+                os.environ.get("SAGEMAKER_CONNECT_TIMEOUT", "5")
+            ),
+            "read_timeout": float(
+                os.environ.get("SAGEMAKER_READ_TIMEOUT", "60")
+            ),
+            "circuit_failure_threshold": int(
+                os.environ.get("SAGEMAKER_CIRCUIT_FAILURE_THRESHOLD", "5")
+            ),
+            "circuit_reset_timeout": float(
+                os.environ.get("SAGEMAKER_CIRCUIT_RESET_TIMEOUT", "30")
+            ),
+            "query_batch_window_ms": float(
+                os.environ.get("SAGEMAKER_QUERY_BATCH_WINDOW_MS", "0")
+            ),
+            "vector_format": os.environ.get(
+                "SAGEMAKER_VECTOR_FORMAT", "json"
+            ),
+            "query_batch_max_size": int(
+                os.environ.get("SAGEMAKER_QUERY_BATCH_MAX_SIZE", "32")
+            ),
+            "async_max_concurrency": int(
+                os.environ.get("SAGEMAKER_ASYNC_MAX_CONCURRENCY", "64")
+            ),
         }
 
         self.content_base_index_name = os.environ.get(
@@ -60,6 +103,128 @@ class AppConfig:
         self.sentry_dsn = os.environ.get("SENTRY_DSN", "")
         self.environment = os.environ.get("ENVIRONMENT", "local")
         self.es_timeout = os.environ.get("ELASTICSEARCH_TIMEOUT", "30")
+        # size of the connection pool to each node of the shared client
+        self.es_connections_per_node = int(
+            os.environ.get("ELASTICSEARCH_CONNECTIONS_PER_NODE", "10")
+        )
+        self.elasticsearch_bulk = {
+            "chunk_size": int(
+                os.environ.get("ELASTICSEARCH_BULK_CHUNK_SIZE", "500")
+            ),
+            "max_chunk_bytes": int(
+                os.environ.get(
+                    "ELASTICSEARCH_BULK_MAX_BYTES", str(10 * 1024 * 1024)
+                )
+            ),
+            "thread_count": int(
+                os.environ.get("ELASTICSEARCH_BULK_THREADS", "4")
+            ),
+            "queue_size": int(
+                os.environ.get("ELASTICSEARCH_BULK_QUEUE_SIZE", "4")
+            ),
+        }
+        # loads of at least min_docs documents are written with the
+        # refresh_interval of the index set to refresh_interval, "" to
+        # leave it alone, and refreshed once at the end
+        self.elasticsearch_ingest = {
+            "refresh_interval": (
+                os.environ.get("ELASTICSEARCH_INGEST_REFRESH_INTERVAL", "-1") or None
+            ),
+            "min_docs": int(
+                os.environ.get("ELASTICSEARCH_INGEST_MIN_DOCS", "1000")
+            ),
+        }
+        # float, normalized or int8, see app.store.vector_index
+        self.vector_index_mode = os.environ.get("VECTOR_INDEX_MODE", "float")
+        # HNSW graph of the vector indexes created for kNN search
+        self.vector_hnsw = {
+            "m": int(os.environ.get("VECTOR_HNSW_M", "16")),
+            "ef_construction": int(
+                os.environ.get("VECTOR_HNSW_EF_CONSTRUCTION", "100")
+            ),
+        }
+        self.product_search = {
+            # exact or knn
+            "mode": os.environ.get("PRODUCT_SEARCH_MODE", "exact"),
+            "knn_num_candidates": int(
+                os.environ.get("PRODUCT_KNN_NUM_CANDIDATES", "100")
+            ),
+            # route products by catalog, see app.store.migrations to move
+            # an existing index
+            "routing": os.environ.get(
+                "PRODUCT_ROUTING_ENABLED", "false"
+            ).lower() == "true",
+        }
+        self.content_base_search = {
+            # exact or knn
+            "mode": os.environ.get("CONTENT_BASE_SEARCH_MODE", "exact"),
+            "knn_num_candidates": int(
+                os.environ.get("CONTENT_BASE_KNN_NUM_CANDIDATES", "100")
+            ),
+            "exact_search_max_docs": int(
+                os.environ.get("CONTENT_BASE_EXACT_SEARCH_MAX_DOCS", "1000")
+            ),
+            "doc_count_ttl": int(
+                os.environ.get("CONTENT_BASE_DOC_COUNT_TTL", "300")
+            ),
+            # route chunks by content base
+            "routing": os.environ.get(
+                "CONTENT_BASE_ROUTING_ENABLED", "false"
+            ).lower() == "true",
+        }
         self.content_base_documents_index_name = os.environ.get(
             "INDEX_CONTENTBASEDOCS_NAME", "content_base_documents"
         )
+        # characters per compressed segment of the documents previews
+        self.content_base_preview_segment_size = int(
+            os.environ.get("CONTENT_BASE_PREVIEW_SEGMENT_SIZE", str(64 * 1024))
+        )
+        # full pages of the content base chunks, see split_pages
+        self.content_base_pages_index_name = os.environ.get(
+            "INDEX_CONTENTBASEPAGES_NAME", "content_base_pages"
+        )
+        self.fake_embeddings = {
+            "dimensions": int(
+                os.environ.get("FAKE_EMBEDDING_DIMENSIONS", "1024")
+            ),
+            "latency_ms": float(
+                os.environ.get("FAKE_EMBEDDING_LATENCY_MS", "0")
+            ),
+        }
+        self.embedding_batching = {
+            "batch_size": int(os.environ.get("EMBEDDING_BATCH_SIZE", "32")),
+            "max_batch_bytes": int(
+                os.environ.get("EMBEDDING_BATCH_MAX_BYTES", "0")
+            ),
+            "adaptive": os.environ.get(
+                "EMBEDDING_BATCH_ADAPTIVE", "false"
+            ).lower() == "true",
+            "max_adaptive_batch_size": int(
+                os.environ.get("EMBEDDING_BATCH_MAX_ADAPTIVE_SIZE", "128")
+            ),
+            "target_latency": float(
+                os.environ.get("EMBEDDING_BATCH_TARGET_LATENCY", "1.0")
+            ),
+        }
+        self.embedding_cache = {
+            "enabled": os.environ.get(
+                "EMBEDDING_CACHE_ENABLED", "false"
+            ).lower() == "true",
+            "max_size": int(
+                os.environ.get("EMBEDDING_CACHE_MAX_SIZE", "50000")
+            ),
+            "ttl": int(
+                os.environ.get("EMBEDDING_CACHE_TTL", str(60 * 60 * 24 * 7))
+            ),
+            "redis_url": os.environ.get("EMBEDDING_CACHE_REDIS_URL", ""),
+        }
+        self.search_cache = {
+            "enabled": os.environ.get(
+                "SEARCH_CACHE_ENABLED", "false"
+            ).lower() == "true",
+            "max_size": int(os.environ.get("SEARCH_CACHE_MAX_SIZE", "10000")),
+            # also bounds how long writes made by other processes take to be
+            # seen when there is no redis
+            "ttl": int(os.environ.get("SEARCH_CACHE_TTL", "300")),
+            "redis_url": os.environ.get("SEARCH_CACHE_REDIS_URL", ""),
+        }
@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from langchain.embeddings.base import Embeddings
+
+from app.embedders.cache import normalize_text
+from app.embedders.queries import embed_queries
+
+
+def batch_texts(
+    texts: List[str], max_count: int, max_bytes: int = 0
+) -> List[List[str]]:
+    """Groups texts, in order, into batches of at most `max_count` texts and,
+    when `max_bytes` is set, at most `max_bytes` of utf-8 encoded text.
+
+    A single text bigger than `max_bytes` is sent alone in its own batch.
+    """
+    batches = []
+    current: List[str] = []
+    current_bytes = 0
+    for text in texts:
+        size = len(text.encode("utf-8"))
+        if current and (
+            len(current) >= max_count
+            or (max_bytes and current_bytes + size > max_bytes)
+        ):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(text)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def unique_texts(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """Returns the distinct texts, in order of first appearance, and for each
+    of `texts` the position of its distinct copy.
+
+    Texts are compared as they are sent to the model, so copies that only
+    differ by newlines or unicode composition are embedded once.
+    """
+    positions = {}
+    unique = []
+    index = []
+    for text in texts:
+        key = normalize_text(text)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(text)
+        index.append(positions[key])
+    return unique, index
+
+
+class AdaptiveBatchSizer:
+    """Tunes the batch size from the observed endpoint latency.
+
+    Additive increase while full batches come back under `target_latency`,
+    multiplicative decrease when they do not, so batches grow until the
+    endpoint starts to saturate and shrink quickly when it slows down.
+    """
+
+    def __init__(
+        self,
+        initial_size: int = 32,
+        min_size: int = 1,
+        max_size: int = 256,
+        target_latency: float = 1.0,
+        step: int = 8,
+    ) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = step
+        self._size = max(min_size, min(initial_size, max_size))
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def observe(self, batch_size: int, latency: float) -> None:
+        with self._lock:
+            if latency > self.target_latency:
+                self._size = max(self.min_size, self._size // 2)
+            elif batch_size >= self._size:
+                self._size = min(self.max_size, self._size + self.step)
+
+    def stats(self) -> dict:
+        return {"batch_size": self._size, "target_latency": self.target_latency}
+
+
+class BatchedEmbeddings(Embeddings):
+    """Splits embed_documents calls of any langchain Embeddings into
+    count and byte bounded batches, optionally sized adaptively.
+
+    Repeated texts are embedded once and their vector is reused for every
+    copy."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        batch_size: int = 32,
+        max_batch_bytes: int = 0,
+        batch_sizer: Optional[AdaptiveBatchSizer] = None,
+    ) -> None:
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_sizer = batch_sizer
+        self.duplicates_skipped = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        unique, index = unique_texts(texts)
+        with self._lock:
+            self.duplicates_skipped += len(texts) - len(unique)
+
+        max_count = self.batch_sizer.size if self.batch_sizer else self.batch_size
+        results = []
+        for batch in batch_texts(unique, max_count, self.max_batch_bytes):
+            start = time.monotonic()
+            results.extend(self.embeddings.embed_documents(batch))
+            if self.batch_sizer is not None:
+                self.batch_sizer.observe(len(batch), time.monotonic() - start)
+        return [results[i] for i in index]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        unique, index = unique_texts(texts)
+        max_count = self.batch_sizer.size if self.batch_sizer else self.batch_size
+        results = []
+        for batch in batch_texts(unique, max_count, self.max_batch_bytes):
+            results.extend(embed_queries(self.embeddings, batch))
+        return [results[i] for i in index]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
+
+    def stats(self) -> dict:
+        stats = {"duplicates_skipped": self.duplicates_skipped}
+        if self.batch_sizer is not None:
+            stats.update(self.batch_sizer.stats())
+        return stats
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from app.cache import LRUCache, RedisCache
+from app.embedders.queries import embed_queries
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a text the same way it is sent to the embedding model."""
+    return unicodedata.normalize("NFC", text).replace("\n", " ")
+
+
+def embedding_cache_key(namespace: str, kind: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{namespace}:{kind}:{digest}"
+
+
+def encode_vector(vector: List[float]) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def decode_vector(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps any langchain Embeddings with a content-hash cache.
+
+    Vectors are looked up first in an in-process LRU and then, if given, in a
+    shared redis tier. Only the texts missing from both tiers reach the
+    wrapped embeddings, each distinct text once.
+
+    Queries and documents are cached under different keys because some
+    backends (e.g. cohere) embed them with different input types.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        namespace: str,
+        local: LRUCache,
+        shared: Optional[RedisCache] = None,
+    ) -> None:
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(
+            [text], "query", lambda texts: [self.embeddings.embed_query(texts[0])]
+        )[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeds queries with the same cache entries as embed_query."""
+        return self._embed(
+            texts, "query", lambda missing: embed_queries(self.embeddings, missing)
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = embedding_cache_key(self.namespace, "query", text)
+        vector = self.local.get(key)
+        if vector is not None:
+            with self._lock:
+                self.hits += 1
+            return vector
+
+        loop = asyncio.get_running_loop()
+        if self.shared is not None:
+            value = await loop.run_in_executor(None, self.shared.get, key)
+            if value is not None:
+                vector = decode_vector(value)
+                self.local.set(key, vector)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                return vector
+
+        vector = await self.embeddings.aembed_query(text)
+        with self._lock:
+            self.misses += 1
+        self.local.set(key, vector)
+        if self.shared is not None:
+            await loop.run_in_executor(
+                None, self.shared.set, key, encode_vector(vector)
+            )
+        return vector
+
+    def _embed(
+        self,
+        texts: List[str],
+        kind: str,
+        embed_func: Callable[[List[str]], List[List[float]]],
+    ) -> List[List[float]]:
+        keys = [embedding_cache_key(self.namespace, kind, text) for text in texts]
+        vectors = [self.local.get(key) for key in keys]
+        local_hits = sum(vector is not None for vector in vectors)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        shared_hits = 0
+        if missing and self.shared is not None:
+            values = self.shared.get_many([keys[i] for i in missing])
+            for i, value in zip(missing, values):
+                if value is not None:
+                    vectors[i] = decode_vector(value)
+                    self.local.set(keys[i], vectors[i])
+                    shared_hits += 1
+            missing = [i for i in missing if vectors[i] is None]
+
+        with self._lock:
+            self.hits += local_hits + shared_hits
+            self.shared_hits += shared_hits
+            self.misses += len(missing)
+
+        if not missing:
+            return vectors
+
+        positions: Dict[str, List[int]] = {}
+        for i in missing:
+            positions.setdefault(keys[i], []).append(i)
+        unique_keys = list(positions.keys())
+        embedded = embed_func([texts[positions[key][0]] for key in unique_keys])
+
+        for key, vector in zip(unique_keys, embedded):
+            self.local.set(key, vector)
+            for i in positions[key]:
+                vectors[i] = vector
+        if self.shared is not None:
+            self.shared.set_many(
+                {key: encode_vector(vector) for key, vector in zip(unique_keys, embedded)}
+            )
+        return vectors
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "local_size": len(self.local),
+        }
@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from app.embedders.exceptions import (
+    EmbeddingEndpointException,
+    InvalidEmbeddingRequestException,
+)
+
+
+class QueryCoalescer:
+    """Gathers texts submitted by concurrent callers within a short window
+    into a single batched call and hands each caller its own result.
+
+    The first text to arrive opens a window of `window` seconds; the batch
+    is dispatched when the window closes or `max_batch_size` texts are
+    waiting, whichever comes first. Batches are dispatched on a small pool
+    so the next window can open while the previous batch is in flight.
+
+    A batch the endpoint rejects as invalid is split in halves sent again,
+    down to the texts rejected on their own, so only their callers fail.
+    """
+
+    def __init__(
+        self,
+        batch_func: Callable[[List[str]], List[List[float]]],
+        window: float = 0.003,
+        max_batch_size: int = 32,
+        max_workers: int = 4,
+    ) -> None:
+        self.batch_func = batch_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.requests = 0
+        self.batches = 0
+        self.splits = 0
+        self._pending: List[Tuple[str, Future]] = []
+        self._condition = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, text: str) -> Future:
+        future: Future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._start()
+            self._pending.append((text, future))
+            self.requests += 1
+            self._condition.notify()
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    def _start(self) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="query-coalescer"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="query-coalescer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+                self.batches += 1
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: List[Tuple[str, Future]]) -> None:
+        try:
+            vectors = self.batch_func([text for text, _ in batch])
+            if len(vectors) != len(batch):
+                raise EmbeddingEndpointException(
+                    f"Expected {len(batch)} embeddings, got {len(vectors)}"
+                )
+        except InvalidEmbeddingRequestException as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            with self._condition:
+                self.splits += 1
+            middle = len(batch) // 2
+            self._dispatch(batch[:middle])
+            self._dispatch(batch[middle:])
+            return
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "average_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "splits": self.splits,
+        }
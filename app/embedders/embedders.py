@@ -1,12 +1,92 @@
-from pydantic.v1 import root_validator
+from pydantic.v1 import Field, PrivateAttr, root_validator
+import asyncio
+import hashlib
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from botocore.config import Config
+from fastapi.logger import logger
 from langchain.embeddings import SagemakerEndpointEmbeddings
-from typing import Dict, List
+from langchain.embeddings.base import Embeddings
+from typing import Any, Dict, List, Optional
+
+from app.embedders.batching import AdaptiveBatchSizer, batch_texts, unique_texts
+from app.embedders.cache import normalize_text
+from app.embedders.coalescer import QueryCoalescer
+from app.embedders.exceptions import (
+    CircuitOpenException,
+    EmbeddingEndpointException,
+    InvalidEmbeddingRequestException,
+)
+from app.embedders.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    get_circuit_breaker,
+    is_retryable_error,
+)
 
 
 class SagemakerEndpointEmbeddingsKeys(SagemakerEndpointEmbeddings):
     aws_key: str = ""
     aws_secret: str = ""
+    max_concurrency: int = 1
+    """Maximum number of chunks in flight to the endpoint at the same time.
+    Shared by every call made through this instance."""
+    batch_size: int = 32
+    """Maximum number of texts sent in one request."""
+    max_batch_bytes: int = 0
+    """Maximum utf-8 size of the texts sent in one request, 0 for no limit."""
+    batch_sizer: Optional[AdaptiveBatchSizer] = None
+    """When set, replaces `batch_size` with a size tuned from latency."""
+    query_batch_window: float = 0
+    """Seconds to wait for concurrent queries to embed them in a single
+    request, 0 to send every query on its own."""
+    query_batch_max_size: int = 32
+    async_max_concurrency: int = 64
+    """Maximum number of awaited embedding calls blocking a thread at the
+    same time. Coalesced queries do not take a thread while waiting."""
+
+    retry_policy: RetryPolicy = Field(default_factory=RetryPolicy)
+    """Retries used when embedding documents for indexing."""
+    query_retry_policy: RetryPolicy = Field(
+        default_factory=lambda: RetryPolicy(max_attempts=2, deadline=5.0)
+    )
+    """Retries used when embedding a search query."""
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    """Seconds an attempt waits to connect and to read the response, at
+    most the deadline of the retry policy of its call. Queries use their
+    own client with the shorter limits of `query_retry_policy`."""
+    query_client: Any = None
+    circuit_breaker: Optional[CircuitBreaker] = None
+    """Defaults to the process-wide breaker of `endpoint_name`."""
+
+    _executor: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+    _async_executor: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+    _coalescer: Optional[QueryCoalescer] = PrivateAttr(default=None)
+    _counters: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _counters_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.circuit_breaker is None:
+            self.circuit_breaker = get_circuit_breaker(self.endpoint_name)
+        if self.max_concurrency > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix="sagemaker-embeddings",
+            )
+        self._async_executor = ThreadPoolExecutor(
+            max_workers=self.async_max_concurrency,
+            thread_name_prefix="sagemaker-embeddings-async",
+        )
+        if self.query_batch_window > 0:
+            self._coalescer = QueryCoalescer(
+                lambda texts: self._embedding_func(texts, fail_fast=True),
+                window=self.query_batch_window,
+                max_batch_size=self.query_batch_max_size,
+            )
 
     @root_validator(skip_on_failure=True)
     def validate_environment(cls, values: Dict) -> Dict:
@@ -17,14 +97,25 @@ class SagemakerEndpointEmbeddingsKeys(SagemakerEndpointEmbeddings):
             aws_secret_access_key=values["aws_secret"]
         )
 
-        values["client"] = session.client(
-            "sagemaker-runtime", region_name=values["region_name"]
-        )
+        def client(policy: RetryPolicy):
+            # retries are handled by _embedding_func
+            return session.client(
+                "sagemaker-runtime",
+                region_name=values["region_name"],
+                config=Config(
+                    retries={"mode": "standard", "max_attempts": 1},
+                    connect_timeout=min(values["connect_timeout"], policy.deadline),
+                    read_timeout=min(values["read_timeout"], policy.deadline),
+                ),
+            )
+
+        values["client"] = client(values["retry_policy"])
+        values["query_client"] = client(values["query_retry_policy"])
 
         return values
 
     def embed_documents(
-        self, texts: List[str], chunk_size: int = 32
+        self, texts: List[str], chunk_size: Optional[int] = None
     ) -> List[List[float]]:
         """Compute doc embeddings using a SageMaker Inference Endpoint.
 
@@ -32,21 +123,82 @@ class SagemakerEndpointEmbeddingsKeys(SagemakerEndpointEmbeddings):
             texts: The list of texts to embed.
             chunk_size: The chunk size defines how many input texts will
                 be grouped together as request. If None, will use the
-                chunk size specified by the class.
+                adaptive batch size or the `batch_size` of the class.
 
+        Repeated texts are sent once. Chunks are also bounded by
+        `max_batch_bytes`. They are sent concurrently, at most
+        `max_concurrency` at a time, and the embeddings are returned in the
+        same order as `texts`.
 
         Returns:
             List of embeddings, one for each text.
         """
+        if not texts:
+            return []
+        unique, index = unique_texts(texts)
+        if len(unique) < len(texts):
+            self._count("duplicates_skipped", len(texts) - len(unique))
+        if chunk_size is None:
+            chunk_size = (
+                self.batch_sizer.size if self.batch_sizer else self.batch_size
+            )
+        chunks = batch_texts(unique, chunk_size, self.max_batch_bytes)
+        if self._executor is None or len(chunks) == 1:
+            responses = map(self._embedding_func, chunks)
+        else:
+            responses = self._executor.map(self._embedding_func, chunks)
+
         results = []
-        _chunk_size = len(texts) if chunk_size > len(texts) else chunk_size
-        for i in range(0, len(texts), _chunk_size):
-            response = self._embedding_func(texts[i:i + _chunk_size])
+        for response in responses:
             results.extend(response)
-        return results
+        return [results[i] for i in index]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Compute query embeddings using a SageMaker inference endpoint.
+
+        Queries arriving within `query_batch_window` of each other share one
+        request. Fails fast with CircuitOpenException while the endpoint is
+        down.
+        """
+        if self._coalescer is not None:
+            return self._coalescer.embed(text)
+        return self._embedding_func([text], fail_fast=True)[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeds several search queries in as few requests as the batch
+        limits allow, failing fast like embed_query."""
+        if not texts:
+            return []
+        unique, index = unique_texts(texts)
+        chunk_size = self.batch_sizer.size if self.batch_sizer else self.batch_size
+        results = []
+        for chunk in batch_texts(unique, chunk_size, self.max_batch_bytes):
+            results.extend(self._embedding_func(chunk, fail_fast=True))
+        return [results[i] for i in index]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._async_executor, self.embed_documents, texts
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Awaitable embed_query that keeps the event loop and its
+        threadpool free while the endpoint answers."""
+        if self._coalescer is not None:
+            return await asyncio.wrap_future(self._coalescer.submit(text))
+        return await asyncio.get_running_loop().run_in_executor(
+            self._async_executor, self.embed_query, text
+        )
+
+    def _embedding_func(
+        self, texts: List[str], fail_fast: bool = False
+    ) -> List[List[float]]:
+        """Call out to SageMaker Inference embedding endpoint.
 
-    def _embedding_func(self, texts: List[str]) -> List[List[float]]:
-        """Call out to SageMaker Inference embedding endpoint."""
+        Transient errors are retried with capped exponential backoff until
+        the retry policy runs out of attempts or time. When `fail_fast` is
+        set an open circuit raises right away instead of waiting for it.
+        """
         # replace newlines, which can negatively affect performance.
         texts = list(map(lambda x: x.replace("\n", " "), texts))
         _model_kwargs = self.model_kwargs or {}
@@ -56,20 +208,129 @@ class SagemakerEndpointEmbeddingsKeys(SagemakerEndpointEmbeddings):
         content_type = self.content_handler.content_type
         accepts = self.content_handler.accepts
 
+        policy = self.query_retry_policy if fail_fast else self.retry_policy
+        client = self.query_client if fail_fast else self.client
+        breaker = self.circuit_breaker
+        deadline = time.monotonic() + policy.deadline
+        attempt = 0
+
         # send request
         while True:
+            if not breaker.allow_request():
+                wait = breaker.retry_after()
+                if fail_fast or time.monotonic() + wait > deadline:
+                    self._count("rejected")
+                    raise CircuitOpenException(
+                        f"Circuit for endpoint {self.endpoint_name} is open"
+                    )
+                time.sleep(wait)
+                continue
+
+            start = time.monotonic()
             try:
-                response = self.client.invoke_endpoint(
+                response = client.invoke_endpoint(
                     EndpointName=self.endpoint_name,
                     Body=body,
                     ContentType=content_type,
                     Accept=accepts,
                     **_endpoint_kwargs,
                 )
-                return self.content_handler.transform_output(response["Body"])
             except Exception as e:
-                print(
-                    f"Error raised by inference endpoint: {e}\nBody: {body}."
+                retryable = is_retryable_error(e)
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_invalid_request()
+
+                attempt += 1
+                delay = policy.backoff(attempt)
+                if (
+                    not retryable
+                    or attempt >= policy.max_attempts
+                    or time.monotonic() + delay > deadline
+                ):
+                    self._count("failures")
+                    logger.error(
+                        f"Error raised by inference endpoint: {e} "
+                        f"({len(texts)} texts, {attempt} attempts)"
+                    )
+                    if not retryable:
+                        raise InvalidEmbeddingRequestException(str(e)) from e
+                    raise EmbeddingEndpointException(str(e)) from e
+
+                self._count("retries")
+                logger.warning(
+                    f"Error raised by inference endpoint: {e}. "
+                    f"Retrying in {delay:.1f}s (attempt {attempt})."
                 )
-                print("Trying again in 5 seconds.")
-                time.sleep(60 * 5)
+                time.sleep(delay)
+                continue
+
+            breaker.record_success()
+            if self.batch_sizer is not None and not fail_fast:
+                self.batch_sizer.observe(len(texts), time.monotonic() - start)
+            return self.content_handler.transform_output(response["Body"])
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._counters_lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def stats(self) -> dict:
+        with self._counters_lock:
+            counters = dict(self._counters)
+        stats = {
+            "retries": counters.get("retries", 0),
+            "failures": counters.get("failures", 0),
+            "rejected": counters.get("rejected", 0),
+            "duplicates_skipped": counters.get("duplicates_skipped", 0),
+            "circuit_breaker": self.circuit_breaker.stats(),
+            "batch_size": (
+                self.batch_sizer.size if self.batch_sizer else self.batch_size
+            ),
+        }
+        if self._coalescer is not None:
+            stats["query_batching"] = self._coalescer.stats()
+        return stats
+
+
+class DeterministicFakeEmbeddings(Embeddings):
+    """Offline embeddings for load tests and benchmarks.
+
+    Each text gets a unit length pseudo-random vector seeded by the hash of
+    the text, so the same text always gets the same vector without calling
+    any model. `latency` seconds are slept on every call to stand in for
+    the endpoint round trip.
+    """
+
+    def __init__(self, dimensions: int = 1024, latency: float = 0.0) -> None:
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _vector(self, text: str) -> np.ndarray:
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+        vector = rng.standard_normal(self.dimensions).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._vector(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._vector(text)
@@ -0,0 +1,10 @@
+class EmbeddingEndpointException(Exception):
+    pass
+
+
+class CircuitOpenException(EmbeddingEndpointException):
+    pass
+
+
+class InvalidEmbeddingRequestException(EmbeddingEndpointException):
+    pass
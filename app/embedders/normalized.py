@@ -0,0 +1,40 @@
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from app.embedders.queries import embed_queries
+
+
+def normalize_vectors(vectors: List[List[float]]) -> np.ndarray:
+    """Scales every row to unit L2 norm, leaving zero vectors untouched."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NormalizedEmbeddings(Embeddings):
+    """Returns the vectors of any langchain Embeddings with unit length, as
+    needed by indexes scored with dot_product."""
+
+    def __init__(self, embeddings: Embeddings) -> None:
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.embeddings.embed_documents(texts)
+        if not len(vectors):
+            return []
+        return list(normalize_vectors(vectors))
+
+    def embed_query(self, text: str) -> List[float]:
+        return normalize_vectors(self.embeddings.embed_query(text))
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        vectors = embed_queries(self.embeddings, texts)
+        if not len(vectors):
+            return []
+        return list(normalize_vectors(vectors))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return normalize_vectors(await self.embeddings.aembed_query(text))
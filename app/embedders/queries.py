@@ -0,0 +1,24 @@
+from typing import List
+
+from langchain.embeddings import CohereEmbeddings, HuggingFaceHubEmbeddings
+from langchain.embeddings.base import Embeddings
+
+
+def embed_queries(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """Embeds several search queries with as few requests as `embeddings`
+    allows, in the same order as `texts`.
+
+    The embeddings of this package implement embed_queries. Langchain
+    embeddings embed queries as documents, except cohere that takes an
+    input type, and unknown embeddings fall back to one embed_query per
+    text.
+    """
+    if not texts:
+        return []
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    if isinstance(embeddings, CohereEmbeddings):
+        return embeddings.embed(texts, input_type="search_query")
+    if isinstance(embeddings, HuggingFaceHubEmbeddings):
+        return embeddings.embed_documents(texts)
+    return [embeddings.embed_query(text) for text in texts]
@@ -0,0 +1,163 @@
+import random
+import threading
+import time
+from typing import Dict
+
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+
+RETRYABLE_ERROR_CODES = {
+    "InternalFailure",
+    "InternalServerError",
+    "ModelNotReadyException",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Tells transient endpoint errors (throttling, 5xx, network) apart from
+    permanent ones, such as a payload the model rejects."""
+    if isinstance(error, (ConnectionError, ReadTimeoutError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+
+    response = error.response or {}
+    if response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES:
+        return True
+    status = response.get("OriginalStatusCode") or response.get(
+        "ResponseMetadata", {}
+    ).get("HTTPStatusCode", 0)
+    return status == 429 or status >= 500
+
+
+class RetryPolicy:
+    """Capped exponential backoff with full jitter and a per-call deadline."""
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        deadline: float = 120.0,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt)
+        )
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint after consecutive failures.
+
+    After `failure_threshold` failures the circuit opens and requests are
+    rejected for `reset_timeout` seconds. Then a single probe request is let
+    through: success closes the circuit, failure opens it again. Callers
+    turned away while the probe is in flight retry every `probe_interval`
+    seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        probe_interval: float = 0.5,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.times_opened = 0
+        self._opened_at = 0.0
+        self._state = self.CLOSED
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() >= self._opened_at + self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        """Seconds until a rejected request is worth trying again."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.OPEN:
+                return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+            if state == self.HALF_OPEN and self._probing:
+                return min(self.probe_interval, self.reset_timeout)
+            return 0.0
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._probing = False
+            self.failures = 0
+
+    def record_invalid_request(self) -> None:
+        """The endpoint answered but rejected the request itself, which
+        says nothing of its health: a half-open circuit stays half-open and
+        lets another probe through, an open one stays open."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                self.failures = 0
+            elif state == self.HALF_OPEN:
+                self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            half_open = self._current_state() == self.HALF_OPEN
+            if half_open or self.failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+        }
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker for an endpoint, so every
+    embeddings instance calling the same endpoint shares its state."""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(**kwargs)
+        return _circuit_breakers[name]
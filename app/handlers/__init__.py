@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 
+# searches accepted by the batch search endpoints
+SEARCH_BATCH_MAX_SIZE = 32
+
 
 class IDocumentHandler(ABC):
     @abstractmethod
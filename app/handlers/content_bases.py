@@ -1,13 +1,17 @@
-from fastapi import APIRouter, Header
-from pydantic import BaseModel
+import json
 
-from app.handlers import IDocumentHandler
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from app.handlers import IDocumentHandler, SEARCH_BATCH_MAX_SIZE
 from app.indexer import IDocumentIndexer
 
 from app.celery import index_file_data
 from typing import List
 from typing import Annotated
 from app.handlers.authorizations import token_verification
+from app.store.exceptions import TaskNotFoundException
 
 
 class ContentBaseIndexRequest(BaseModel):
@@ -36,6 +40,16 @@ class ContentBaseSearchResponse(BaseModel):
     response: List[dict]
 
 
+class ContentBaseBatchSearchRequest(BaseModel):
+    searches: List[ContentBaseSearchRequest] = Field(
+        min_length=1, max_length=SEARCH_BATCH_MAX_SIZE
+    )
+
+
+class ContentBaseBatchSearchResponse(BaseModel):
+    responses: List[ContentBaseSearchResponse]
+
+
 class ContentBaseDeleteRequest(BaseModel):
     filename: str
     content_base: str
@@ -46,13 +60,35 @@ class ContentBaseDeleteResponse(BaseModel):
     deleted: bool
 
 
+class ContentBaseDeleteContentBaseRequest(BaseModel):
+    content_base: str
+
+
+class ContentBaseDeleteContentBaseResponse(BaseModel):
+    deleted: bool
+    task_id: str = None
+
+
+class ContentBaseDeleteTaskResponse(BaseModel):
+    completed: bool
+    deleted: int
+    total: int
+
+
 class ContentBaseSearchDocumentRequest(BaseModel):
     file_uuid: str
     content_base_uuid: str
+    # slice of the document, in characters, the whole document by default
+    offset: int = Field(default=0, ge=0)
+    length: int = Field(default=None, ge=0)
+    # streams the content as NDJSON, one line per stored segment, the last
+    # one {"error": ...} when the read failed partway
+    stream: bool = False
 
 
 class ContentBaseSearchDocumentResponse(BaseModel):
     content: str
+    total_length: int = None
 
 
 class ContentBaseHandler(IDocumentHandler):
@@ -65,12 +101,21 @@ class ContentBaseHandler(IDocumentHandler):
         self.router.add_api_route(
             "/content_base/search", endpoint=self.search, methods=["POST"]
         )
+        self.router.add_api_route(
+            "/content_base/search/batch", endpoint=self.search_batch, methods=["POST"]
+        )
         self.router.add_api_route(
             "/content_base/search-document", endpoint=self.search_document_content, methods=["POST"]
         )
         self.router.add_api_route(
             "/content_base/delete", endpoint=self.delete, methods=["DELETE"]
         )
+        self.router.add_api_route(
+            "/content_base/delete-content-base", endpoint=self.delete_content_base, methods=["DELETE"]
+        )
+        self.router.add_api_route(
+            "/content_base/delete-task/{task_id}", endpoint=self.delete_task, methods=["GET"]
+        )
 
     def index(self, request: ContentBaseIndexRequest, Authorization: Annotated[str | None, Header()] = None):
         token_verification(Authorization)
@@ -99,30 +144,79 @@ class ContentBaseHandler(IDocumentHandler):
         )
         return ContentBaseDeleteResponse(deleted=True)
 
+    def delete_content_base(
+        self,
+        request: ContentBaseDeleteContentBaseRequest,
+        Authorization: Annotated[str | None, Header()] = None
+    ):
+        token_verification(Authorization)
+        task_id = self.content_base_indexer.delete_content_base(request.content_base)
+        return ContentBaseDeleteContentBaseResponse(deleted=True, task_id=task_id)
+
+    def delete_task(
+        self,
+        task_id: str,
+        Authorization: Annotated[str | None, Header()] = None
+    ):
+        token_verification(Authorization)
+        try:
+            response = self.content_base_indexer.get_delete_task(task_id)
+        except TaskNotFoundException as e:
+            raise HTTPException(status_code=404, detail=[{"msg": str(e)}])
+        return ContentBaseDeleteTaskResponse(**response)
+
     def delete_batch(self):
         raise NotImplementedError
 
-    def search(
+    async def search(
         self,
         request: ContentBaseSearchRequest,
         Authorization: Annotated[str | None, Header()] = None
     ):
         token_verification(Authorization)
-        response = self.content_base_indexer.search(
+        response = await self.content_base_indexer.asearch(
             search=request.search,
             threshold=request.threshold,
             filter=request.filter
         )
         return ContentBaseSearchResponse(response=response)
 
+    async def search_batch(
+        self,
+        request: ContentBaseBatchSearchRequest,
+        Authorization: Annotated[str | None, Header()] = None
+    ):
+        token_verification(Authorization)
+        results = await self.content_base_indexer.asearch_batch(
+            searches=[search.search for search in request.searches],
+            filters=[search.filter for search in request.searches],
+            thresholds=[search.threshold for search in request.searches],
+        )
+        return ContentBaseBatchSearchResponse(
+            responses=[ContentBaseSearchResponse(response=response) for response in results]
+        )
+
     def search_document_content(
         self,
         request: ContentBaseSearchDocumentRequest,
         Authorization: Annotated[str | None, Header()] = None
     ):
         token_verification(Authorization)
+        if request.stream:
+            chunks = self.content_base_indexer.iter_document_content(
+                file_uuid=request.file_uuid,
+                content_base_uuid=request.content_base_uuid,
+                offset=request.offset,
+                length=request.length,
+            )
+            return StreamingResponse(
+                (json.dumps(chunk) + "\n" for chunk in chunks),
+                media_type="application/x-ndjson",
+            )
         response = self.content_base_indexer.search_document_content(
             file_uuid=request.file_uuid,
-            content_base_uuid=request.content_base_uuid
+            content_base_uuid=request.content_base_uuid,
+            offset=request.offset,
+            length=request.length,
         )
-        return ContentBaseSearchDocumentResponse(content=response)
+        return ContentBaseSearchDocumentResponse(**response)
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from app.handlers import IDocumentHandler
+from app.handlers import IDocumentHandler, SEARCH_BATCH_MAX_SIZE
 from app.indexer import IDocumentIndexer
 
 
@@ -50,6 +50,16 @@ class ProductSearchResponse(BaseModel):
     products: list[Product]
 
 
+class ProductBatchSearchRequest(BaseModel):
+    searches: list[ProductSearchRequest] = Field(
+        min_length=1, max_length=SEARCH_BATCH_MAX_SIZE
+    )
+
+
+class ProductBatchSearchResponse(BaseModel):
+    responses: list[ProductSearchResponse]
+
+
 class ProductDeleteRequest(BaseModel):
     catalog_id: str
     product_retailer_ids: list[str]
@@ -68,6 +78,9 @@ class ProductsHandler(IDocumentHandler):
         self.router.add_api_route(
             "/products/search", endpoint=self.search, methods=["GET"]
         )
+        self.router.add_api_route(
+            "/products/search/batch", endpoint=self.search_batch, methods=["POST"]
+        )
         self.router.add_api_route(
             "/products/index", endpoint=self.delete, methods=["DELETE"]
         )
@@ -100,15 +113,28 @@ class ProductsHandler(IDocumentHandler):
         except Exception as e:
             raise HTTPException(status_code=500, detail=[{"msg": str(e)}])
 
-    def search(self, request: ProductSearchRequest):
+    async def search(self, request: ProductSearchRequest):
         try:
-            matched_products = self.product_indexer.search(
+            matched_products = await self.product_indexer.asearch(
                 request.search, request.filter, request.threshold
             )
             return ProductSearchResponse(products=matched_products)
         except Exception as e:
             raise HTTPException(status_code=500, detail=[{"msg": str(e)}])
 
+    async def search_batch(self, request: ProductBatchSearchRequest):
+        try:
+            results = await self.product_indexer.asearch_batch(
+                [search.search for search in request.searches],
+                [search.filter for search in request.searches],
+                [search.threshold for search in request.searches],
+            )
+            return ProductBatchSearchResponse(
+                responses=[ProductSearchResponse(products=products) for products in results]
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=[{"msg": str(e)}])
+
     def delete(
         self,
         catalog_id: str = "",
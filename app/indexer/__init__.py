@@ -14,6 +14,10 @@ class IDocumentIndexer(ABC):
     def search(self):
         pass
 
+    @abstractmethod
+    async def asearch(self):
+        pass
+
     @abstractmethod
     def delete(self):
         pass
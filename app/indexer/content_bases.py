@@ -1,30 +1,67 @@
 from langchain.docstore.document import Document
+from starlette.concurrency import run_in_threadpool
 
 from app.handlers.products import Product
 from app.indexer import IDocumentIndexer
+from app.indexer.search_cache import SearchResultCache
 from app.store import IStorage
-from typing import List
+from typing import Iterator, List, Tuple
 from uuid import UUID
 
 
+def page_document_id(file_uuid: str, page_number: int) -> str:
+    return f"{file_uuid}:{page_number}"
+
+
+def split_pages(docs: List[Document]) -> Tuple[List[Document], List[Document], List[str]]:
+    """Moves the full_page of the chunks to one page document per distinct
+    page of the file, the chunks keeping the page_id of their page.
+
+    Returns the chunks, the pages and the ids of the pages.
+    """
+    chunks = []
+    pages = []
+    page_ids = {}
+    for doc in docs:
+        metadata = dict(doc.metadata)
+        full_page = metadata.pop("full_page", None)
+        if full_page is None:
+            chunks.append(doc)
+            continue
+        page_id = page_ids.get(full_page)
+        if page_id is None:
+            page_id = page_document_id(metadata["file_uuid"], len(pages))
+            page_ids[full_page] = page_id
+            pages.append(Document(page_content=full_page, metadata=metadata))
+        chunks.append(
+            Document(page_content=doc.page_content, metadata={**metadata, "page_id": page_id})
+        )
+    return chunks, pages, list(page_ids.values())
+
+
 class ContentBaseIndexer(IDocumentIndexer):
-    def __init__(self, storage: IStorage):
+    def __init__(self, storage: IStorage, search_cache: SearchResultCache = None):
         self.storage = storage
+        self.search_cache = search_cache
 
     def index_documents(self, docs: List[Document]):
         file_uuid = docs[0].metadata["file_uuid"]
         content_base_uuid = docs[0].metadata["content_base_uuid"]
 
-        results = self._search_docs_by_content_base_uuid(
-            content_base_uuid=content_base_uuid,
-            file_uuid=file_uuid,
-        )
-        ids = []
-        if len(results) > 0:
-            ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
+        file_filter = {
+            "metadata.content_base_uuid": content_base_uuid,
+            "metadata.file_uuid": file_uuid,
+        }
+        with self.storage.grouped_writes():
+            self.storage.delete_by_query(file_filter)
+            self.storage.delete_pages(file_filter)
 
-        return self.storage.save(docs)
+            chunks, pages, page_ids = split_pages(docs)
+            # pages first, so every chunk found already has its page
+            self.storage.save_pages(pages, page_ids)
+            result = self.storage.save(chunks)
+        self._invalidate_search_cache(content_base_uuid)
+        return result
 
     def index(self, texts: List, metadatas: dict):
         results = self._search_docs_by_content_base_uuid(
@@ -33,28 +70,97 @@ class ContentBaseIndexer(IDocumentIndexer):
         ids = []
         if len(results) > 0:
             ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
+            self.storage.delete(ids=ids, routing=metadatas.get('content_base_uuid'))
 
         docs = [
             Document(page_content=text, metadata=metadatas)
             for text in texts
         ]
 
-        return self.storage.save(docs)
+        result = self.storage.save(docs)
+        self._invalidate_search_cache(metadatas.get('content_base_uuid'))
+        return result
 
     def index_batch(self):
         raise NotImplementedError
 
     def search(self, search, filter=None, threshold=0.1) -> list[Product]:
-        matched_responses = self.storage.search(search, filter, threshold)
+        content_base_uuid = (filter or {}).get("content_base_uuid")
+        if self.search_cache is None or content_base_uuid is None:
+            matched_responses = self.storage.search(search, filter, threshold)
+        else:
+            matched_responses = self.search_cache.search(
+                self.storage, content_base_uuid, search, filter, threshold
+            )
+        return self._unique_pages(matched_responses, self._get_pages(matched_responses))
+
+    async def asearch(self, search, filter=None, threshold=0.1) -> list[dict]:
+        content_base_uuid = (filter or {}).get("content_base_uuid")
+        if self.search_cache is None or content_base_uuid is None:
+            matched_responses = await self.storage.asearch(search, filter, threshold)
+        else:
+            matched_responses = await self.search_cache.asearch(
+                self.storage, content_base_uuid, search, filter, threshold
+            )
+        pages = await run_in_threadpool(self._get_pages, matched_responses)
+        return self._unique_pages(matched_responses, pages)
+
+    def search_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[dict]]:
+        """Runs several searches at once, with one embedding call and one
+        _msearch for the ones not cached, and fetches the pages of all of
+        them with one mget per content base."""
+        if self.search_cache is None:
+            results = self.storage.search_batch(searches, filters, thresholds)
+        else:
+            content_base_uuids = [(filter or {}).get("content_base_uuid") for filter in filters]
+            results = self.search_cache.search_batch(
+                self.storage, content_base_uuids, searches, filters, thresholds
+            )
+        by_content_base = {}
+        for matched_responses in results:
+            for doc in matched_responses:
+                by_content_base.setdefault(doc.metadata.get("content_base_uuid"), []).append(doc)
+        pages = {}
+        for matched_responses in by_content_base.values():
+            pages.update(self._get_pages(matched_responses))
+        return [self._unique_pages(matched_responses, pages) for matched_responses in results]
+
+    async def asearch_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[dict]]:
+        return await run_in_threadpool(self.search_batch, searches, filters, thresholds)
+
+    def _invalidate_search_cache(self, content_base_uuid) -> None:
+        if self.search_cache is not None:
+            self.search_cache.invalidate(content_base_uuid)
+
+    def _get_pages(self, matched_responses: List[Document]) -> dict:
+        page_ids = list(dict.fromkeys(
+            doc.metadata["page_id"]
+            for doc in matched_responses
+            if "page_id" in doc.metadata
+        ))
+        if not page_ids:
+            return {}
+        return self.storage.get_pages(
+            page_ids, matched_responses[0].metadata.get("content_base_uuid")
+        )
 
+    def _unique_pages(self, matched_responses: List[Document], pages: dict) -> list[dict]:
         seen = set()
         return_list = []
 
         for doc in matched_responses:
-            full_page = doc.metadata.get("full_page")
-            if full_page not in seen:
-                seen.add(full_page)
+            # chunks indexed before the page store hold their page
+            page_id = doc.metadata.get("page_id")
+            if page_id is None:
+                full_page = doc.metadata.get("full_page")
+            else:
+                full_page = pages.get(page_id, "")
+            if (page_id or full_page) not in seen:
+                seen.add(page_id or full_page)
                 return_list.append({
                     "full_page": full_page,
                     "filename": doc.metadata.get("filename"),
@@ -84,18 +190,37 @@ class ContentBaseIndexer(IDocumentIndexer):
         if filename:
             search_filter.update({"metadata.source": filename})
 
-        scroll_id, results = self.storage.search_delete(search_filter)
-        ids = []
-
-        while len(results) > 0:
-            ids += [item["_id"] for item in results]
-            scroll_id, results = self.storage.search_delete(
-                search_filter,
-                scroll_id
-            )
+        self.storage.delete_by_query(search_filter)
+        self.storage.delete_pages(search_filter)
+        self._invalidate_search_cache(content_base_uuid)
+
+    def delete_content_base(self, content_base_uuid: UUID) -> str:
+        """Starts deleting a whole content base and returns the id of the
+        task doing it. Searches cached while it runs are invalidated when
+        get_delete_task sees it completed."""
+        response = self.storage.delete_content_base(str(content_base_uuid))
+        task_id = response.get("task")
+        self._invalidate_search_cache(content_base_uuid)
+        if self.search_cache is not None and task_id is not None:
+            self.search_cache.watch_task(task_id, content_base_uuid)
+        return task_id
+
+    def get_delete_task(self, task_id: str) -> dict:
+        """Progress of a delete_content_base task, raises
+        TaskNotFoundException for an unknown task."""
+        task = self.storage.get_task(task_id)
+        if task["completed"] and self.search_cache is not None:
+            self.search_cache.task_completed(task_id)
+        status = task["response"]
+        return {
+            "completed": task["completed"],
+            "deleted": status.get("deleted", 0),
+            "total": status.get("total", 0),
+        }
 
-        if ids:
-            self.storage.delete(ids=ids)
+    def grouped_writes(self):
+        """Groups the writes of indexing a file, see IStorage.grouped_writes."""
+        return self.storage.grouped_writes()
 
     def index_doc_content(self, full_content: str, content_base_uuid: UUID, filename: str, file_uuid: str):
         self.storage.save_doc_content(
@@ -108,8 +233,15 @@ class ContentBaseIndexer(IDocumentIndexer):
     def delete_batch(self):
         raise NotImplementedError
 
-    def search_document_content(self, file_uuid: str, content_base_uuid: str) -> str:
-        return self.storage.search_doc_content(file_uuid, content_base_uuid)
+    def search_document_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> dict:
+        return self.storage.search_doc_content(file_uuid, content_base_uuid, offset, length)
+
+    def iter_document_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> Iterator[dict]:
+        return self.storage.iter_doc_content(file_uuid, content_base_uuid, offset, length)
 
     def check_if_doc_was_embedded_document(self, file_uuid: str, content_base_uuid: str) -> bool:
         return self.storage.check_if_doc_was_embedded_document(file_uuid, content_base_uuid)
@@ -62,13 +62,14 @@ class IndexerFileManager:
         )
         document_pages: List[Document] = add_file_metadata(docs, content_base)
         try:
-            self.content_base_indexer.index_documents(document_pages)
-            self.content_base_indexer.index_doc_content(
-                full_content=full_content,
-                content_base_uuid=str(content_base.get('content_base')),
-                filename=content_base.get("filename"),
-                file_uuid=content_base.get("file_uuid"),
-            )
+            with self.content_base_indexer.grouped_writes():
+                self.content_base_indexer.index_documents(document_pages)
+                self.content_base_indexer.index_doc_content(
+                    full_content=full_content,
+                    content_base_uuid=str(content_base.get('content_base')),
+                    filename=content_base.get("filename"),
+                    file_uuid=content_base.get("file_uuid"),
+                )
             return True
         except Exception as e:  # TODO: handle exceptions
             logger.exception(e)
@@ -1,48 +1,100 @@
 from langchain.docstore.document import Document
+from starlette.concurrency import run_in_threadpool
 
 from app.handlers.products import Product
 from app.indexer import IDocumentIndexer
+from app.indexer.search_cache import SearchResultCache
 from app.store import IStorage
 
 
+def product_document_id(catalog_id: str, product_retailer_id: str) -> str:
+    """Id of the document of a product, so writing a product again
+    replaces its previous version."""
+    return f"{catalog_id}:{product_retailer_id}"
+
+
 class ProductsIndexer(IDocumentIndexer):
-    def __init__(self, storage: IStorage):
+    def __init__(self, storage: IStorage, search_cache: SearchResultCache = None):
         self.storage = storage
+        self.search_cache = search_cache
 
     def index(self, catalog_id: str, product: Product):
-        results = self._search_products_by_retailer_id(
-            catalog_id, [product.product_retailer_id]
-        )
-        ids = []
-        if len(results) > 0:
-            ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
         doc = Document(page_content=product.title, metadata=product)
-        return self.storage.save(doc)
+        result = self.storage.save(
+            doc, ids=[product_document_id(catalog_id, product.product_retailer_id)]
+        )
+        self._invalidate_search_cache(catalog_id)
+        return result
 
     def index_batch(self, catalog_id: str, products: list[Product]):
-        retailer_ids = [product.product_retailer_id for product in products]
-        results = self._search_products_by_retailer_id(
-            catalog_id,
-            retailer_ids
+        # a product sent more than once in the batch is indexed once,
+        # with its last version
+        products = list(
+            {product.product_retailer_id: product for product in products}.values()
         )
-        ids = []
-        if len(results) > 0:
-            ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
         docs = [
             Document(page_content=product.title, metadata=product)
             for product in products
         ]
-        return self.storage.save_batch(docs)
+        ids = [
+            product_document_id(catalog_id, product.product_retailer_id)
+            for product in products
+        ]
+        result = self.storage.save_batch(docs, ids=ids)
+        self._invalidate_search_cache(catalog_id)
+        return result
 
     def search(self, search, filter=None, threshold=0.1) -> list[Product]:
-        matched_documents = self.storage.search(search, filter, threshold)
+        catalog_id = (filter or {}).get("catalog_id")
+        if self.search_cache is None or catalog_id is None:
+            matched_documents = self.storage.search(search, filter, threshold)
+        else:
+            matched_documents = self.search_cache.search(
+                self.storage, catalog_id, search, filter, threshold
+            )
         products = [
             Product.from_metadata(doc.metadata) for doc in matched_documents
         ]
         return products
 
+    async def asearch(self, search, filter=None, threshold=0.1) -> list[Product]:
+        catalog_id = (filter or {}).get("catalog_id")
+        if self.search_cache is None or catalog_id is None:
+            matched_documents = await self.storage.asearch(search, filter, threshold)
+        else:
+            matched_documents = await self.search_cache.asearch(
+                self.storage, catalog_id, search, filter, threshold
+            )
+        return [
+            Product.from_metadata(doc.metadata) for doc in matched_documents
+        ]
+
+    def search_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[Product]]:
+        """Runs several searches at once, with one embedding call and one
+        _msearch for the ones not cached, in the same order."""
+        if self.search_cache is None:
+            results = self.storage.search_batch(searches, filters, thresholds)
+        else:
+            catalog_ids = [(filter or {}).get("catalog_id") for filter in filters]
+            results = self.search_cache.search_batch(
+                self.storage, catalog_ids, searches, filters, thresholds
+            )
+        return [
+            [Product.from_metadata(doc.metadata) for doc in matched_documents]
+            for matched_documents in results
+        ]
+
+    async def asearch_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[Product]]:
+        return await run_in_threadpool(self.search_batch, searches, filters, thresholds)
+
+    def _invalidate_search_cache(self, catalog_id: str) -> None:
+        if self.search_cache is not None:
+            self.search_cache.invalidate(catalog_id)
+
     def _search_products_by_retailer_id(self, catalog_id, ids):
         search_filter = {
             "metadata.catalog_id": catalog_id,
@@ -57,7 +109,8 @@ class ProductsIndexer(IDocumentIndexer):
         ids = []
         if len(results) > 0:
             ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
+            self.storage.delete(ids=ids, routing=catalog_id)
+            self._invalidate_search_cache(catalog_id)
         return ids
 
     def delete_batch(self, catalog_id, product_retailer_ids):
@@ -68,5 +121,6 @@ class ProductsIndexer(IDocumentIndexer):
         ids = []
         if len(results) > 0:
             ids = [item["_id"] for item in results]
-            self.storage.delete(ids=ids)
+            self.storage.delete(ids=ids, routing=catalog_id)
+            self._invalidate_search_cache(catalog_id)
         return ids
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Dict, List, Optional
+
+from langchain.docstore.document import Document
+
+from app.cache import LRUCache, RedisCache
+from app.embedders.cache import normalize_text
+from app.store import IStorage
+
+
+class SearchResultCache:
+    """Caches the documents matched by a search, per tenant (a catalog or
+    a content base).
+
+    Entries are keyed by the current generation of their tenant, which is
+    bumped every time the tenant is written to, so a write makes every
+    cached search of the tenant unreachable at once. Evicted entries are
+    left to the LRU and the TTL.
+
+    With a shared redis tier the generations live in redis and writes made
+    by any process, the celery workers included, invalidate the cache of
+    every process. Without it the generations are local to the process and
+    writes made elsewhere are only seen when the entries expire.
+
+    Writes running in background tasks are watched: their tenant is
+    invalidated again when the task is seen completed, dropping what was
+    cached while it ran.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        local: LRUCache,
+        shared: Optional[RedisCache] = None,
+    ) -> None:
+        self.namespace = namespace
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _generation_key(self, tenant: str) -> str:
+        return f"{self.namespace}:generation:{tenant}"
+
+    def generation(self, tenant: str) -> int:
+        if self.shared is None:
+            return self._generations.get(tenant, 0)
+        value = self.shared.get(self._generation_key(tenant))
+        return int(value) if value is not None else 0
+
+    def invalidate(self, tenant: str) -> None:
+        """Drops every cached search of `tenant`."""
+        tenant = str(tenant)
+        with self._lock:
+            self._generations[tenant] = self._generations.get(tenant, 0) + 1
+            self.invalidations += 1
+        if self.shared is not None:
+            self.shared.incr(self._generation_key(tenant))
+
+    def _task_key(self, task_id: str) -> str:
+        return f"{self.namespace}:task:{task_id}"
+
+    def watch_task(self, task_id: str, tenant: str) -> None:
+        """Remembers that the background task `task_id` writes to `tenant`,
+        until task_completed is called for it."""
+        key = self._task_key(task_id)
+        self.local.set(key, str(tenant))
+        if self.shared is not None:
+            self.shared.set(key, str(tenant).encode("utf-8"))
+
+    def task_completed(self, task_id: str) -> None:
+        """Invalidates the tenant written by `task_id`, once."""
+        key = self._task_key(task_id)
+        tenant = self.local.get(key)
+        self.local.delete(key)
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value:
+                tenant = value.decode("utf-8")
+                # redis entries expire with the ttl, emptied to be read once
+                self.shared.set(key, b"")
+        if tenant:
+            self.invalidate(tenant)
+
+    def key(self, tenant: str, search: str, filter: dict, threshold: float, k: int) -> str:
+        tenant = str(tenant)
+        params = json.dumps(
+            [normalize_text(search), filter, threshold, k], sort_keys=True, default=str
+        )
+        digest = hashlib.sha256(params.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{tenant}:{self.generation(tenant)}:{digest}"
+
+    def get(self, key: str) -> Optional[List[Document]]:
+        documents = self.local.get(key)
+        if documents is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                documents = [Document(**document) for document in json.loads(value)]
+                self.local.set(key, documents)
+                with self._lock:
+                    self.shared_hits += 1
+        with self._lock:
+            if documents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return documents
+
+    def set(self, key: str, documents: List[Document]) -> None:
+        self.local.set(key, documents)
+        if self.shared is not None:
+            value = json.dumps(
+                [
+                    {"page_content": doc.page_content, "metadata": dict(doc.metadata)}
+                    for doc in documents
+                ],
+                default=str,
+            )
+            self.shared.set(key, value.encode("utf-8"))
+
+    def search(
+        self, storage: IStorage, tenant: str, search: str, filter: dict, threshold: float
+    ) -> List[Document]:
+        """Returns the cached result of storage.search or runs and caches it."""
+        key = self.key(tenant, search, filter, threshold, storage.search_k)
+        documents = self.get(key)
+        if documents is None:
+            documents = storage.search(search, filter, threshold)
+            self.set(key, documents)
+        return documents
+
+    async def asearch(
+        self, storage: IStorage, tenant: str, search: str, filter: dict, threshold: float
+    ) -> List[Document]:
+        """Same as search, with storage.asearch. Redis is called from the
+        default executor."""
+        loop = asyncio.get_running_loop()
+        if self.shared is None:
+            key = self.key(tenant, search, filter, threshold, storage.search_k)
+            documents = self.get(key)
+        else:
+            key = await loop.run_in_executor(
+                None, self.key, tenant, search, filter, threshold, storage.search_k
+            )
+            documents = await loop.run_in_executor(None, self.get, key)
+        if documents is not None:
+            return documents
+
+        documents = await storage.asearch(search, filter, threshold)
+        if self.shared is None:
+            self.set(key, documents)
+        else:
+            await loop.run_in_executor(None, self.set, key, documents)
+        return documents
+
+    def search_batch(
+        self,
+        storage: IStorage,
+        tenants: List[Optional[str]],
+        searches: List[str],
+        filters: List[dict],
+        thresholds: List[float],
+    ) -> List[List[Document]]:
+        """Same as search for several searches, the ones missing from the
+        cache run together with storage.search_batch. Searches without a
+        tenant are not cached."""
+        keys = [
+            None if tenant is None
+            else self.key(tenant, search, filter, threshold, storage.search_k)
+            for tenant, search, filter, threshold in zip(tenants, searches, filters, thresholds)
+        ]
+        results = [None if key is None else self.get(key) for key in keys]
+        missing = [i for i, documents in enumerate(results) if documents is None]
+        if missing:
+            found = storage.search_batch(
+                [searches[i] for i in missing],
+                [filters[i] for i in missing],
+                [thresholds[i] for i in missing],
+            )
+            for i, documents in zip(missing, found):
+                results[i] = documents
+                if keys[i] is not None:
+                    self.set(keys[i], documents)
+        return results
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "local_size": len(self.local),
+        }
@@ -1,6 +1,5 @@
 import sentry_sdk
 import os
-from elasticsearch import Elasticsearch
 from elasticapm.contrib.starlette import ElasticAPM, make_apm_client
 from fastapi import FastAPI
 from langchain.embeddings import HuggingFaceHubEmbeddings, CohereEmbeddings
@@ -12,17 +11,34 @@ from app.handlers import IDocumentHandler
 from app.handlers.products import ProductsHandler
 from app.indexer import IDocumentIndexer
 from app.indexer.products import ProductsIndexer
+from app.indexer.search_cache import SearchResultCache
+from app.store import NUMPY, VECTOR_STORES
 from app.store.elasticsearch_vector_store import (
     ElasticsearchVectorStoreIndex,
-    ContentBaseElasticsearchVectorStoreIndex
+    ContentBaseElasticsearchVectorStoreIndex,
+    create_elasticsearch_client,
 )
+from app.store.numpy_vector_store import ContentBaseNumpyVectorStore, NumpyVectorStore
+from app.store.vector_index import (
+    FLOAT,
+    VECTOR_INDEX_MODES,
+    VectorIndexExactRetrievalStrategy,
+)
+from app.cache import LRUCache, RedisCache
 from app.config import AppConfig
 from app.util import ContentHandler
 
 
 from app.handlers.content_bases import ContentBaseHandler
 from app.indexer.content_bases import ContentBaseIndexer
-from app.embedders.embedders import SagemakerEndpointEmbeddingsKeys
+from app.embedders.embedders import (
+    DeterministicFakeEmbeddings,
+    SagemakerEndpointEmbeddingsKeys,
+)
+from app.embedders.batching import AdaptiveBatchSizer, BatchedEmbeddings
+from app.embedders.cache import CachedEmbeddings
+from app.embedders.normalized import NormalizedEmbeddings
+from app.embedders.resilience import RetryPolicy, get_circuit_breaker
 
 
 class App:
@@ -35,7 +51,29 @@ class App:
 
     def __init__(self, config: AppConfig):
         self.config = config
+        if config.vector_store not in VECTOR_STORES:
+            raise ValueError(
+                f"Invalid VECTOR_STORE {config.vector_store}, "
+                f"expected one of {', '.join(VECTOR_STORES)}"
+            )
+        if config.vector_index_mode not in VECTOR_INDEX_MODES:
+            raise ValueError(
+                f"Invalid VECTOR_INDEX_MODE {config.vector_index_mode}, "
+                f"expected one of {', '.join(VECTOR_INDEX_MODES)}"
+            )
+        self.metric_sources = {}
+        batching = config.embedding_batching
+        batch_sizer = None
+        if batching["adaptive"]:
+            batch_sizer = AdaptiveBatchSizer(
+                initial_size=batching["batch_size"],
+                max_size=batching["max_adaptive_batch_size"],
+                target_latency=batching["target_latency"],
+            )
+            self.metric_sources["embedding_batching"] = batch_sizer.stats
+
         if config.embedding_type == "huggingface":
+            embedding_model = config.huggingfacehub["repo_id"]
             self.embeddings = HuggingFaceHubEmbeddings(
                 repo_id=config.huggingfacehub["repo_id"],
                 task=config.huggingfacehub["task"],
@@ -44,19 +82,86 @@ class App:
                 ],
             )
         elif config.embedding_type == "cohere":
+            embedding_model = config.cohere["model"]
             self.embeddings = CohereEmbeddings(
                 model=config.cohere["model"],
                 cohere_api_key=config.cohere["cohere_api_key"]
             )
+        elif config.embedding_type == "fake":
+            embedding_model = f"fake-{config.fake_embeddings['dimensions']}"
+            self.embeddings = DeterministicFakeEmbeddings(
+                dimensions=config.fake_embeddings["dimensions"],
+                latency=config.fake_embeddings["latency_ms"] / 1000,
+            )
         else:  # sagemaker by default
-            content_handler = ContentHandler()
+            embedding_model = config.sagemaker_aws["endpoint_name"]
+            content_handler = ContentHandler(
+                vector_format=config.sagemaker_aws["vector_format"]
+            )
             self.embeddings = SagemakerEndpointEmbeddingsKeys(
                 aws_key=config.sagemaker_aws["aws_key"],
                 aws_secret=config.sagemaker_aws["aws_secret"],
                 endpoint_name=config.sagemaker_aws["endpoint_name"],
                 region_name=config.sagemaker_aws["region_name"],
                 content_handler=content_handler,
+                max_concurrency=config.sagemaker_aws["max_concurrency"],
+                batch_size=batching["batch_size"],
+                max_batch_bytes=batching["max_batch_bytes"],
+                batch_sizer=batch_sizer,
+                query_batch_window=config.sagemaker_aws["query_batch_window_ms"] / 1000,
+                query_batch_max_size=config.sagemaker_aws["query_batch_max_size"],
+                async_max_concurrency=config.sagemaker_aws["async_max_concurrency"],
+                retry_policy=RetryPolicy(
+                    max_attempts=config.sagemaker_aws["max_retries"],
+                    deadline=config.sagemaker_aws["retry_deadline"],
+                ),
+                query_retry_policy=RetryPolicy(
+                    max_attempts=config.sagemaker_aws["query_max_retries"],
+                    deadline=config.sagemaker_aws["query_retry_deadline"],
+                ),
+                connect_timeout=config.sagemaker_aws["connect_timeout"],
+                read_timeout=config.sagemaker_aws["read_timeout"],
+                circuit_breaker=get_circuit_breaker(
+                    config.sagemaker_aws["endpoint_name"],
+                    failure_threshold=config.sagemaker_aws["circuit_failure_threshold"],
+                    reset_timeout=config.sagemaker_aws["circuit_reset_timeout"],
+                ),
+            )
+            self.metric_sources["embedding_endpoint"] = self.embeddings.stats
+
+        if not isinstance(self.embeddings, SagemakerEndpointEmbeddingsKeys):
+            self.embeddings = BatchedEmbeddings(
+                self.embeddings,
+                batch_size=batching["batch_size"],
+                max_batch_bytes=batching["max_batch_bytes"],
+                batch_sizer=batch_sizer,
             )
+            self.metric_sources["embedding_batching"] = self.embeddings.stats
+
+        if config.embedding_cache["enabled"]:
+            namespace = f"{config.embedding_type}:{embedding_model}"
+            shared_cache = None
+            if config.embedding_cache["redis_url"]:
+                shared_cache = RedisCache.from_url(
+                    config.embedding_cache["redis_url"],
+                    prefix="embeddings",
+                    ttl=config.embedding_cache["ttl"],
+                )
+            self.embeddings = CachedEmbeddings(
+                self.embeddings,
+                namespace=namespace,
+                local=LRUCache(
+                    max_size=config.embedding_cache["max_size"],
+                    ttl=config.embedding_cache["ttl"],
+                ),
+                shared=shared_cache,
+            )
+            self.metric_sources["embedding_cache"] = self.embeddings.stats
+
+        # above the cache, which keeps the vectors of the model whatever the
+        # vector index mode
+        if config.vector_index_mode != FLOAT:
+            self.embeddings = NormalizedEmbeddings(self.embeddings)
 
         if config.sentry_dsn != "":
             sentry_sdk.init(
@@ -66,30 +171,21 @@ class App:
             )
 
         self.api = FastAPI()
-        self.vectorstore = ElasticVectorSearch(
-            elasticsearch_url=config.es_url,
-            index_name=config.product_index_name,
-            embedding=self.embeddings,
-        )
-        self.vectorstore.client = Elasticsearch(
-            hosts=config.es_url, timeout=int(config.es_timeout)
+        if config.vector_store == NUMPY:
+            self._create_numpy_stores(config)
+        else:
+            self._create_elasticsearch_stores(config)
+        self.products_indexer = ProductsIndexer(
+            self.elasticStore,
+            search_cache=self._search_cache("products", embedding_model),
         )
-        self.elasticStore = ElasticsearchVectorStoreIndex(self.vectorstore)
-        self.products_indexer = ProductsIndexer(self.elasticStore)
         self.products_handler = ProductsHandler(self.products_indexer)
         self.api.include_router(self.products_handler.router)
 
-        self.content_base_vectorstore = ElasticsearchStore(
-            es_url=config.es_url,
-            index_name=config.content_base_index_name,
-            embedding=self.embeddings,
-            strategy=ElasticsearchStore.ExactRetrievalStrategy()
-        )
-        self.content_base_vectorstore.client = Elasticsearch(
-            hosts=config.es_url, timeout=int(config.es_timeout)
+        self.content_base_indexer = ContentBaseIndexer(
+            self.custom_elasticStore,
+            search_cache=self._search_cache("content_bases", embedding_model),
         )
-        self.custom_elasticStore = ContentBaseElasticsearchVectorStoreIndex(self.content_base_vectorstore)
-        self.content_base_indexer = ContentBaseIndexer(self.custom_elasticStore)
         self.content_base_handler = ContentBaseHandler(self.content_base_indexer)
         self.api.include_router(self.content_base_handler.router)
 
@@ -105,11 +201,121 @@ class App:
         apm_CLIENT = make_apm_client(apm_config)
         self.api.add_middleware(ElasticAPM, client=apm_CLIENT)
 
+    def _create_elasticsearch_stores(self, config: AppConfig) -> None:
+        self.es_client = create_elasticsearch_client(
+            config.es_url,
+            timeout=int(config.es_timeout),
+            connections_per_node=config.es_connections_per_node,
+        )
+        self.vectorstore = ElasticVectorSearch(
+            elasticsearch_url=config.es_url,
+            index_name=config.product_index_name,
+            embedding=self.embeddings,
+        )
+        self.vectorstore.client = self.es_client
+        product_knn = config.product_search["mode"] == "knn"
+        self.elasticStore = ElasticsearchVectorStoreIndex(
+            self.vectorstore,
+            vector_index_mode=config.vector_index_mode,
+            knn_num_candidates=(
+                config.product_search["knn_num_candidates"] if product_knn else 0
+            ),
+            hnsw_options=config.vector_hnsw if product_knn else None,
+            routing=config.product_search["routing"],
+            ingest_options=config.elasticsearch_ingest,
+        )
+
+        content_base_search = config.content_base_search
+        knn_num_candidates = 0
+        hnsw_options = None
+        if content_base_search["mode"] == "knn":
+            knn_num_candidates = content_base_search["knn_num_candidates"]
+            hnsw_options = config.vector_hnsw
+        if config.vector_index_mode == FLOAT and hnsw_options is None:
+            content_base_strategy = ElasticsearchStore.ExactRetrievalStrategy()
+        else:
+            content_base_strategy = VectorIndexExactRetrievalStrategy(
+                config.vector_index_mode, hnsw_options=hnsw_options
+            )
+        self.content_base_vectorstore = ElasticsearchStore(
+            es_url=config.es_url,
+            index_name=config.content_base_index_name,
+            embedding=self.embeddings,
+            strategy=content_base_strategy
+        )
+        self.content_base_vectorstore.client = self.es_client
+        self.custom_elasticStore = ContentBaseElasticsearchVectorStoreIndex(
+            self.content_base_vectorstore,
+            vector_index_mode=config.vector_index_mode,
+            knn_num_candidates=knn_num_candidates,
+            exact_search_max_docs=content_base_search["exact_search_max_docs"],
+            doc_count_ttl=content_base_search["doc_count_ttl"],
+            bulk_options=config.elasticsearch_bulk,
+            routing=content_base_search["routing"],
+            ingest_options=config.elasticsearch_ingest,
+            pages_index_name=config.content_base_pages_index_name,
+            documents_index_name=config.content_base_documents_index_name,
+            preview_segment_size=config.content_base_preview_segment_size,
+        )
+        self.metric_sources["content_base_bulk"] = (
+            self.custom_elasticStore.bulk_ingester.stats
+        )
+
+    def _create_numpy_stores(self, config: AppConfig) -> None:
+        path = config.numpy_store_path or None
+        self.elasticStore = NumpyVectorStore(
+            self.embeddings, path=path, index_name=config.product_index_name
+        )
+        self.custom_elasticStore = ContentBaseNumpyVectorStore(
+            self.embeddings,
+            path=path,
+            index_name=config.content_base_index_name,
+            preview_segment_size=config.content_base_preview_segment_size,
+        )
+
+    def _search_cache(self, name: str, embedding_model: str) -> SearchResultCache:
+        options = self.config.search_cache
+        if not options["enabled"]:
+            return None
+        shared_cache = None
+        if options["redis_url"]:
+            shared_cache = RedisCache.from_url(
+                options["redis_url"], prefix="search", ttl=options["ttl"]
+            )
+        search_cache = SearchResultCache(
+            namespace=f"{name}:{self.config.embedding_type}:{embedding_model}",
+            local=LRUCache(max_size=options["max_size"], ttl=options["ttl"]),
+            shared=shared_cache,
+        )
+        self.metric_sources[f"{name}_search_cache"] = search_cache.stats
+        return search_cache
+
+    def metrics(self) -> dict:
+        return {name: source() for name, source in self.metric_sources.items()}
+
+    def warm_index_caches(self) -> None:
+        if self.config.vector_store == NUMPY:
+            return
+        self.elasticStore.index_cache.warm([self.vectorstore.index_name])
+        self.custom_elasticStore.index_cache.warm(
+            [self.content_base_vectorstore.index_name]
+        )
+
 
 config = AppConfig()
 main_app = App(config)
 
 
+@main_app.api.on_event("startup")
+def startup():
+    main_app.warm_index_caches()
+
+
 @main_app.api.get('/', status_code=200)
 def home():
     return {}
+
+
+@main_app.api.get('/metrics', status_code=200)
+def metrics():
+    return main_app.metrics()
@@ -1,4 +1,9 @@
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
+
+ELASTICSEARCH = "elasticsearch"
+NUMPY = "numpy"
+VECTOR_STORES = (ELASTICSEARCH, NUMPY)
 
 
 class IStorage(ABC):
@@ -14,6 +19,10 @@ class IStorage(ABC):
     def search(self):
         pass
 
+    @abstractmethod
+    async def asearch(self):
+        pass
+
     @abstractmethod
     def query_search(self):
         pass
@@ -21,3 +30,8 @@ class IStorage(ABC):
     @abstractmethod
     def delete(self):
         pass
+
+    def grouped_writes(self):
+        """Context manager around writes to persist together when it
+        ends, for stores that would otherwise persist each of them."""
+        return nullcontext()
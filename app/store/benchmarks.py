@@ -0,0 +1,224 @@
+"""Compares the memory and latency of the vector index modes on a live
+cluster, using deterministic fake vectors so no embedding endpoint is
+needed.
+
+For each mode a throwaway index is filled with `--docs` vectors, force
+merged, and searched `--queries` times with the script_score query used by
+the application and, for modes with an HNSW graph, with a kNN query.
+
+    python -m app.store.benchmarks --docs 20000 --dims 1024
+
+With --payload it instead compares the size and latency of the responses
+of the same search fetching whole documents and only the text and
+metadata used by the application.
+
+    python -m app.store.benchmarks --payload --docs 5000 --dims 1024
+
+estimated_memory_bytes follows the Elasticsearch sizing guide for the
+memory the kNN vectors need to stay in the page cache. int8 keeps the
+float vectors on disk for scripts and rescoring, so its disk usage grows
+while the memory needed for kNN search drops to about a quarter.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from elasticsearch import Elasticsearch, helpers
+
+from app.embedders.embedders import DeterministicFakeEmbeddings
+from app.store.vector_index import (
+    FLOAT,
+    INT8,
+    VECTOR_INDEX_MODES,
+    es_version,
+    script_score_source,
+    vector_mapping,
+)
+
+
+# dense_vector fields are indexed with HNSW by default from this version on
+INDEXED_BY_DEFAULT_VERSION = (8, 11)
+
+
+def estimated_memory_bytes(docs: int, dims: int, mode: str, m: int = 16) -> int:
+    vector_bytes = dims + 4 if mode == INT8 else 4 * dims
+    return docs * (vector_bytes + 4 * m)
+
+
+def _latencies(client: Elasticsearch, index: str, bodies: list[dict]) -> dict:
+    latencies = []
+    payload_bytes = []
+    for body in bodies:
+        start = time.monotonic()
+        response = client.search(index=index, **body)
+        latencies.append(time.monotonic() - start)
+        payload_bytes.append(len(json.dumps(response.body)))
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "payload_bytes": int(np.mean(payload_bytes)),
+    }
+
+
+def run_benchmark(
+    client: Elasticsearch,
+    docs: int = 10000,
+    dims: int = 1024,
+    queries: int = 100,
+    k: int = 15,
+    modes=VECTOR_INDEX_MODES,
+    prefix: str = "sentenx_benchmark",
+) -> list[dict]:
+    embeddings = DeterministicFakeEmbeddings(dimensions=dims)
+    version = es_version(client)
+    query_vectors = embeddings.embed_documents([f"query {i}" for i in range(queries)])
+    results = []
+
+    for mode in modes:
+        index = f"{prefix}_{mode}"
+        client.indices.delete(index=index, ignore_unavailable=True)
+        client.indices.create(
+            index=index,
+            mappings={"properties": {"vector": vector_mapping(dims, mode, version)}},
+        )
+        helpers.bulk(
+            client,
+            (
+                {
+                    "_index": index,
+                    "vector": embeddings.embed_query(f"document {i}"),
+                    "text": f"document {i}",
+                }
+                for i in range(docs)
+            ),
+            chunk_size=500,
+        )
+        client.indices.refresh(index=index)
+        client.indices.forcemerge(index=index, max_num_segments=1)
+
+        indexed = mode != FLOAT or version >= INDEXED_BY_DEFAULT_VERSION
+        store = client.indices.stats(index=index, metric="store")
+        result = {
+            "mode": mode,
+            "store_bytes": store["_all"]["primaries"]["store"]["size_in_bytes"],
+            # without an HNSW graph vectors are only read by scripts
+            "estimated_memory_bytes": (
+                estimated_memory_bytes(docs, dims, mode) if indexed else 0
+            ),
+            "script_score": _latencies(client, index, [
+                {
+                    "query": {
+                        "script_score": {
+                            "query": {"match_all": {}},
+                            "script": {
+                                "source": script_score_source(mode),
+                                "params": {"query_vector": vector},
+                            },
+                        }
+                    },
+                    "size": k,
+                    "source": False,
+                }
+                for vector in query_vectors
+            ]),
+        }
+        if indexed:
+            result["knn"] = _latencies(client, index, [
+                {
+                    "knn": {
+                        "field": "vector",
+                        "query_vector": vector,
+                        "k": k,
+                        "num_candidates": 100,
+                    },
+                    "size": k,
+                    "source": False,
+                }
+                for vector in query_vectors
+            ])
+        results.append(result)
+        client.indices.delete(index=index)
+    return results
+
+
+def run_payload_benchmark(
+    client: Elasticsearch,
+    docs: int = 5000,
+    dims: int = 1024,
+    queries: int = 100,
+    k: int = 15,
+    index: str = "sentenx_benchmark_payload",
+) -> dict:
+    embeddings = DeterministicFakeEmbeddings(dimensions=dims)
+    client.indices.delete(index=index, ignore_unavailable=True)
+    client.indices.create(
+        index=index,
+        mappings={"properties": {"vector": vector_mapping(dims, FLOAT)}},
+    )
+    helpers.bulk(
+        client,
+        (
+            {
+                "_index": index,
+                "vector": embeddings.embed_query(f"document {i}"),
+                "text": f"document {i}",
+                "metadata": {"catalog_id": "benchmark", "title": f"document {i}"},
+            }
+            for i in range(docs)
+        ),
+        chunk_size=500,
+    )
+    client.indices.refresh(index=index)
+
+    def bodies(source) -> list[dict]:
+        body = {"size": k}
+        if source is not None:
+            body["source"] = source
+        return [
+            {
+                "query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "source": script_score_source(FLOAT),
+                            "params": {"query_vector": vector},
+                        },
+                    }
+                },
+                **body,
+            }
+            for vector in embeddings.embed_documents([f"query {i}" for i in range(queries)])
+        ]
+
+    result = {
+        "whole_source": _latencies(client, index, bodies(None)),
+        "text_and_metadata": _latencies(client, index, bodies(["metadata", "text"])),
+    }
+    client.indices.delete(index=index)
+    return result
+
+
+if __name__ == "__main__":
+    from app.config import AppConfig
+    from app.store.elasticsearch_vector_store import create_elasticsearch_client
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument(
+        "--modes", nargs="+", choices=VECTOR_INDEX_MODES, default=VECTOR_INDEX_MODES
+    )
+    parser.add_argument(
+        "--payload", action="store_true", help="compare search response payloads"
+    )
+    args = parser.parse_args()
+
+    config = AppConfig()
+    client = create_elasticsearch_client(config.es_url, timeout=int(config.es_timeout))
+    if args.payload:
+        print(run_payload_benchmark(client, args.docs, args.dims, args.queries))
+        raise SystemExit
+    for result in run_benchmark(client, args.docs, args.dims, args.queries, modes=args.modes):
+        print(result)
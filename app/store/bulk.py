@@ -0,0 +1,72 @@
+import threading
+from typing import Iterable, List
+
+from elasticsearch import Elasticsearch, helpers
+from fastapi.logger import logger
+
+from app.store.exceptions import BulkIndexingException
+
+
+class BulkIngester:
+    """Long-lived bulk writer sharing the pooled client of the store.
+
+    Actions are sent by `thread_count` threads in bulk requests holding at
+    most `chunk_size` documents and `max_chunk_bytes` bytes, whichever is
+    reached first. At most `queue_size` chunks wait for a free thread, so a
+    lazy iterable of actions is only consumed as fast as Elasticsearch
+    takes it in.
+
+    Every item is sent even if some fail, failed items are logged and
+    reported together in a BulkIndexingException.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 10 * 1024 * 1024,
+        thread_count: int = 4,
+        queue_size: int = 4,
+    ) -> None:
+        self.client = client
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+        self._counters = {"indexed": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    def ingest(self, actions: Iterable[dict]) -> List[str]:
+        """Sends `actions` and returns the ids of the documents written."""
+        ids = []
+        errors = []
+        results = helpers.parallel_bulk(
+            self.client,
+            actions,
+            thread_count=self.thread_count,
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            queue_size=self.queue_size,
+            raise_on_error=False,
+        )
+        for ok, item in results:
+            ((op_type, result),) = item.items()
+            if ok:
+                ids.append(result["_id"])
+            else:
+                logger.error(f"Bulk {op_type} of {result.get('_id')} failed: {result.get('error')}")
+                errors.append(item)
+
+        with self._lock:
+            self._counters["indexed"] += len(ids)
+            self._counters["failed"] += len(errors)
+        if errors:
+            raise BulkIndexingException(
+                f"{len(errors)} of {len(ids) + len(errors)} documents failed to index",
+                errors,
+            )
+        return ids
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
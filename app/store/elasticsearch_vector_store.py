@@ -1,33 +1,383 @@
-import os
+import uuid
+from contextlib import nullcontext
+from typing import Iterator, NamedTuple
 
 import sentry_sdk
 
+from elasticsearch import BadRequestError, Elasticsearch, NotFoundError, helpers
+from starlette.concurrency import run_in_threadpool
 from langchain.vectorstores import VectorStore
 from langchain.docstore.document import Document
 
+from app.cache import LRUCache
+from app.embedders.queries import embed_queries
 from app.store import IStorage
+from app.store.bulk import BulkIngester
+from app.store.exceptions import (
+    PreviewSegmentNotFoundException,
+    SearchException,
+    TaskNotFoundException,
+)
+from app.store.index_cache import IndexMetadataCache
+from app.store.ingest import IngestSessions
+from app.store.previews import (
+    DEFAULT_SEGMENT_SIZE,
+    STREAM_SEGMENTS_PER_READ,
+    decode_segment,
+    encode_segment,
+    preview_id,
+    segment_id,
+    segment_range,
+    split_segments,
+)
+from app.store.vector_index import (
+    FLOAT,
+    es_version,
+    knn_score_to_script_score,
+    script_score_source,
+    script_score_to_similarity,
+    vector_mapping,
+)
+
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:  # pragma: no cover
+    OrjsonSerializer = None
+
+
+# default index.max_result_window
+QUERY_SEARCH_MAX_HITS = 10000
+
+# responses without hits have no hits key at all
+HIT_IDS_FILTER_PATH = "hits.hits._id"
+
+# joins the ids of the tasks of a delete into the one id returned for it
+TASK_ID_SEPARATOR = ","
+
+
+def create_elasticsearch_client(es_url: str, timeout: int, **kwargs) -> Elasticsearch:
+    """Creates a client that serializes with orjson when it is installed,
+    which writes numpy vectors directly instead of converting them to
+    python lists first.
+
+    The client keeps a pool of connections per node and is safe to share
+    between threads, create one per process.
+    """
+    if OrjsonSerializer is not None:
+        kwargs["serializer"] = OrjsonSerializer()
+    return Elasticsearch(hosts=es_url, timeout=timeout, **kwargs)
+
+
+class VectorSearchRequest(NamedTuple):
+    """A search by vector, as the keyword arguments of client.search, and
+    how to read its hits."""
+
+    params: dict
+    threshold: float
+    routing: str = None
+    knn: bool = False
+
+    def body(self) -> dict:
+        """The request as a search body, for _msearch."""
+        return {
+            ("_source" if key == "source" else key): value
+            for key, value in self.params.items()
+        }
 
 
 class ElasticsearchVectorStoreIndex(IStorage):
-    def __init__(self, vectorstore: VectorStore, score=1.55):
+    """Products, searched with an exact script_score over the products
+    matching the filter or, when `knn_num_candidates` is set, with
+    approximate kNN over an HNSW graph built with `hnsw_options`.
+
+    With `routing`, documents are routed by the `routing_field` of their
+    metadata, their tenant, and the searches and deletes of a tenant only
+    go to the shard holding it.
+    """
+
+    vector_field = "vector"
+    text_field = "text"
+    search_k = 15
+    routing_field = "catalog_id"
+
+    def __init__(
+        self,
+        vectorstore: VectorStore,
+        score=1.55,
+        vector_index_mode=FLOAT,
+        knn_num_candidates=0,
+        hnsw_options=None,
+        routing=False,
+        ingest_options=None,
+    ):
         self.vectorstore = vectorstore
         self.score = score
+        self.vector_index_mode = vector_index_mode
+        self.knn_num_candidates = knn_num_candidates
+        self.hnsw_options = hnsw_options
+        self.routing = routing
+        self.ingest_options = ingest_options or {}
+        self._index_cache = None
+        self._ingest_sessions = None
+        self._index_created = False
+
+    @property
+    def index_cache(self) -> IndexMetadataCache:
+        if self._index_cache is None:
+            self._index_cache = IndexMetadataCache(self.vectorstore.client)
+        return self._index_cache
+
+    @property
+    def ingest_sessions(self) -> IngestSessions:
+        if self._ingest_sessions is None:
+            self._ingest_sessions = IngestSessions(
+                self.vectorstore.client, self.vectorstore.index_name, **self.ingest_options
+            )
+        return self._ingest_sessions
+
+    def ingest_session(self):
+        """Context manager wrapping a large load, see IngestSessions.
+        Writes made in it are refreshed once, when it ends."""
+        return self.ingest_sessions.session()
+
+    def _ingest(self, size: int):
+        """An ingest session for writes of `size` documents big enough to
+        pay for changing the index settings."""
+        if size >= self.ingest_sessions.min_docs:
+            return self.ingest_session()
+        return nullcontext()
+
+    def _refresh(self) -> None:
+        """Makes the last writes searchable, at the end of the ingest
+        session when there is one."""
+        if not self.ingest_sessions.active:
+            self.vectorstore.client.indices.refresh(index=self.vectorstore.index_name)
+
+    @property
+    def _uses_vector_index(self) -> bool:
+        """Whether vectors are written and searched here instead of through
+        langchain, whose products index has no HNSW graph, normalized
+        vectors or routing."""
+        return (
+            self.vector_index_mode != FLOAT
+            or bool(self.knn_num_candidates)
+            or self.routing
+        )
+
+    def _routing_params(self, tenant) -> dict:
+        """Routing of the requests made for `tenant`, none when routing is
+        off or the tenant is unknown."""
+        if not self.routing or tenant is None:
+            return {}
+        return {"routing": str(tenant)}
+
+    def _index_action(self, doc_id: str, text: str, vector, metadata) -> dict:
+        metadata = dict(metadata)
+        action = {
+            "_op_type": "index",
+            "_index": self.vectorstore.index_name,
+            "_id": doc_id,
+            self.vector_field: vector,
+            self.text_field: text,
+            "metadata": metadata,
+        }
+        if self.routing:
+            action["_routing"] = str(metadata[self.routing_field])
+        return action
 
-    def save(self, doc: Document) -> list[str]:
+    def save(self, doc: Document, ids: list[str] = None) -> list[str]:
+        """Indexes `doc`, replacing the document with the same id if `ids`
+        is given."""
         texts = [doc.page_content]
         metadatas = [doc.metadata]
-        return self.vectorstore.add_texts(texts, metadatas)
-
-    def save_batch(self, documents: list[Document]) -> list[str]:
+        if self._uses_vector_index:
+            return self._add_texts(texts, metadatas, ids)
+        if ids is None:
+            return self.vectorstore.add_texts(texts, metadatas)
+        return self.vectorstore.add_texts(texts, metadatas, ids=ids)
+
+    def save_batch(self, documents: list[Document], ids: list[str] = None) -> list[str]:
+        """Indexes `documents` in one bulk request, replacing the documents
+        with the same ids if `ids` are given. Large batches are written in
+        an ingest session."""
         texts = [doc.page_content for doc in documents]
         metadatas = [doc.metadata for doc in documents]
-        return self.vectorstore.add_texts(texts, metadatas)
+        with self._ingest(len(documents)):
+            if self._uses_vector_index:
+                return self._add_texts(texts, metadatas, ids)
+            kwargs = {} if ids is None else {"ids": ids}
+            if self.ingest_sessions.active:
+                kwargs["refresh_indices"] = False
+            return self.vectorstore.add_texts(texts, metadatas, **kwargs)
+
+    def _add_texts(self, texts: list[str], metadatas: list, ids: list[str] = None) -> list[str]:
+        """Same as ElasticVectorSearch.add_texts, creating the index with
+        the vector mapping of `vector_index_mode` and `hnsw_options`."""
+        embeddings = self.vectorstore.embedding.embed_documents(texts)
+        self._create_index_if_not_exists(len(embeddings[0]))
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        requests = [
+            self._index_action(doc_id, text, vector, metadata)
+            for doc_id, vector, text, metadata in zip(ids, embeddings, texts, metadatas)
+        ]
+        helpers.bulk(self.vectorstore.client, requests)
+        self._refresh()
+        return ids
+
+    def _create_index_if_not_exists(self, dims: int) -> None:
+        if self._index_created:
+            return
+        client = self.vectorstore.client
+        if not client.indices.exists(index=self.vectorstore.index_name):
+            vector = vector_mapping(
+                dims, self.vector_index_mode, es_version(client), self.hnsw_options
+            )
+            client.indices.create(
+                index=self.vectorstore.index_name,
+                mappings={"properties": {"vector": vector}},
+            )
+        self._index_created = True
 
     def search(self, search: str, filter=None, threshold=0.1) -> list[Document]:
-        sr = self.vectorstore.similarity_search_with_score(
-            query=search, k=15, filter=filter
+        # same query as ElasticVectorSearch.similarity_search_with_score,
+        # which fetches the vectors of the hits too
+        embedding = self.vectorstore.embedding.embed_query(search)
+        return self.search_by_vector(embedding, filter, threshold)
+
+    async def asearch(self, search: str, filter=None, threshold=0.1) -> list[Document]:
+        embedding = await self.vectorstore.embedding.aembed_query(search)
+        return await run_in_threadpool(
+            self.search_by_vector, embedding, filter, threshold
+        )
+
+    def search_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[Document]]:
+        """Runs several searches with one embedding call and one _msearch,
+        returning their results in the same order."""
+        embeddings = embed_queries(self.vectorstore.embedding, searches)
+        return self.search_by_vectors(embeddings, filters, thresholds)
+
+    def search_by_vector(self, embedding, filter=None, threshold=0.1) -> list[Document]:
+        return self._run_search(self._vector_search_request(embedding, filter, threshold))
+
+    def search_by_vectors(
+        self, embeddings: list, filters: list[dict], thresholds: list[float]
+    ) -> list[list[Document]]:
+        requests = [
+            self._vector_search_request(embedding, filter, threshold)
+            for embedding, filter, threshold in zip(embeddings, filters, thresholds)
+        ]
+        if not requests:
+            return []
+        searches = []
+        for request in requests:
+            searches.append(
+                {"index": self.vectorstore.index_name, **self._routing_params(request.routing)}
+            )
+            searches.append(request.body())
+        response = self.vectorstore.client.msearch(searches=searches)
+        results = []
+        for request, item in zip(requests, response["responses"]):
+            if "error" in item:
+                raise SearchException(f"Search failed: {item['error']}")
+            results.append(self._documents(request, item))
+        return results
+
+    def _vector_search_request(
+        self, embedding, filter=None, threshold=0.1
+    ) -> VectorSearchRequest:
+        routing = (filter or {}).get(self.routing_field)
+        if self.knn_num_candidates:
+            knn_filter = [
+                {"term": {f"metadata.{key}.keyword": f"{value}"}}
+                for key, value in (filter or {}).items()
+            ]
+            return self._knn_request(
+                embedding, knn_filter, threshold, k=self.search_k, routing=routing
+            )
+
+        if filter:
+            ((key, value),) = filter.items()
+            query = {"match": {f"metadata.{key}.keyword": f"{value}"}}
+        else:
+            query = {"match_all": {}}
+        return self._script_score_request(embedding, query, threshold, self.search_k, routing)
+
+    def _script_score_search(
+        self, embedding, query: dict, threshold: float, k: int, routing=None
+    ) -> list[Document]:
+        """Exact search scoring every document matching `query`. Only the
+        text and metadata of the hits are fetched, not their vectors."""
+        return self._run_search(
+            self._script_score_request(embedding, query, threshold, k, routing)
+        )
+
+    def _script_score_request(
+        self, embedding, query: dict, threshold: float, k: int, routing=None
+    ) -> VectorSearchRequest:
+        script_query = {
+            "script_score": {
+                "query": query,
+                "script": {
+                    "source": script_score_source(self.vector_index_mode),
+                    "params": {"query_vector": embedding},
+                },
+            }
+        }
+        params = {
+            "query": script_query,
+            "size": k,
+            "min_score": threshold,
+            "source": ["metadata", self.text_field],
+        }
+        return VectorSearchRequest(params, threshold, routing)
+
+    def _knn_search(
+        self, embedding, filter: list, threshold: float, k: int, routing=None
+    ) -> list[Document]:
+        """Approximate kNN with the filter applied while walking the graph,
+        so k hits are found within the filter, and the threshold applied by
+        Elasticsearch."""
+        return self._run_search(self._knn_request(embedding, filter, threshold, k, routing))
+
+    def _knn_request(
+        self, embedding, filter: list, threshold: float, k: int, routing=None
+    ) -> VectorSearchRequest:
+        knn = {
+            "field": self.vector_field,
+            "query_vector": embedding,
+            "k": k,
+            "num_candidates": max(self.knn_num_candidates, k),
+            "similarity": script_score_to_similarity(threshold),
+        }
+        if filter:
+            knn["filter"] = filter
+        params = {"knn": knn, "size": k, "source": ["metadata", self.text_field]}
+        return VectorSearchRequest(params, threshold, routing, knn=True)
+
+    def _run_search(self, request: VectorSearchRequest) -> list[Document]:
+        response = self.vectorstore.client.search(
+            index=self.vectorstore.index_name,
+            **request.params,
+            **self._routing_params(request.routing),
         )
-        return [doc[0] for doc in sr if doc[1] > threshold]
+        return self._documents(request, response)
+
+    def _documents(self, request: VectorSearchRequest, response) -> list[Document]:
+        documents = []
+        for hit in response["hits"]["hits"]:
+            score = hit["_score"]
+            if request.knn:
+                score = knn_score_to_script_score(score)
+            if score > request.threshold:
+                documents.append(
+                    Document(
+                        page_content=hit["_source"].get(self.text_field, ""),
+                        metadata=hit["_source"]["metadata"],
+                    )
+                )
+        return documents
 
     def query_search(self, search_filter: dict) -> list[dict]:
         match_field: str = list(search_filter.keys())[0]
@@ -40,37 +390,189 @@ class ElasticsearchVectorStoreIndex(IStorage):
                 "filter": {"terms": {term_field: term_value}},
             }
         }
-        try:
-            self.vectorstore.client.indices.get(index=self.vectorstore.index_name)
-        except Exception:
+        if not self.index_cache.exists(self.vectorstore.index_name):
             return []
 
-        source = ["metadata"]
-        response = self.vectorstore.client.search(
-            index=self.vectorstore.index_name, query=query_script, source=source
-        )
-        hits = [hit for hit in response["hits"]["hits"]]
-        return hits
-
-    def delete(self, ids: list[str] = []) -> bool:
-        return self.vectorstore.delete(ids)
+        # every copy of every product searched for, not only the first 10,
+        # callers only need their ids
+        try:
+            response = self.vectorstore.client.search(
+                index=self.vectorstore.index_name,
+                query=query_script,
+                source=False,
+                size=QUERY_SEARCH_MAX_HITS,
+                filter_path=HIT_IDS_FILTER_PATH,
+                **self._routing_params(search_filter.get(f"metadata.{self.routing_field}")),
+            )
+        except NotFoundError:
+            self.index_cache.invalidate(self.vectorstore.index_name)
+            return []
+        return response.get("hits", {}).get("hits", [])
+
+    def delete(self, ids: list[str] = [], routing: str = None) -> bool:
+        """Deletes documents by id. Routed documents are only found with
+        the `routing` of their tenant."""
+        if not self._routing_params(routing):
+            return self.vectorstore.delete(ids)
+        requests = [
+            {
+                "_op_type": "delete",
+                "_index": self.vectorstore.index_name,
+                "_id": doc_id,
+                "_routing": str(routing),
+            }
+            for doc_id in ids
+        ]
+        helpers.bulk(self.vectorstore.client, requests)
+        self._refresh()
+        return True
 
 
 class ContentBaseElasticsearchVectorStoreIndex(ElasticsearchVectorStoreIndex):
+    """Content base chunks, searched with an exact script_score over the
+    chunks of the content base or, when `knn_num_candidates` is set, with
+    approximate kNN.
+
+    Content bases with at most `exact_search_max_docs` chunks keep the exact
+    search, which is as fast as kNN on few documents and has perfect recall.
+    Chunk counts are cached for `doc_count_ttl` seconds.
+
+    The full pages the chunks were split from are stored once each in
+    `pages_index_name`, chunks only hold the page_id of their page. The
+    whole text of each file, its preview, is kept in `documents_index_name`.
+    """
+
+    search_k = 5
+    routing_field = "content_base_uuid"
+
+    def __init__(
+        self,
+        vectorstore: VectorStore,
+        score=1.55,
+        vector_index_mode=FLOAT,
+        knn_num_candidates=0,
+        exact_search_max_docs=0,
+        doc_count_ttl=300,
+        bulk_options=None,
+        routing=False,
+        ingest_options=None,
+        pages_index_name="content_base_pages",
+        documents_index_name="content_base_documents",
+        preview_segment_size=DEFAULT_SEGMENT_SIZE,
+    ):
+        super().__init__(
+            vectorstore,
+            score,
+            vector_index_mode,
+            knn_num_candidates,
+            routing=routing,
+            ingest_options=ingest_options,
+        )
+        self.exact_search_max_docs = exact_search_max_docs
+        self.pages_index_name = pages_index_name
+        self.documents_index_name = documents_index_name
+        self.preview_segment_size = preview_segment_size
+        self._ensured_indices = set()
+        self.bulk_options = bulk_options or {}
+        self._doc_counts = LRUCache(max_size=10000, ttl=doc_count_ttl)
+        self._bulk_ingester = None
+
+    @property
+    def bulk_ingester(self) -> BulkIngester:
+        if self._bulk_ingester is None:
+            self._bulk_ingester = BulkIngester(self.vectorstore.client, **self.bulk_options)
+        return self._bulk_ingester
 
     def save(self, docs: list[Document]) -> list[str]:
-        index = os.environ.get("INDEX_CONTENTBASES_NAME", "content_bases")
-        res = self.vectorstore.from_documents(
-            docs,
-            self.vectorstore.embeddings,
-            es_url=os.environ.get("ELASTICSEARCH_URL"),
-            index_name=index,
-            bulk_kwargs={
-                "chunk_size": os.environ.get("DEFAULT_CHUNK_SIZE", 75),
-                "max_chunk_bytes": 200000000
+        """Embeds and indexes `docs` through the bulk ingester. Chunks are
+        embedded a bulk request at a time, while the previous requests are
+        being written. Large loads are written in an ingest session."""
+        if not docs:
+            return []
+        with self._ingest(len(docs)):
+            ids = self.bulk_ingester.ingest(self._index_actions(docs))
+            self._refresh()
+        return ids
+
+    def _index_actions(self, docs: list[Document]):
+        batch_size = self.bulk_ingester.chunk_size
+        for start in range(0, len(docs), batch_size):
+            batch = docs[start:start + batch_size]
+            embeddings = self.vectorstore.embeddings.embed_documents(
+                [doc.page_content for doc in batch]
+            )
+            self._create_index_if_not_exists(len(embeddings[0]))
+            for doc, vector in zip(batch, embeddings):
+                yield self._index_action(
+                    str(uuid.uuid4()), doc.page_content, vector, doc.metadata
+                )
+
+    def _create_index_if_not_exists(self, dims: int) -> None:
+        """Creates the index with the mapping of the retrieval strategy of
+        the store."""
+        if self._index_created:
+            return
+        self.vectorstore._create_index_if_not_exists(self.vectorstore.index_name, dims)
+        self._index_created = True
+
+    def save_pages(self, pages: list[Document], ids: list[str]) -> list[str]:
+        """Indexes the full pages referenced by the page_id of the chunks,
+        replacing the pages with the same ids."""
+        if not pages:
+            return []
+        # pages are only read by id, their content is not indexed
+        self._ensure_index(self.pages_index_name, {"content": {"type": "text", "index": False}})
+        actions = []
+        for page_id, page in zip(ids, pages):
+            metadata = dict(page.metadata)
+            action = {
+                "_op_type": "index",
+                "_index": self.pages_index_name,
+                "_id": page_id,
+                "content": page.page_content,
+                "metadata": metadata,
             }
-        )
-        return res
+            if self.routing:
+                action["_routing"] = str(metadata[self.routing_field])
+            actions.append(action)
+        return self.bulk_ingester.ingest(actions)
+
+    def get_pages(self, page_ids: list[str], content_base_uuid: str = None) -> dict[str, str]:
+        """Fetches the content of `page_ids` in a single mget. Pages that do
+        not exist are left out."""
+        if not page_ids:
+            return {}
+        docs = [
+            {"_id": page_id, **self._routing_params(content_base_uuid)}
+            for page_id in page_ids
+        ]
+        try:
+            response = self.vectorstore.client.mget(
+                index=self.pages_index_name, docs=docs, source=["content"]
+            )
+        except NotFoundError:
+            return {}
+        return {
+            doc["_id"]: doc["_source"]["content"]
+            for doc in response["docs"]
+            if doc.get("found")
+        }
+
+    def _ensure_index(self, index: str, properties: dict) -> None:
+        """Creates `index` with the mapping of `properties` or, if it
+        already exists, adds them to its mapping."""
+        if index in self._ensured_indices:
+            return
+        client = self.vectorstore.client
+        try:
+            if self.index_cache.exists(index):
+                client.indices.put_mapping(index=index, properties=properties)
+            else:
+                client.indices.create(index=index, mappings={"properties": properties})
+        except BadRequestError as e:
+            if e.error != "resource_already_exists_exception":
+                raise
+        self._ensured_indices.add(index)
 
     def query_search(self, search_filter: dict) -> list[dict]:
         match_field: str = list(search_filter.keys())[0]
@@ -81,17 +583,21 @@ class ContentBaseElasticsearchVectorStoreIndex(ElasticsearchVectorStoreIndex):
                 "must": [{"match": {match_field: match_value}}],
             }
         }
-        try:
-            self.vectorstore.client.indices.get(index=self.vectorstore.index_name)
-        except Exception:
+        if not self.index_cache.exists(self.vectorstore.index_name):
             return []
 
-        source = ["metadata"]
-        response = self.vectorstore.client.search(
-            index=self.vectorstore.index_name, query=query_script, source=source
-        )
-        hits = [hit for hit in response["hits"]["hits"]]
-        return hits
+        try:
+            response = self.vectorstore.client.search(
+                index=self.vectorstore.index_name,
+                query=query_script,
+                source=False,
+                filter_path=HIT_IDS_FILTER_PATH,
+                **self._routing_params(search_filter.get(f"metadata.{self.routing_field}")),
+            )
+        except NotFoundError:
+            self.index_cache.invalidate(self.vectorstore.index_name)
+            return []
+        return response.get("hits", {}).get("hits", [])
 
     def search_delete(self, search_filter: dict, scroll_id: str = None) -> tuple[str, dict]:
 
@@ -115,67 +621,352 @@ class ContentBaseElasticsearchVectorStoreIndex(ElasticsearchVectorStoreIndex):
             }
         }
 
-        try:
-            self.vectorstore.client.indices.get(index=self.vectorstore.index_name)
-        except Exception:
+        if not self.index_cache.exists(self.vectorstore.index_name):
             return []
 
-        source = ["metadata"]
-
-        response = self.vectorstore.client.search(
-            index=self.vectorstore.index_name,
-            query=query_script,
-            source=source,
-            scroll="2m",
-            size=100,
-        )
+        try:
+            response = self.vectorstore.client.search(
+                index=self.vectorstore.index_name,
+                query=query_script,
+                source=False,
+                scroll="2m",
+                size=100,
+                **self._routing_params(search_filter.get(f"metadata.{self.routing_field}")),
+            )
+        except NotFoundError:
+            self.index_cache.invalidate(self.vectorstore.index_name)
+            return []
         scroll_id = response["_scroll_id"]
         hits = [hit for hit in response["hits"]["hits"]]
         return scroll_id, hits
 
+    def delete_by_query(self, search_filter: dict, wait_for_completion: bool = True) -> dict:
+        """Deletes the chunks whose metadata matches every field of
+        `search_filter` exactly, in sliced batches run by Elasticsearch.
+
+        Returns the delete_by_query response or, when `wait_for_completion`
+        is False, a response holding the id of the task doing the deletion.
+        """
+        return self._delete_by_query(
+            self.vectorstore.index_name,
+            self._metadata_query(search_filter),
+            wait_for_completion,
+            search_filter.get(f"metadata.{self.routing_field}"),
+        )
+
+    def delete_pages(self, search_filter: dict, wait_for_completion: bool = True) -> dict:
+        """Same as delete_by_query, for the pages."""
+        return self._delete_by_query(
+            self.pages_index_name,
+            self._metadata_query(search_filter),
+            wait_for_completion,
+            search_filter.get(f"metadata.{self.routing_field}"),
+        )
+
+    def _metadata_query(self, search_filter: dict) -> dict:
+        return {
+            "bool": {
+                "filter": [
+                    {"term": {f"{field}.keyword": value}}
+                    for field, value in search_filter.items()
+                ]
+            }
+        }
+
+    def delete_content_base(self, content_base_uuid: str, wait_for_completion: bool = False) -> dict:
+        """Deletes every chunk, page and document of a content base.
+
+        Without `wait_for_completion` each index is deleted from by its own
+        Elasticsearch task, their ids are returned joined as one that
+        get_task reads.
+        """
+        responses = [
+            self._delete_by_query(
+                self.documents_index_name,
+                {"term": {"content_base_uuid.keyword": content_base_uuid}},
+                wait_for_completion,
+            ),
+            self.delete_pages(
+                {"metadata.content_base_uuid": content_base_uuid}, wait_for_completion
+            ),
+            self.delete_by_query(
+                {"metadata.content_base_uuid": content_base_uuid}, wait_for_completion
+            ),
+        ]
+        tasks = [response["task"] for response in responses if "task" in response]
+        if tasks:
+            return {"task": TASK_ID_SEPARATOR.join(tasks)}
+        return {"deleted": sum(response.get("deleted", 0) for response in responses)}
+
+    def _delete_by_query(
+        self, index: str, query: dict, wait_for_completion: bool, routing=None
+    ) -> dict:
+        try:
+            return self.vectorstore.client.delete_by_query(
+                index=index,
+                query=query,
+                slices="auto",
+                conflicts="proceed",
+                refresh=True,
+                wait_for_completion=wait_for_completion,
+                **self._routing_params(routing),
+            )
+        except NotFoundError:
+            return {"deleted": 0}
+
+    def get_task(self, task_id: str) -> dict:
+        """The progress of the tasks joined in `task_id`, summed as if they
+        were one task."""
+        completed, deleted, total = True, 0, 0
+        for task in task_id.split(TASK_ID_SEPARATOR):
+            try:
+                response = self.vectorstore.client.tasks.get(task_id=task)
+            except (BadRequestError, NotFoundError) as e:
+                # malformed, unknown, or finished and no longer stored
+                raise TaskNotFoundException(f"Task {task} was not found") from e
+            status = response.get("response") or response.get("task", {}).get("status", {})
+            completed = completed and response.get("completed", False)
+            deleted += status.get("deleted", 0)
+            total += status.get("total", 0)
+        return {"completed": completed, "response": {"deleted": deleted, "total": total}}
+
     def search(self, search: str, filter=None, threshold=0.1) -> list[Document]:
+        if self.knn_num_candidates or self.routing:
+            embedding = self.vectorstore.embedding.embed_query(search)
+            return self.search_by_vector(embedding, filter, threshold)
+
         content_base_uuid = filter.get("content_base_uuid")
         q = {"bool": {"filter": [{"term": {"metadata.content_base_uuid.keyword": content_base_uuid}}]}}
 
 
-        docs = self.vectorstore.similarity_search_with_score(query=search, k=5, filter=q)
+        docs = self.vectorstore.similarity_search_with_score(query=search, k=self.search_k, filter=q)
         return [doc[0] for doc in docs if doc[1] > threshold]
 
-    def delete(self, ids: list[str] = []) -> bool:
-        return self.vectorstore.delete(ids)
+    def search_by_vector(self, embedding, filter=None, threshold=0.1) -> list[Document]:
+        content_base_uuid = filter.get("content_base_uuid")
+        term = {"term": {"metadata.content_base_uuid.keyword": content_base_uuid}}
+        if self._use_knn(content_base_uuid, term):
+            return self._knn_search(
+                embedding, [term], threshold, k=self.search_k, routing=content_base_uuid
+            )
+        if self.routing:
+            return self._script_score_search(
+                embedding, term, threshold, self.search_k, routing=content_base_uuid
+            )
+
+        q = {"bool": {"filter": [term]}}
+        docs = self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding=embedding, k=self.search_k, filter=q
+        )
+        return [doc[0] for doc in docs if doc[1] > threshold]
+
+    def _vector_search_request(
+        self, embedding, filter=None, threshold=0.1
+    ) -> VectorSearchRequest:
+        """The search of search_by_vector, the exact one always as a
+        script_score, which scores as langchain's exact strategy."""
+        content_base_uuid = filter.get("content_base_uuid")
+        term = {"term": {"metadata.content_base_uuid.keyword": content_base_uuid}}
+        if self._use_knn(content_base_uuid, term):
+            return self._knn_request(
+                embedding, [term], threshold, k=self.search_k, routing=content_base_uuid
+            )
+        return self._script_score_request(
+            embedding, term, threshold, self.search_k, routing=content_base_uuid
+        )
+
+    def _use_knn(self, content_base_uuid: str, term: dict) -> bool:
+        if not self.knn_num_candidates:
+            return False
+        if not self.exact_search_max_docs:
+            return True
+        count = self._doc_counts.get(content_base_uuid)
+        if count is None:
+            count = self.vectorstore.client.count(
+                index=self.vectorstore.index_name,
+                query=term,
+                **self._routing_params(content_base_uuid),
+            )["count"]
+            self._doc_counts.set(content_base_uuid, count)
+        return count > self.exact_search_max_docs
 
     def save_doc_content(self, full_content, content_base_uuid, filename, file_uuid) -> None:
-        elasticsearch_doc = {
-            "content": full_content,
-            "content_base_uuid": content_base_uuid,
-            "filename": filename,
-            "file_uuid":file_uuid
-        }
-        es_client = self.vectorstore.client
-        res = es_client.index(index="content_base_documents", body=elasticsearch_doc)
-        return
+        """Writes the preview of a file in place of its previous one, its
+        text split into compressed segments of `preview_segment_size`
+        characters."""
+        segments = split_segments(full_content, self.preview_segment_size)
+        ids = [preview_id(content_base_uuid, file_uuid)]
+        actions = [
+            {
+                "_op_type": "index",
+                "_index": self.documents_index_name,
+                "_id": ids[0],
+                "content_base_uuid": content_base_uuid,
+                "file_uuid": file_uuid,
+                "filename": filename,
+                "length": len(full_content),
+                "segment_size": self.preview_segment_size,
+                "segments": len(segments),
+            }
+        ]
+        for segment, text in enumerate(segments):
+            ids.append(segment_id(content_base_uuid, file_uuid, segment))
+            actions.append({
+                "_op_type": "index",
+                "_index": self.documents_index_name,
+                "_id": ids[-1],
+                "content_base_uuid": content_base_uuid,
+                "file_uuid": file_uuid,
+                "segment": segment,
+                "data": encode_segment(text),
+            })
+        self._ensure_index(self.documents_index_name, {"data": {"type": "binary"}})
+        self.bulk_ingester.ingest(actions)
+
+        # segments left by a longer previous version and copies written
+        # before previews had ids
+        self._delete_by_query(
+            self.documents_index_name,
+            {
+                "bool": {
+                    "filter": [
+                        {"term": {"content_base_uuid.keyword": content_base_uuid}},
+                        {"term": {"file_uuid.keyword": file_uuid}},
+                    ],
+                    "must_not": [{"ids": {"values": ids}}],
+                }
+            },
+            wait_for_completion=True,
+        )
 
-    def search_doc_content(self, file_uuid: str, content_base_uuid: str) -> str:
+    def search_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> dict:
+        """Reads `length` characters of the preview of a file from `offset`,
+        every character from `offset` on when `length` is None, fetching
+        only the segments holding them.
+
+        Returns the content read and the length of the whole preview.
+        """
+        header_id = preview_id(content_base_uuid, file_uuid)
+        needed = segment_range(offset, length, self.preview_segment_size)
+        try:
+            docs = self._get_preview_docs(
+                [header_id] + [segment_id(content_base_uuid, file_uuid, i) for i in needed]
+            )
+            header = docs.pop(header_id, None)
+            if header is None:
+                return self._search_legacy_doc_content(file_uuid, content_base_uuid, offset, length)
+
+            segment_size = header["segment_size"]
+            needed = segment_range(offset, length, segment_size, header["length"])
+            data = {doc["segment"]: doc["data"] for doc in docs.values()}
+            missing = [i for i in needed if i not in data]
+            if missing:
+                docs = self._get_preview_docs(
+                    [segment_id(content_base_uuid, file_uuid, i) for i in missing]
+                )
+                data.update({doc["segment"]: doc["data"] for doc in docs.values()})
+            text = "".join(decode_segment(self._preview_segment(data, i, file_uuid)) for i in needed)
+        except Exception as e:
+            sentry_sdk.capture_message(f"{e}")
+            return {"content": "", "total_length": 0}
+
+        start = offset - needed.start * segment_size if needed else 0
+        content = text[start:] if length is None else text[start:start + length]
+        return {"content": content, "total_length": header["length"]}
+
+    def iter_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> Iterator[dict]:
+        """Yields the same slice as search_doc_content, one segment at a
+        time, as {"offset", "content", "total_length"}, reading
+        STREAM_SEGMENTS_PER_READ segments per request so memory does not
+        grow with the size of the file.
+
+        A read failing partway ends the stream with {"error"}, telling the
+        client the content it got is truncated.
+        """
+        try:
+            yield from self._iter_doc_content(file_uuid, content_base_uuid, offset, length)
+        except Exception as e:
+            sentry_sdk.capture_message(f"{e}")
+            yield {"error": str(e)}
+
+    def _iter_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int, length: int
+    ) -> Iterator[dict]:
+        header_id = preview_id(content_base_uuid, file_uuid)
+        header = self._get_preview_docs([header_id]).get(header_id)
+        if header is None:
+            legacy = self._search_legacy_doc_content(file_uuid, content_base_uuid, offset, length)
+            for start in range(0, len(legacy["content"]), self.preview_segment_size):
+                yield {
+                    "offset": offset + start,
+                    "content": legacy["content"][start:start + self.preview_segment_size],
+                    "total_length": legacy["total_length"],
+                }
+            return
+
+        segment_size = header["segment_size"]
+        total_length = header["length"]
+        end = total_length if length is None else min(offset + length, total_length)
+        needed = segment_range(offset, length, segment_size, total_length)
+        for batch_start in range(needed.start, needed.stop, STREAM_SEGMENTS_PER_READ):
+            batch = range(batch_start, min(batch_start + STREAM_SEGMENTS_PER_READ, needed.stop))
+            docs = self._get_preview_docs(
+                [segment_id(content_base_uuid, file_uuid, i) for i in batch]
+            )
+            data = {doc["segment"]: doc["data"] for doc in docs.values()}
+            for i in batch:
+                segment_start = i * segment_size
+                text = decode_segment(self._preview_segment(data, i, file_uuid))
+                start = max(offset - segment_start, 0)
+                stop = min(end - segment_start, len(text))
+                yield {
+                    "offset": segment_start + start,
+                    "content": text[start:stop],
+                    "total_length": total_length,
+                }
+
+    @staticmethod
+    def _preview_segment(data: dict[int, str], index: int, file_uuid: str) -> str:
+        # removed by a concurrent rewrite of the preview
+        if index not in data:
+            raise PreviewSegmentNotFoundException(
+                f"Segment {index} of the preview of {file_uuid} was not found"
+            )
+        return data[index]
+
+    def _get_preview_docs(self, ids: list[str]) -> dict[str, dict]:
+        response = self.vectorstore.client.mget(
+            index=self.documents_index_name,
+            ids=ids,
+            source=["length", "segment_size", "segment", "data"],
+        )
+        return {doc["_id"]: doc["_source"] for doc in response["docs"] if doc.get("found")}
+
+    def _search_legacy_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int, length: int
+    ) -> dict:
+        """Previews written whole, without an id."""
         query = {
             "bool": {
                 "filter": [
-                    { "term": { "file_uuid.keyword": file_uuid}},
-                    { "term": { "content_base_uuid.keyword": content_base_uuid}}
+                    {"term": {"file_uuid.keyword": file_uuid}},
+                    {"term": {"content_base_uuid.keyword": content_base_uuid}},
                 ]
             }
         }
-        es_client = self.vectorstore.client
-        try:
-            res = es_client.search(index="content_base_documents", query=query)
-            hits = res["hits"]["hits"]
-
-            if len(hits) > 0:
-                doc = hits[0]
-                return doc.get("_source").get("content")
-            return ""
-        except Exception as e:
-            sentry_sdk.capture_message(f"{e}")
-            return ""
+        res = self.vectorstore.client.search(
+            index=self.documents_index_name, query=query, source=["content"], size=1
+        )
+        hits = res["hits"]["hits"]
+        if not hits:
+            return {"content": "", "total_length": 0}
+        content = hits[0]["_source"].get("content") or ""
+        end = None if length is None else offset + length
+        return {"content": content[offset:end], "total_length": len(content)}
 
     def check_if_doc_was_embedded_document(self, file_uuid: str, content_base_uuid: str) -> bool:
         query = {
@@ -188,7 +979,14 @@ class ContentBaseElasticsearchVectorStoreIndex(ElasticsearchVectorStoreIndex):
         }
         es_client = self.vectorstore.client
         try:
-            res = es_client.search(index=self.vectorstore.index_name, query=query)
+            # only whether a chunk exists, no hits are fetched
+            res = es_client.search(
+                index=self.vectorstore.index_name,
+                query=query,
+                size=0,
+                terminate_after=1,
+                **self._routing_params(content_base_uuid),
+            )
             hits = res["hits"].get("total").get("value")
 
             return hits > 0
@@ -0,0 +1,20 @@
+class VectorIndexMigrationException(Exception):
+    pass
+
+
+class BulkIndexingException(Exception):
+    def __init__(self, message: str, errors: list):
+        super().__init__(message)
+        self.errors = errors
+
+
+class SearchException(Exception):
+    pass
+
+
+class PreviewSegmentNotFoundException(Exception):
+    pass
+
+
+class TaskNotFoundException(Exception):
+    pass
@@ -0,0 +1,46 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+from elasticsearch import Elasticsearch
+from fastapi.logger import logger
+
+
+class IndexMetadataCache:
+    """Per-process cache of the indices.get response of each index, so
+    checking that an index exists does not cost a request per query.
+
+    Only existing indexes are cached: a missing index is looked up again
+    until it is created. Entries must be invalidated when a request fails
+    because the index was deleted.
+    """
+
+    def __init__(self, client: Elasticsearch) -> None:
+        self.client = client
+        self._indices: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, index: str) -> Optional[Any]:
+        """Returns the metadata of `index`, None if it does not exist or
+        cannot be fetched."""
+        metadata = self._indices.get(index)
+        if metadata is not None:
+            return metadata
+        try:
+            metadata = self.client.indices.get(index=index)
+        except Exception:
+            return None
+        with self._lock:
+            self._indices[index] = metadata
+        return metadata
+
+    def exists(self, index: str) -> bool:
+        return self.get(index) is not None
+
+    def invalidate(self, index: str) -> None:
+        with self._lock:
+            self._indices.pop(index, None)
+
+    def warm(self, indices: List[str]) -> None:
+        for index in indices:
+            if not self.exists(index):
+                logger.warning(f"Index {index} not found while warming the index cache")
@@ -0,0 +1,115 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from elasticsearch import Elasticsearch, NotFoundError
+from fastapi.logger import logger
+
+
+class IngestSessions:
+    """Relaxes the refresh of an index for the length of a large load.
+
+    While a thread holds a session its writes are not refreshed one by
+    one. The first session opened on the index sets its refresh_interval
+    to `refresh_interval`, "-1" to stop periodic refreshes, and the last
+    one closed restores the previous value, even when the load failed.
+    Every outermost session ends with one explicit refresh, so what it
+    wrote is searchable when it returns.
+
+    With `refresh_interval` None the index settings are left alone and
+    sessions only merge the refreshes of the writes they wrap. Sessions
+    nest, the inner ones do nothing.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        index: str,
+        refresh_interval: Optional[str] = "-1",
+        min_docs: int = 1000,
+    ) -> None:
+        self.client = client
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.min_docs = min_docs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._relaxed = 0
+        self._previous = None
+
+    @property
+    def active(self) -> bool:
+        """Whether the current thread holds a session."""
+        return getattr(self._local, "depth", 0) > 0
+
+    @contextmanager
+    def session(self) -> Iterator[None]:
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+
+        relaxed = self._relax()
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            try:
+                if relaxed:
+                    self._restore()
+            finally:
+                self._refresh()
+
+    def _relax(self) -> bool:
+        if self.refresh_interval is None:
+            return False
+        with self._lock:
+            if not self._relaxed:
+                try:
+                    response = self.client.indices.get_settings(
+                        index=self.index, name="index.refresh_interval"
+                    )
+                    settings = next(iter(response.values()), {}).get("settings", {})
+                    previous = settings.get("index", {}).get("refresh_interval")
+                    self._put_refresh_interval(self.refresh_interval)
+                except NotFoundError:
+                    # created by the load itself, with the default settings
+                    return False
+                except Exception as e:
+                    logger.warning(f"Could not relax the refresh of {self.index}: {e}")
+                    return False
+                # left relaxed by a session of another process, which
+                # restores it, the default is the best guess of the original
+                self._previous = None if previous == self.refresh_interval else previous
+            self._relaxed += 1
+        return True
+
+    def _restore(self) -> None:
+        with self._lock:
+            self._relaxed -= 1
+            if self._relaxed:
+                return
+            try:
+                self._put_refresh_interval(self._previous)
+            except Exception as e:
+                logger.error(
+                    f"Could not restore the refresh_interval of {self.index}: {e}"
+                )
+
+    def _put_refresh_interval(self, value: Optional[str]) -> None:
+        # None resets the setting to its default
+        self.client.indices.put_settings(
+            index=self.index, settings={"index": {"refresh_interval": value}}
+        )
+
+    def _refresh(self) -> None:
+        try:
+            self.client.indices.refresh(index=self.index)
+        except NotFoundError:
+            # nothing was written
+            pass
@@ -0,0 +1,192 @@
+"""Moves an existing vector index to another VECTOR_INDEX_MODE, re-keys
+product documents by catalog and retailer id and/or routes the documents
+by tenant.
+
+The documents are reindexed into a new index created with the vector
+mapping of the mode, normalizing the vectors on the way, and the old index
+is then atomically replaced by an alias with its name pointing to the new
+one, so the application keeps using the same index name.
+
+Re-keying gives products indexed with random ids the id they are written
+with now, collapsing duplicate copies of a product into one document.
+
+Routing sets the routing of every document to its tenant, as written with
+PRODUCT_ROUTING_ENABLED or CONTENT_BASE_ROUTING_ENABLED, usually into an
+index with more primary shards. Enable routing right after the swap.
+
+Writes made to the old index while the reindex runs are not copied, run it
+while indexing is paused.
+
+    python -m app.store.migrations catalog_products --mode int8
+    python -m app.store.migrations catalog_products --rekey-products
+    python -m app.store.migrations content_bases --routing-field content_base_uuid --shards 6
+"""
+import argparse
+import logging
+import time
+
+from elasticsearch import Elasticsearch
+from fastapi.logger import logger
+
+from app.store.exceptions import VectorIndexMigrationException
+from app.store.vector_index import FLOAT, VECTOR_INDEX_MODES, es_version, vector_mapping
+
+NORMALIZE_VECTOR_SCRIPT = """
+def vector = ctx._source[params.field];
+if (vector != null) {
+  double norm = 0;
+  for (def value : vector) {
+    norm += value * value;
+  }
+  norm = Math.sqrt(norm);
+  if (norm > 0) {
+    for (int i = 0; i < vector.size(); i++) {
+      vector.set(i, vector.get(i) / norm);
+    }
+  }
+}
+"""
+
+# same id as app.indexer.products.product_document_id
+PRODUCT_ID_SCRIPT = """
+ctx._id = ctx._source.metadata.catalog_id + ':' + ctx._source.metadata.product_retailer_id;
+"""
+
+# same routing as ElasticsearchVectorStoreIndex with routing
+ROUTING_SCRIPT = """
+ctx._routing = String.valueOf(ctx._source.metadata[params.routing_field]);
+"""
+
+ROUTING_FIELDS = ("catalog_id", "content_base_uuid")
+
+
+def migrate_vector_index(
+    client: Elasticsearch,
+    index: str,
+    mode: str = None,
+    target: str = None,
+    vector_field: str = "vector",
+    swap: bool = True,
+    poll_interval: float = 5.0,
+    hnsw_options: dict = None,
+    rekey_products: bool = False,
+    routing_field: str = None,
+    number_of_shards: int = None,
+) -> str:
+    """Reindexes `index` (an index or an alias) into `target` with the vector
+    mapping of `mode` and `hnsw_options`, or the same mapping when `mode` is
+    None, and, when `swap` is set, makes `index` an alias of it.
+
+    Documents are routed by the `routing_field` of their metadata when it
+    is given. `number_of_shards` defaults to the Elasticsearch default.
+
+    Returns the name of the new index.
+    """
+    ((source, body),) = client.indices.get_mapping(index=index).items()
+    suffix = mode or ("rekeyed" if rekey_products else "routed")
+    target = target or f"{index}_{suffix}_{int(time.time())}"
+
+    mappings = body["mappings"]
+    if mode is not None:
+        properties = dict(mappings.get("properties", {}))
+        dims = properties[vector_field]["dims"]
+        properties[vector_field] = vector_mapping(
+            dims, mode, es_version(client), hnsw_options
+        )
+        mappings = {**mappings, "properties": properties}
+    new_index = {"index": target, "mappings": mappings}
+    if number_of_shards:
+        new_index["settings"] = {"number_of_shards": number_of_shards}
+    client.indices.create(**new_index)
+
+    reindex = {"source": {"index": source}, "dest": {"index": target}}
+    scripts = []
+    if mode is not None and mode != FLOAT:
+        scripts.append(NORMALIZE_VECTOR_SCRIPT)
+    if rekey_products:
+        scripts.append(PRODUCT_ID_SCRIPT)
+    if routing_field:
+        scripts.append(ROUTING_SCRIPT)
+    if scripts:
+        reindex["script"] = {
+            "source": "".join(scripts),
+            "params": {"field": vector_field, "routing_field": routing_field},
+        }
+    task_id = client.reindex(**reindex, wait_for_completion=False)["task"]
+    logger.info(f"Reindexing {source} into {target}, task {task_id}")
+
+    while True:
+        task = client.tasks.get(task_id=task_id)
+        if task["completed"]:
+            break
+        status = task["task"]["status"]
+        logger.info(f"Reindexed {status['created']} of {status['total']} documents")
+        time.sleep(poll_interval)
+
+    response = task.get("response", {})
+    if task.get("error") or response.get("failures"):
+        raise VectorIndexMigrationException(
+            f"Reindex of {source} into {target} failed: "
+            f"{task.get('error') or response['failures'][:5]}"
+        )
+
+    client.indices.refresh(index=target)
+    if swap:
+        client.indices.update_aliases(
+            actions=[
+                {"add": {"index": target, "alias": index}},
+                {"remove_index": {"index": source}},
+            ]
+        )
+    return target
+
+
+if __name__ == "__main__":
+    from app.config import AppConfig
+    from app.store.elasticsearch_vector_store import create_elasticsearch_client
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("index")
+    parser.add_argument("--mode", choices=VECTOR_INDEX_MODES, default=None)
+    parser.add_argument("--target", default=None)
+    parser.add_argument(
+        "--no-swap", action="store_true", help="keep the old index in place"
+    )
+    parser.add_argument(
+        "--hnsw", action="store_true",
+        help="build the HNSW graph with VECTOR_HNSW_M and VECTOR_HNSW_EF_CONSTRUCTION",
+    )
+    parser.add_argument(
+        "--rekey-products", action="store_true",
+        help="give product documents their catalog_id:product_retailer_id id",
+    )
+    parser.add_argument(
+        "--routing-field", choices=ROUTING_FIELDS, default=None,
+        help="route documents by this metadata field",
+    )
+    parser.add_argument(
+        "--shards", type=int, default=None, help="primary shards of the new index"
+    )
+    args = parser.parse_args()
+    if args.mode is None and not args.rekey_products and not args.routing_field:
+        parser.error(
+            "nothing to migrate, give --mode, --rekey-products and/or --routing-field"
+        )
+    if args.hnsw and args.mode is None:
+        parser.error("--hnsw needs --mode")
+    logging.basicConfig(level=logging.INFO)
+
+    config = AppConfig()
+    client = create_elasticsearch_client(config.es_url, timeout=int(config.es_timeout))
+    new_index = migrate_vector_index(
+        client,
+        args.index,
+        args.mode,
+        target=args.target,
+        swap=not args.no_swap,
+        hnsw_options=config.vector_hnsw if args.hnsw else None,
+        rekey_products=args.rekey_products,
+        routing_field=args.routing_field,
+        number_of_shards=args.shards,
+    )
+    print(f"{args.index} migrated to {new_index}")
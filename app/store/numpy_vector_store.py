@@ -0,0 +1,634 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from starlette.concurrency import run_in_threadpool
+
+from app.embedders.normalized import normalize_vectors
+from app.embedders.queries import embed_queries
+from app.store import IStorage
+from app.store.exceptions import TaskNotFoundException
+from app.store.previews import DEFAULT_SEGMENT_SIZE
+
+DOCUMENTS_FILE = "documents.json"
+FILES_DIRECTORY = "files"
+LOCK_FILE = ".lock"
+
+
+def matches(metadata: dict, search_filter: dict) -> bool:
+    """Whether `metadata` has every value of `search_filter`, keyed by
+    field with or without the "metadata." prefix. A list value matches
+    any of its items."""
+    for key, value in search_filter.items():
+        if key.startswith("metadata."):
+            key = key[len("metadata."):]
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if str(metadata.get(key)) not in {str(item) for item in values}:
+            return False
+    return True
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+def file_stamp(path: str) -> tuple:
+    """Changes whenever the file is replaced, even within the mtime
+    resolution of the filesystem."""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class Segment:
+    """The documents of one tenant, their unit vectors kept in one
+    contiguous float32 matrix so a search is a single matrix product.
+
+    On disk a segment is a directory holding the vectors in an .npy file,
+    loaded memory-mapped, and the texts and metadata in a json file naming
+    the .npy file of the current version. The pages and the preview of
+    each file are kept in a json file of their own, read when asked for
+    and written only when they change.
+    """
+
+    def __init__(self, tenant: str) -> None:
+        self.tenant = tenant
+        self.ids: list[str] = []
+        self.texts: list[str] = []
+        self.metadatas: list[dict] = []
+        self.positions: dict[str, int] = {}
+        # file of every page, and the files with pages or a preview
+        self.page_files: dict[str, str] = {}
+        self.file_uuids: set[str] = set()
+        self.version = 0
+        self.stamp = None
+        self.directory: Optional[str] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._files: dict[str, dict] = {}
+        self._changed_files: set[str] = set()
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix[:len(self.ids)]
+
+    def upsert(self, ids: list[str], texts: list[str], metadatas: list[dict], vectors: np.ndarray) -> None:
+        self._reserve(len(self.ids) + len(ids), vectors.shape[1])
+        for doc_id, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+            position = self.positions.get(doc_id)
+            if position is None:
+                position = len(self.ids)
+                self.positions[doc_id] = position
+                self.ids.append(doc_id)
+                self.texts.append(text)
+                self.metadatas.append(metadata)
+            else:
+                self.texts[position] = text
+                self.metadatas[position] = metadata
+            self._matrix[position] = vector
+
+    def _reserve(self, size: int, dims: int) -> None:
+        """Grows the matrix, doubling it, unless it has room for `size`
+        rows and is not the read-only mapping of the file."""
+        matrix = self._matrix
+        if matrix is not None and matrix.shape[0] >= size and matrix.flags.writeable:
+            return
+        capacity = max(size, 2 * len(self.ids), 16)
+        grown = np.empty((capacity, dims), dtype=np.float32)
+        if self.ids:
+            grown[:len(self.ids)] = self.vectors
+        self._matrix = grown
+
+    def remove(self, positions: list[int]) -> int:
+        if not positions:
+            return 0
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[positions] = False
+        self._matrix = np.ascontiguousarray(self.vectors[keep])
+        self.ids = [doc_id for doc_id, kept in zip(self.ids, keep) if kept]
+        self.texts = [text for text, kept in zip(self.texts, keep) if kept]
+        self.metadatas = [metadata for metadata, kept in zip(self.metadatas, keep) if kept]
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        return len(positions)
+
+    def matching(self, search_filter: dict) -> list[int]:
+        return [
+            i for i, metadata in enumerate(self.metadatas)
+            if matches(metadata, search_filter)
+        ]
+
+    def top_k(self, query: np.ndarray, k: int, threshold: float, positions: list[int] = None) -> list[tuple]:
+        """(score, position) of the `k` best documents scoring more than
+        `threshold`, best first. Scores are cosine + 1.0, the scale of the
+        Elasticsearch script_score."""
+        if not self.ids:
+            return []
+        if positions is None:
+            candidates = np.arange(len(self.ids))
+            scores = self.vectors @ query + 1.0
+        else:
+            candidates = np.asarray(positions, dtype=np.int64)
+            if not len(candidates):
+                return []
+            scores = self.vectors[candidates] @ query + 1.0
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [
+            (float(scores[i]), int(candidates[i]))
+            for i in best
+            if scores[i] > threshold
+        ]
+
+    def document(self, position: int) -> Document:
+        return Document(page_content=self.texts[position], metadata=self.metadatas[position])
+
+    def file(self, file_uuid: str) -> dict:
+        """The {"pages", "preview"} of a file, read from disk once."""
+        file_uuid = str(file_uuid)
+        entry = self._files.get(file_uuid)
+        if entry is None:
+            entry = {"pages": {}, "preview": None}
+            if self.directory and file_uuid in self.file_uuids:
+                try:
+                    with open(self._file_path(self.directory, file_uuid), encoding="utf-8") as f:
+                        entry = json.load(f)
+                except FileNotFoundError:
+                    # removed by a newer version
+                    pass
+            self._files[file_uuid] = entry
+        return entry
+
+    def _changed(self, file_uuid: str) -> dict:
+        file_uuid = str(file_uuid)
+        entry = self.file(file_uuid)
+        self._changed_files.add(file_uuid)
+        return entry
+
+    def set_page(self, page_id: str, page: dict) -> None:
+        file_uuid = str(page["metadata"].get("file_uuid", ""))
+        previous = self.page_files.get(page_id)
+        if previous is not None and previous != file_uuid:
+            self._changed(previous)["pages"].pop(page_id, None)
+        self._changed(file_uuid)["pages"][page_id] = page
+        self.page_files[page_id] = file_uuid
+
+    def page(self, page_id: str) -> Optional[dict]:
+        file_uuid = self.page_files.get(page_id)
+        if file_uuid is None:
+            return None
+        return self.file(file_uuid)["pages"].get(page_id)
+
+    def remove_pages(self, search_filter: dict) -> int:
+        file_uuid = search_filter.get("metadata.file_uuid", search_filter.get("file_uuid"))
+        if file_uuid is None or isinstance(file_uuid, (list, tuple, set)):
+            file_uuids = set(self.page_files.values())
+        else:
+            file_uuids = {str(file_uuid)} & set(self.page_files.values())
+        removed = 0
+        for file_uuid in file_uuids:
+            pages = self.file(file_uuid)["pages"]
+            stale = [page_id for page_id, page in pages.items() if matches(page["metadata"], search_filter)]
+            if stale:
+                pages = self._changed(file_uuid)["pages"]
+                for page_id in stale:
+                    del pages[page_id]
+                    del self.page_files[page_id]
+                removed += len(stale)
+        return removed
+
+    def set_preview(self, file_uuid: str, preview: dict) -> None:
+        self._changed(file_uuid)["preview"] = preview
+
+    def preview(self, file_uuid: str) -> Optional[dict]:
+        return self.file(file_uuid)["preview"]
+
+    @staticmethod
+    def _file_path(directory: str, file_uuid: str) -> str:
+        return os.path.join(directory, FILES_DIRECTORY, f"{_digest(file_uuid)}.json")
+
+    def dump(self, directory: str) -> None:
+        """Writes a new version of the segment. The json file is replaced
+        last, readers see either version whole."""
+        os.makedirs(os.path.join(directory, FILES_DIRECTORY), exist_ok=True)
+        for file_uuid in self._changed_files:
+            entry = self._files[file_uuid]
+            if entry["pages"] or entry["preview"] is not None:
+                self.file_uuids.add(file_uuid)
+                _replace(
+                    self._file_path(directory, file_uuid),
+                    lambda f: f.write(json.dumps(entry).encode("utf-8")),
+                )
+            else:
+                self.file_uuids.discard(file_uuid)
+        self._changed_files.clear()
+        self.version += 1
+        vectors_file = f"vectors-{self.version}.npy" if self.ids else None
+        if vectors_file:
+            _replace(os.path.join(directory, vectors_file), lambda f: np.save(f, self.vectors))
+        data = {
+            "tenant": self.tenant,
+            "version": self.version,
+            "vectors": vectors_file,
+            "ids": self.ids,
+            "texts": self.texts,
+            "metadatas": self.metadatas,
+            "page_files": self.page_files,
+            "file_uuids": sorted(self.file_uuids),
+        }
+        documents_path = os.path.join(directory, DOCUMENTS_FILE)
+        _replace(documents_path, lambda f: f.write(json.dumps(data).encode("utf-8")))
+        self.stamp = file_stamp(documents_path)
+        self.directory = directory
+        for name in os.listdir(directory):
+            if name.startswith("vectors-") and name != vectors_file:
+                os.remove(os.path.join(directory, name))
+        files = {f"{_digest(file_uuid)}.json" for file_uuid in self.file_uuids}
+        for name in os.listdir(os.path.join(directory, FILES_DIRECTORY)):
+            if name not in files:
+                os.remove(os.path.join(directory, FILES_DIRECTORY, name))
+
+    @classmethod
+    def load(cls, directory: str) -> "Segment":
+        documents_path = os.path.join(directory, DOCUMENTS_FILE)
+        stamp = file_stamp(documents_path)
+        with open(documents_path, encoding="utf-8") as f:
+            data = json.load(f)
+        segment = cls(data["tenant"])
+        segment.version = data["version"]
+        segment.ids = data["ids"]
+        segment.texts = data["texts"]
+        segment.metadatas = data["metadatas"]
+        segment.page_files = data["page_files"]
+        segment.file_uuids = set(data["file_uuids"])
+        segment.positions = {doc_id: i for i, doc_id in enumerate(segment.ids)}
+        segment.stamp = stamp
+        segment.directory = directory
+        if data["vectors"]:
+            segment._matrix = np.load(os.path.join(directory, data["vectors"]), mmap_mode="r")
+        return segment
+
+
+def _replace(path: str, write) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class NumpyVectorStore(IStorage):
+    """Products kept in process, searched with an exact dot product over
+    the unit vectors of a tenant, a catalog, or of every tenant when the
+    search is not filtered by one. Scores and thresholds are the ones of
+    the Elasticsearch store.
+
+    With a `path`, every tenant is persisted in its own segment directory
+    and loaded lazily, its vectors memory-mapped. Segments changed on disk
+    by another process, a celery worker, are reloaded when next read.
+    Writes hold a file lock on the segment, reload it and persist it
+    before releasing the lock, so processes sharing a path do not undo
+    each other's writes. An ingest session holds the locks of the
+    segments it writes until it ends.
+    """
+
+    routing_field = "catalog_id"
+    search_k = 15
+
+    def __init__(self, embeddings: Embeddings, path: str = None, index_name: str = "products"):
+        self.embeddings = embeddings
+        self.path = path
+        self.index_name = index_name
+        self._segments: dict[str, Segment] = {}
+        self._dirty: set[str] = set()
+        self._file_locks: dict[str, int] = {}
+        self._sessions = 0
+        self._lock = threading.RLock()
+
+    def _directory(self, tenant: str) -> str:
+        return os.path.join(self.path, self.index_name, _digest(tenant))
+
+    def _segment(self, tenant, create: bool = False) -> Optional[Segment]:
+        tenant = "" if tenant is None else str(tenant)
+        with self._lock:
+            segment = self._segments.get(tenant)
+            if self.path and tenant not in self._dirty:
+                segment = self._load(self._directory(tenant), segment)
+            if segment is None and create:
+                segment = Segment(tenant)
+            if segment is not None:
+                self._segments[tenant] = segment
+            else:
+                self._segments.pop(tenant, None)
+            return segment
+
+    def _load(self, directory: str, segment: Optional[Segment]) -> Optional[Segment]:
+        """The segment stored in `directory`, `segment` if it is current."""
+        try:
+            stamp = file_stamp(os.path.join(directory, DOCUMENTS_FILE))
+        except FileNotFoundError:
+            # removed since it was cached
+            return None
+        if segment is not None and segment.stamp == stamp:
+            return segment
+        return Segment.load(directory)
+
+    def _all_segments(self) -> list[Segment]:
+        with self._lock:
+            if self.path:
+                root = os.path.join(self.path, self.index_name)
+                loaded = {self._directory(tenant) for tenant in self._segments}
+                for tenant in list(self._segments):
+                    self._segment(tenant)
+                for name in os.listdir(root) if os.path.isdir(root) else []:
+                    directory = os.path.join(root, name)
+                    if directory not in loaded:
+                        segment = self._load(directory, None)
+                        if segment is not None:
+                            self._segments[segment.tenant] = segment
+            return list(self._segments.values())
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """Persists the segments written in the block and releases their
+        file locks, when the last ingest session ends if one is open."""
+        with self._lock:
+            try:
+                yield
+            finally:
+                if not self._sessions:
+                    self._flush()
+
+    def _writable(self, tenant, create: bool = False) -> Optional[Segment]:
+        """The segment of `tenant` as last persisted by any process, locked
+        against their writes until it is flushed."""
+        tenant = "" if tenant is None else str(tenant)
+        if self.path and tenant not in self._file_locks:
+            directory = self._directory(tenant)
+            os.makedirs(directory, exist_ok=True)
+            fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+            self._file_locks[tenant] = fd
+        return self._segment(tenant, create)
+
+    def _written(self, segment: Segment) -> None:
+        self._dirty.add(segment.tenant)
+
+    def _flush(self) -> None:
+        try:
+            for tenant in self._dirty:
+                segment = self._segments.get(tenant)
+                if self.path and segment is not None:
+                    segment.dump(self._directory(tenant))
+            self._dirty.clear()
+        finally:
+            # closing the file releases its lock
+            for fd in self._file_locks.values():
+                os.close(fd)
+            self._file_locks.clear()
+
+    @contextmanager
+    def ingest_session(self) -> Iterator[None]:
+        """Writes made in the session are persisted once, when it ends."""
+        with self._lock:
+            self._sessions += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._sessions -= 1
+                if not self._sessions:
+                    self._flush()
+
+    def grouped_writes(self):
+        return self.ingest_session()
+
+    def save(self, doc: Document, ids: list[str] = None) -> list[str]:
+        return self.save_batch([doc], ids=ids)
+
+    def save_batch(self, documents: list[Document], ids: list[str] = None) -> list[str]:
+        """Indexes `documents`, replacing the documents with the same ids
+        if `ids` are given."""
+        if not documents:
+            return []
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+        vectors = normalize_vectors(
+            self.embeddings.embed_documents([doc.page_content for doc in documents])
+        )
+        by_tenant: dict[str, list[int]] = {}
+        for i, doc in enumerate(documents):
+            by_tenant.setdefault(str(doc.metadata.get(self.routing_field, "")), []).append(i)
+        with self._writing():
+            for tenant, positions in by_tenant.items():
+                segment = self._writable(tenant, create=True)
+                segment.upsert(
+                    [ids[i] for i in positions],
+                    [documents[i].page_content for i in positions],
+                    [dict(documents[i].metadata) for i in positions],
+                    vectors[positions],
+                )
+                self._written(segment)
+        return ids
+
+    def search(self, search: str, filter=None, threshold=0.1) -> list[Document]:
+        return self.search_by_vector(self.embeddings.embed_query(search), filter, threshold)
+
+    async def asearch(self, search: str, filter=None, threshold=0.1) -> list[Document]:
+        embedding = await self.embeddings.aembed_query(search)
+        return await run_in_threadpool(self.search_by_vector, embedding, filter, threshold)
+
+    def search_batch(
+        self, searches: list[str], filters: list[dict], thresholds: list[float]
+    ) -> list[list[Document]]:
+        embeddings = embed_queries(self.embeddings, searches)
+        return [
+            self.search_by_vector(embedding, filter, threshold)
+            for embedding, filter, threshold in zip(embeddings, filters, thresholds)
+        ]
+
+    def search_by_vector(self, embedding, filter=None, threshold=0.1) -> list[Document]:
+        query = normalize_vectors(embedding)
+        filter = dict(filter or {})
+        if self.routing_field in filter:
+            segment = self._segment(filter.pop(self.routing_field))
+            segments = [] if segment is None else [segment]
+        else:
+            segments = self._all_segments()
+
+        hits = []
+        with self._lock:
+            for segment in segments:
+                positions = segment.matching(filter) if filter else None
+                hits.extend(
+                    (score, segment.document(position))
+                    for score, position in segment.top_k(query, self.search_k, threshold, positions)
+                )
+        hits.sort(key=lambda hit: -hit[0])
+        return [doc for _, doc in hits[:self.search_k]]
+
+    def query_search(self, search_filter: dict) -> list[dict]:
+        """Ids of the documents matching every field of `search_filter`, as
+        hits of an Elasticsearch search."""
+        with self._lock:
+            return [
+                {"_id": segment.ids[position]}
+                for segment in self._filtered_segments(search_filter)
+                for position in segment.matching(search_filter)
+            ]
+
+    def _filtered_segments(self, search_filter: dict) -> list[Segment]:
+        tenant = search_filter.get(f"metadata.{self.routing_field}")
+        if tenant is None or isinstance(tenant, (list, tuple, set)):
+            return self._all_segments()
+        segment = self._segment(tenant)
+        return [] if segment is None else [segment]
+
+    def delete(self, ids: list[str] = [], routing: str = None) -> bool:
+        ids = set(ids)
+        with self._writing():
+            tenants = [s.tenant for s in self._all_segments()] if routing is None else [routing]
+            for tenant in tenants:
+                segment = self._writable(tenant)
+                if segment is None:
+                    continue
+                if segment.remove([segment.positions[doc_id] for doc_id in ids & segment.positions.keys()]):
+                    self._written(segment)
+        return True
+
+
+class ContentBaseNumpyVectorStore(NumpyVectorStore):
+    """Content base chunks, their pages and file previews kept in process,
+    one segment per content base. Deleting a content base is immediate,
+    its task is reported as completed."""
+
+    routing_field = "content_base_uuid"
+    search_k = 5
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        path: str = None,
+        index_name: str = "content_bases",
+        preview_segment_size=DEFAULT_SEGMENT_SIZE,
+    ):
+        super().__init__(embeddings, path, index_name)
+        self.preview_segment_size = preview_segment_size
+        self._tasks: dict[str, int] = {}
+
+    def save(self, docs: list[Document]) -> list[str]:
+        return self.save_batch(docs)
+
+    def delete_by_query(self, search_filter: dict, wait_for_completion: bool = True) -> dict:
+        deleted = 0
+        with self._writing():
+            for segment in self._filtered_segments(search_filter):
+                segment = self._writable(segment.tenant)
+                removed = segment.remove(segment.matching(search_filter))
+                if removed:
+                    deleted += removed
+                    self._written(segment)
+        return {"deleted": deleted}
+
+    def save_pages(self, pages: list[Document], ids: list[str]) -> list[str]:
+        with self._writing():
+            for page_id, page in zip(ids, pages):
+                segment = self._writable(page.metadata.get(self.routing_field), create=True)
+                segment.set_page(page_id, {"content": page.page_content, "metadata": dict(page.metadata)})
+                self._written(segment)
+        return ids
+
+    def get_pages(self, page_ids: list[str], content_base_uuid: str = None) -> dict[str, str]:
+        if content_base_uuid is None:
+            segments = self._all_segments()
+        else:
+            segment = self._segment(content_base_uuid)
+            segments = [] if segment is None else [segment]
+        pages = {}
+        for segment in segments:
+            for page_id in page_ids:
+                page = segment.page(page_id)
+                if page is not None:
+                    pages[page_id] = page["content"]
+        return pages
+
+    def delete_pages(self, search_filter: dict, wait_for_completion: bool = True) -> dict:
+        deleted = 0
+        with self._writing():
+            for segment in self._filtered_segments(search_filter):
+                segment = self._writable(segment.tenant)
+                removed = segment.remove_pages(search_filter)
+                if removed:
+                    deleted += removed
+                    self._written(segment)
+        return {"deleted": deleted}
+
+    def delete_content_base(self, content_base_uuid: str, wait_for_completion: bool = False) -> dict:
+        with self._writing():
+            segment = self._writable(content_base_uuid)
+            deleted = 0
+            if segment is not None:
+                deleted = len(segment.ids)
+                # an empty version, not a removed directory, so that other
+                # processes drop their copy when they next read it
+                emptied = Segment(segment.tenant)
+                emptied.version = segment.version
+                self._segments[segment.tenant] = emptied
+                self._written(emptied)
+            task_id = str(uuid.uuid4())
+            self._tasks[task_id] = deleted
+        return {"task": task_id, "deleted": deleted}
+
+    def get_task(self, task_id: str) -> dict:
+        if task_id not in self._tasks:
+            raise TaskNotFoundException(f"Task {task_id} was not found")
+        deleted = self._tasks[task_id]
+        return {"completed": True, "response": {"deleted": deleted, "total": deleted}}
+
+    def save_doc_content(self, full_content, content_base_uuid, filename, file_uuid) -> None:
+        with self._writing():
+            segment = self._writable(content_base_uuid, create=True)
+            segment.set_preview(file_uuid, {"filename": filename, "content": full_content})
+            self._written(segment)
+
+    def search_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> dict:
+        content = self._preview(file_uuid, content_base_uuid)
+        end = None if length is None else offset + length
+        return {"content": content[offset:end], "total_length": len(content)}
+
+    def iter_doc_content(
+        self, file_uuid: str, content_base_uuid: str, offset: int = 0, length: int = None
+    ) -> Iterator[dict]:
+        content = self._preview(file_uuid, content_base_uuid)
+        end = len(content) if length is None else min(offset + length, len(content))
+        for start in range(offset, end, self.preview_segment_size):
+            yield {
+                "offset": start,
+                "content": content[start:min(start + self.preview_segment_size, end)],
+                "total_length": len(content),
+            }
+
+    def _preview(self, file_uuid: str, content_base_uuid: str) -> str:
+        segment = self._segment(content_base_uuid)
+        if segment is None:
+            return ""
+        preview = segment.preview(file_uuid)
+        return (preview or {}).get("content") or ""
+
+    def check_if_doc_was_embedded_document(self, file_uuid: str, content_base_uuid: str) -> bool:
+        segment = self._segment(content_base_uuid)
+        return segment is not None and bool(segment.matching({"file_uuid": file_uuid}))
@@ -0,0 +1,47 @@
+"""Encoding of the documents previews, the full text of the indexed files.
+
+The text of a file is split into segments of a fixed number of
+characters, each compressed with zlib and stored base64 encoded, so a
+slice of the text is read by fetching and decoding only the segments it
+spans.
+"""
+import base64
+import zlib
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+# segments fetched per request when a preview is streamed
+STREAM_SEGMENTS_PER_READ = 4
+
+
+def preview_id(content_base_uuid: str, file_uuid: str) -> str:
+    return f"{content_base_uuid}:{file_uuid}"
+
+
+def segment_id(content_base_uuid: str, file_uuid: str, segment: int) -> str:
+    return f"{preview_id(content_base_uuid, file_uuid)}:{segment}"
+
+
+def split_segments(text: str, segment_size: int) -> list[str]:
+    return [text[i:i + segment_size] for i in range(0, len(text), segment_size)] or [""]
+
+
+def encode_segment(text: str) -> str:
+    return base64.b64encode(zlib.compress(text.encode("utf-8"))).decode("ascii")
+
+
+def decode_segment(data: str) -> str:
+    return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+
+
+def segment_range(offset: int, length: int, segment_size: int, total_length: int = None) -> range:
+    """Segments holding the characters [offset, offset + length), every
+    segment from offset on when length is None."""
+    if total_length is not None:
+        end = total_length if length is None else min(offset + length, total_length)
+    elif length is None:
+        return range(offset // segment_size, offset // segment_size + 1)
+    else:
+        end = offset + length
+    if end <= offset:
+        return range(0)
+    return range(offset // segment_size, (end - 1) // segment_size + 1)
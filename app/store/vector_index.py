@@ -0,0 +1,134 @@
+from typing import Dict, List, Union
+
+from elasticsearch import Elasticsearch
+from fastapi.logger import logger
+from langchain_community.vectorstores.elasticsearch import ExactRetrievalStrategy
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+FLOAT = "float"
+"""Raw float vectors scored with cosine similarity, the original layout."""
+NORMALIZED = "normalized"
+"""L2 normalized float vectors scored with dot product."""
+INT8 = "int8"
+"""Normalized vectors whose HNSW graph is scalar quantized to int8."""
+
+VECTOR_INDEX_MODES = (FLOAT, NORMALIZED, INT8)
+
+INT8_HNSW_MIN_VERSION = (8, 12)
+
+
+def es_version(client: Elasticsearch) -> tuple:
+    number = client.info()["version"]["number"]
+    return tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+
+
+def vector_mapping(
+    dims: int, mode: str, es_version: tuple = None, hnsw_options: dict = None
+) -> dict:
+    """Returns the dense_vector mapping of the vector field for `mode`.
+
+    `hnsw_options` (m, ef_construction) index float vectors for kNN search
+    too and tune the HNSW graph of every mode. int8 falls back to an
+    unquantized HNSW graph on clusters older than 8.12, which do not
+    support int8_hnsw.
+    """
+    if mode == FLOAT and hnsw_options is None:
+        return {"type": "dense_vector", "dims": dims}
+    mapping = {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine" if mode == FLOAT else "dot_product",
+    }
+    index_type = "hnsw"
+    if mode == INT8:
+        if es_version is None or es_version >= INT8_HNSW_MIN_VERSION:
+            index_type = "int8_hnsw"
+        else:
+            logger.warning(
+                f"Elasticsearch {es_version} does not support int8_hnsw, "
+                "indexing normalized float vectors instead"
+            )
+    if index_type != "hnsw" or hnsw_options:
+        mapping["index_options"] = {"type": index_type, **(hnsw_options or {})}
+    return mapping
+
+
+def knn_score_to_script_score(score: float) -> float:
+    """kNN hits score (1 + similarity) / 2 for cosine and dot_product, twice
+    that is the script score scale the search thresholds are given in."""
+    return 2 * score
+
+
+def script_score_to_similarity(threshold: float) -> float:
+    """Raw similarity a kNN hit needs to reach a script score threshold."""
+    return threshold - 1.0
+
+
+def script_score_source(mode: str, vector_field: str = "vector") -> str:
+    """Script scoring a document against params.query_vector. Both variants
+    score in [0, 2] so search thresholds mean the same in every mode."""
+    if mode == FLOAT:
+        return f"cosineSimilarity(params.query_vector, '{vector_field}') + 1.0"
+    return f"dotProduct(params.query_vector, '{vector_field}') + 1.0"
+
+
+class VectorIndexExactRetrievalStrategy(ExactRetrievalStrategy):
+    """Exact retrieval scored for `mode` that creates indexes with the
+    mapping of `mode` and `hnsw_options`.
+
+    Normalized vectors are scored with dotProduct + 1.0, equal to the
+    cosine + 1.0 of the default strategy for unit vectors but cheaper.
+    """
+
+    def __init__(self, mode: str = NORMALIZED, hnsw_options: dict = None) -> None:
+        self.mode = mode
+        self.hnsw_options = hnsw_options
+        self.es_version = None
+
+    def before_index_setup(
+        self, client: Elasticsearch, text_field: str, vector_query_field: str
+    ) -> None:
+        self.es_version = es_version(client)
+
+    def query(
+        self,
+        query_vector: Union[List[float], None],
+        query: Union[str, None],
+        k: int,
+        fetch_k: int,
+        vector_query_field: str,
+        text_field: str,
+        filter: Union[List[dict], None],
+        similarity: Union[DistanceStrategy, None],
+    ) -> Dict:
+        query_bool: Dict = {"match_all": {}}
+        if filter:
+            query_bool = {"bool": {"filter": filter}}
+        return {
+            "query": {
+                "script_score": {
+                    "query": query_bool,
+                    "script": {
+                        "source": script_score_source(self.mode, vector_query_field),
+                        "params": {"query_vector": query_vector},
+                    },
+                },
+            }
+        }
+
+    def index(
+        self,
+        dims_length: Union[int, None],
+        vector_query_field: str,
+        similarity: Union[DistanceStrategy, None],
+    ) -> Dict:
+        return {
+            "mappings": {
+                "properties": {
+                    vector_query_field: vector_mapping(
+                        dims_length, self.mode, self.es_version, self.hnsw_options
+                    ),
+                }
+            }
+        }
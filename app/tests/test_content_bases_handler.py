@@ -0,0 +1,31 @@
+import unittest
+from unittest.mock import Mock
+
+from fastapi import HTTPException
+
+from app.handlers.content_bases import ContentBaseDeleteTaskResponse, ContentBaseHandler
+from app.indexer.content_bases import ContentBaseIndexer
+from app.store.exceptions import TaskNotFoundException
+
+
+class TestContentBaseHandler(unittest.TestCase):
+    def setUp(self):
+        self.mock_indexer = Mock(spec=ContentBaseIndexer)
+        self.handler = ContentBaseHandler(self.mock_indexer)
+
+    def test_delete_task(self):
+        self.mock_indexer.get_delete_task.return_value = {"completed": False, "deleted": 10, "total": 25}
+
+        result = self.handler.delete_task("node:1,node:2")
+
+        self.assertEqual(result, ContentBaseDeleteTaskResponse(completed=False, deleted=10, total=25))
+        self.mock_indexer.get_delete_task.assert_called_once_with("node:1,node:2")
+
+    def test_delete_task_not_found(self):
+        self.mock_indexer.get_delete_task.side_effect = TaskNotFoundException("Task node:1 was not found")
+
+        with self.assertRaises(HTTPException) as context:
+            self.handler.delete_task("node:1")
+
+        self.assertEqual(context.exception.status_code, 404)
+        self.assertEqual(context.exception.detail, [{"msg": "Task node:1 was not found"}])
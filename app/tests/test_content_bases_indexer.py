@@ -0,0 +1,101 @@
+import unittest
+from contextlib import nullcontext
+from unittest.mock import Mock
+
+from langchain.docstore.document import Document
+
+from app.indexer.content_bases import ContentBaseIndexer
+from app.store.elasticsearch_vector_store import ContentBaseElasticsearchVectorStoreIndex
+
+
+class TestContentBaseIndexer(unittest.TestCase):
+    def setUp(self):
+        self.mock_storage = Mock(spec=ContentBaseElasticsearchVectorStoreIndex)
+        self.mock_storage.grouped_writes.return_value = nullcontext()
+        self.indexer = ContentBaseIndexer(self.mock_storage)
+
+    def test_index_documents_replaces_file_chunks(self):
+        docs = [
+            Document(
+                page_content="chunk",
+                metadata={"file_uuid": "f1", "content_base_uuid": "cb1"},
+            )
+        ]
+
+        self.indexer.index_documents(docs)
+
+        self.mock_storage.delete_by_query.assert_called_once_with(
+            {"metadata.content_base_uuid": "cb1", "metadata.file_uuid": "f1"}
+        )
+        self.mock_storage.save.assert_called_once_with(docs)
+        self.mock_storage.query_search.assert_not_called()
+
+    def test_delete(self):
+        self.indexer.delete("cb1", "file.pdf", "f1")
+
+        self.mock_storage.delete_by_query.assert_called_once_with(
+            {
+                "metadata.content_base_uuid": "cb1",
+                "metadata.file_uuid": "f1",
+                "metadata.source": "file.pdf",
+            }
+        )
+        self.mock_storage.search_delete.assert_not_called()
+
+    def test_delete_content_base(self):
+        self.mock_storage.delete_content_base.return_value = {"task": "node:42"}
+
+        task_id = self.indexer.delete_content_base("cb1")
+
+        self.assertEqual(task_id, "node:42")
+        self.mock_storage.delete_content_base.assert_called_once_with("cb1")
+
+    def test_get_delete_task(self):
+        self.mock_storage.get_task.return_value = {
+            "completed": False,
+            "response": {"deleted": 10, "total": 25},
+        }
+
+        self.assertEqual(
+            self.indexer.get_delete_task("node:42"),
+            {"completed": False, "deleted": 10, "total": 25},
+        )
+
+    def test_index_documents_stores_each_page_once(self):
+        metadata = {"file_uuid": "f1", "content_base_uuid": "cb1", "full_page": "first page"}
+        docs = [
+            Document(page_content="first", metadata=metadata),
+            Document(page_content="page", metadata=metadata),
+            Document(page_content="second", metadata={**metadata, "full_page": "second page"}),
+        ]
+
+        self.indexer.index_documents(docs)
+
+        pages, page_ids = self.mock_storage.save_pages.call_args.args
+        self.assertEqual([page.page_content for page in pages], ["first page", "second page"])
+        self.assertEqual(page_ids, ["f1:0", "f1:1"])
+        (chunks,) = self.mock_storage.save.call_args.args
+        self.assertEqual([chunk.metadata["page_id"] for chunk in chunks], ["f1:0", "f1:0", "f1:1"])
+        self.assertTrue(all("full_page" not in chunk.metadata for chunk in chunks))
+        self.mock_storage.delete_pages.assert_called_once_with(
+            {"metadata.content_base_uuid": "cb1", "metadata.file_uuid": "f1"}
+        )
+
+    def test_search_fetches_pages(self):
+        self.mock_storage.search.return_value = [
+            Document(page_content="first", metadata={"page_id": "f1:0", "content_base_uuid": "cb1", "file_uuid": "f1"}),
+            Document(page_content="page", metadata={"page_id": "f1:0", "content_base_uuid": "cb1", "file_uuid": "f1"}),
+            Document(page_content="old", metadata={"full_page": "legacy page", "file_uuid": "f0"}),
+        ]
+        self.mock_storage.get_pages.return_value = {"f1:0": "first page"}
+
+        results = self.indexer.search("first", filter={"content_base_uuid": "cb1"})
+
+        self.mock_storage.get_pages.assert_called_once_with(["f1:0"], "cb1")
+        self.assertEqual(
+            results,
+            [
+                {"full_page": "first page", "filename": None, "file_uuid": "f1"},
+                {"full_page": "legacy page", "filename": None, "file_uuid": "f0"},
+            ],
+        )
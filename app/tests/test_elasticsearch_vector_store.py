@@ -1,9 +1,16 @@
+import asyncio
 import unittest
 
-from langchain.vectorstores import ElasticVectorSearch
+from langchain.vectorstores import ElasticVectorSearch, ElasticsearchStore
 from langchain.docstore.document import Document
 from app.store.elasticsearch_vector_store import ElasticsearchVectorStoreIndex, ContentBaseElasticsearchVectorStoreIndex
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
+
+import numpy as np
+from elasticsearch import NotFoundError
+
+from app.store.exceptions import BulkIndexingException, SearchException, TaskNotFoundException
+from app.store.vector_index import NORMALIZED
 
 
 class ElasticsearchVectorStoreIndexTest(unittest.TestCase):
@@ -42,24 +49,206 @@ class ElasticsearchVectorStoreIndexTest(unittest.TestCase):
         )
         self.assertEqual(result, docs_ids)
 
-    def test_search(self):
-        self.vectorstore.similarity_search_with_score.return_value = [
-            (
-                Document(
-                    page_content="test doc", metadata={"doc_generic_id": "abc123"}
-                ),
-                1.6,
-            )
+    def test_save_batch_large_load_in_ingest_session(self):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, ingest_options={"min_docs": 2})
+        self.vectorstore.client.indices.get_settings.return_value = {"index_test": {"settings": {}}}
+        self.vectorstore.add_texts.return_value = ["1", "2"]
+        documents = [
+            Document(page_content="first doc", metadata={"doc_generic_id": "abc123"}),
+            Document(page_content="second doc", metadata={"doc_generic_id": "abc124"}),
         ]
+
+        storage.save_batch(documents, ids=["1", "2"])
+
+        self.vectorstore.add_texts.assert_called_once_with(
+            ["first doc", "second doc"],
+            [{"doc_generic_id": "abc123"}, {"doc_generic_id": "abc124"}],
+            ids=["1", "2"],
+            refresh_indices=False,
+        )
+        settings = [
+            call.kwargs["settings"] for call in self.vectorstore.client.indices.put_settings.call_args_list
+        ]
+        self.assertEqual(
+            settings, [{"index": {"refresh_interval": "-1"}}, {"index": {"refresh_interval": None}}]
+        )
+        self.vectorstore.client.indices.refresh.assert_called_once_with(index="index_test")
+
+    def test_save_batch_with_ids(self):
+        documents = [Document(page_content="first doc", metadata={"doc_generic_id": "abc123"})]
+        self.vectorstore.add_texts.return_value = ["789:998"]
+
+        result = self.storage.save_batch(documents, ids=["789:998"])
+
+        self.vectorstore.add_texts.assert_called_once_with(
+            ["first doc"], [{"doc_generic_id": "abc123"}], ids=["789:998"]
+        )
+        self.assertEqual(result, ["789:998"])
+
+    def test_search(self):
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_query.return_value = [0.6, 0.8]
+        self.vectorstore.client.search.return_value = {
+            "hits": {"hits": [{"_score": 1.6, "_source": {"text": "test doc", "metadata": {"doc_generic_id": "abc123"}}}]}
+        }
         results = self.storage.search(
             search="test", filter={"doc_generic_id": "abc123"}
         )
-        self.vectorstore.similarity_search_with_score.assert_called_once_with(
-            query="test", k=15, filter={"doc_generic_id": "abc123"}
+        self.vectorstore.similarity_search_with_score.assert_not_called()
+        kwargs = self.vectorstore.client.search.call_args.kwargs
+        self.assertEqual(kwargs["size"], 15)
+        self.assertEqual(kwargs["source"], ["metadata", "text"])
+        self.assertEqual(
+            kwargs["query"]["script_score"]["query"], {"match": {"metadata.doc_generic_id.keyword": "abc123"}}
+        )
+        self.assertEqual(
+            kwargs["query"]["script_score"]["script"]["source"], "cosineSimilarity(params.query_vector, 'vector') + 1.0"
         )
         self.assertEqual(1, len(results))
         self.assertEqual(results[0].page_content, "test doc")
 
+    def test_search_batch_runs_one_msearch(self):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, routing=True)
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_queries.return_value = [[0.6, 0.8], [0.8, 0.6]]
+        hit = {"_score": 1.6, "_source": {"text": "test doc", "metadata": {"catalog_id": "c1"}}}
+        far_hit = {"_score": 1.2, "_source": {"text": "far doc", "metadata": {"catalog_id": "c2"}}}
+        self.vectorstore.client.msearch.return_value = {
+            "responses": [{"hits": {"hits": [hit]}}, {"hits": {"hits": [far_hit]}}]
+        }
+
+        results = storage.search_batch(
+            ["first", "second"], [{"catalog_id": "c1"}, {"catalog_id": "c2"}], [1.5, 1.1]
+        )
+
+        self.vectorstore.embedding.embed_queries.assert_called_once_with(["first", "second"])
+        self.vectorstore.client.search.assert_not_called()
+        searches = self.vectorstore.client.msearch.call_args.kwargs["searches"]
+        self.assertEqual(searches[0], {"index": "index_test", "routing": "c1"})
+        self.assertEqual(searches[2], {"index": "index_test", "routing": "c2"})
+        self.assertEqual(searches[1]["_source"], ["metadata", "text"])
+        self.assertEqual(searches[1]["min_score"], 1.5)
+        self.assertEqual(
+            searches[3]["query"]["script_score"]["script"]["params"], {"query_vector": [0.8, 0.6]}
+        )
+        self.assertEqual(
+            [[doc.page_content for doc in docs] for docs in results], [["test doc"], ["far doc"]]
+        )
+
+    def test_search_batch_raises_failed_searches(self):
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_queries.return_value = [[0.6, 0.8]]
+        self.vectorstore.client.msearch.return_value = {
+            "responses": [{"error": {"type": "index_not_found_exception"}, "status": 404}]
+        }
+
+        with self.assertRaises(SearchException):
+            self.storage.search_batch(["first"], [None], [1.5])
+
+    def test_asearch(self):
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.aembed_query = AsyncMock(return_value=[0.1, 0.2])
+        self.vectorstore.client.search.return_value = {
+            "hits": {
+                "hits": [
+                    {"_score": 1.6, "_source": {"text": "test doc", "metadata": {"doc_generic_id": "abc123"}}},
+                    {"_score": 1.2, "_source": {"text": "far doc", "metadata": {"doc_generic_id": "abc123"}}},
+                ]
+            }
+        }
+
+        results = asyncio.run(
+            self.storage.asearch(search="test", filter={"doc_generic_id": "abc123"}, threshold=1.5)
+        )
+
+        self.vectorstore.embedding.aembed_query.assert_awaited_once_with("test")
+        query = self.vectorstore.client.search.call_args.kwargs["query"]["script_score"]
+        self.assertEqual(query["query"], {"match": {"metadata.doc_generic_id.keyword": "abc123"}})
+        self.assertEqual(query["script"]["params"]["query_vector"], [0.1, 0.2])
+        self.assertEqual([doc.page_content for doc in results], ["test doc"])
+
+    @patch("app.store.elasticsearch_vector_store.helpers.bulk")
+    def test_save_batch_normalized(self, mock_bulk):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, vector_index_mode=NORMALIZED)
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_documents.return_value = [np.array([0.6, 0.8], dtype=np.float32)]
+        self.vectorstore.client.info.return_value = {"version": {"number": "8.13.4"}}
+        self.vectorstore.client.indices.exists.return_value = False
+
+        ids = storage.save_batch(
+            [Document(page_content="first doc", metadata={"doc_generic_id": "abc123"})], ids=["789:998"]
+        )
+
+        self.vectorstore.add_texts.assert_not_called()
+        mappings = self.vectorstore.client.indices.create.call_args.kwargs["mappings"]
+        self.assertEqual(mappings["properties"]["vector"]["similarity"], "dot_product")
+        (request,) = mock_bulk.call_args.args[1]
+        self.assertEqual(ids, ["789:998"])
+        self.assertEqual(request["_id"], "789:998")
+        self.assertEqual(request["metadata"], {"doc_generic_id": "abc123"})
+        self.vectorstore.client.indices.refresh.assert_called_once_with(index="index_test")
+
+    def test_search_normalized_uses_dot_product(self):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, vector_index_mode=NORMALIZED)
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_query.return_value = [0.6, 0.8]
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        storage.search(search="test")
+
+        self.vectorstore.similarity_search_with_score.assert_not_called()
+        script = self.vectorstore.client.search.call_args.kwargs["query"]["script_score"]["script"]
+        self.assertTrue(script["source"].startswith("dotProduct"))
+
+    def test_search_by_vector_sends_threshold_as_min_score(self):
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        self.storage.search_by_vector([0.6, 0.8], threshold=1.5)
+
+        self.assertEqual(self.vectorstore.client.search.call_args.kwargs["min_score"], 1.5)
+
+    def test_search_knn(self):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, knn_num_candidates=100)
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_query.return_value = [0.6, 0.8]
+        self.vectorstore.client.search.return_value = {
+            "hits": {"hits": [{"_score": 0.8, "_source": {"text": "test doc", "metadata": {"catalog_id": "789"}}}]}
+        }
+
+        results = storage.search(search="test", filter={"catalog_id": "789"}, threshold=1.5)
+
+        self.vectorstore.similarity_search_with_score.assert_not_called()
+        kwargs = self.vectorstore.client.search.call_args.kwargs
+        self.assertEqual(
+            kwargs["knn"],
+            {
+                "field": "vector",
+                "query_vector": [0.6, 0.8],
+                "k": 15,
+                "num_candidates": 100,
+                "similarity": 0.5,
+                "filter": [{"term": {"metadata.catalog_id.keyword": "789"}}],
+            },
+        )
+        self.assertEqual(kwargs["source"], ["metadata", "text"])
+        self.assertEqual(results[0].metadata, {"catalog_id": "789"})
+
+    @patch("app.store.elasticsearch_vector_store.helpers.bulk")
+    def test_save_knn_creates_hnsw_index(self, mock_bulk):
+        storage = ElasticsearchVectorStoreIndex(
+            self.vectorstore, knn_num_candidates=100, hnsw_options={"m": 16, "ef_construction": 100}
+        )
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_documents.return_value = [[0.6, 0.8]]
+        self.vectorstore.client.info.return_value = {"version": {"number": "8.13.4"}}
+        self.vectorstore.client.indices.exists.return_value = False
+
+        storage.save(Document(page_content="first doc", metadata={"doc_generic_id": "abc123"}))
+
+        vector = self.vectorstore.client.indices.create.call_args.kwargs["mappings"]["properties"]["vector"]
+        self.assertEqual(vector["similarity"], "cosine")
+        self.assertEqual(vector["index_options"], {"type": "hnsw", "m": 16, "ef_construction": 100})
+
     def test_delete(self):
         self.vectorstore.delete.return_value = True
         result = self.storage.delete(ids=["9ff6c70f-1dc4-4d52-b918-8d0d55462a45"])
@@ -85,6 +274,73 @@ class ElasticsearchVectorStoreIndexTest(unittest.TestCase):
         )
         self.assertEqual(result, [])
 
+    def test_query_search_fetches_only_ids(self):
+        self.vectorstore.client.search.return_value = {}
+
+        result = self.storage.query_search({"metadata.catalog_id": "789", "metadata.product_retailer_id": ["pd123"]})
+
+        self.assertEqual(result, [])
+        kwargs = self.vectorstore.client.search.call_args.kwargs
+        self.assertEqual((kwargs["source"], kwargs["filter_path"]), (False, "hits.hits._id"))
+
+    @patch("app.store.elasticsearch_vector_store.helpers.bulk")
+    def test_routing_routes_writes_searches_and_deletes_by_catalog(self, mock_bulk):
+        storage = ElasticsearchVectorStoreIndex(self.vectorstore, routing=True)
+        self.vectorstore.embedding = Mock()
+        self.vectorstore.embedding.embed_documents.return_value = [[0.6, 0.8]]
+        self.vectorstore.embedding.embed_query.return_value = [0.6, 0.8]
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        storage.save_batch([Document(page_content="shirt", metadata={"catalog_id": 789})], ids=["789:998"])
+        storage.search(search="shirt", filter={"catalog_id": "789"})
+        storage.delete(ids=["789:998"], routing="789")
+
+        (request,) = mock_bulk.call_args_list[0].args[1]
+        self.assertEqual(request["_routing"], "789")
+        self.vectorstore.similarity_search_with_score.assert_not_called()
+        self.assertEqual(self.vectorstore.client.search.call_args.kwargs["routing"], "789")
+        (delete,) = mock_bulk.call_args_list[1].args[1]
+        self.assertEqual(
+            delete, {"_op_type": "delete", "_index": "index_test", "_id": "789:998", "_routing": "789"}
+        )
+        self.vectorstore.delete.assert_not_called()
+
+    def test_no_routing_by_default(self):
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        self.storage.search_by_vector([0.6, 0.8], filter={"catalog_id": "789"})
+        self.storage.delete(ids=["789:998"], routing="789")
+
+        self.assertNotIn("routing", self.vectorstore.client.search.call_args.kwargs)
+        self.vectorstore.delete.assert_called_once_with(["789:998"])
+
+    def test_query_search_caches_index_metadata(self):
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        self.storage.query_search({"doc_generic_id": "123", "metadata.sku": ["SKU-123"]})
+        self.storage.query_search({"doc_generic_id": "456", "metadata.sku": ["SKU-456"]})
+
+        self.vectorstore.client.indices.get.assert_called_once_with(index="index_test")
+        self.assertEqual(self.vectorstore.client.search.call_count, 2)
+
+    def test_query_search_invalidates_deleted_index(self):
+        self.vectorstore.client.search.side_effect = NotFoundError("index_not_found", Mock(), {})
+
+        self.assertEqual(self.storage.query_search({"doc_generic_id": "123", "metadata.sku": ["SKU-123"]}), [])
+
+        self.vectorstore.client.indices.get.side_effect = RuntimeError("Index Not Found")
+        self.assertEqual(self.storage.query_search({"doc_generic_id": "123", "metadata.sku": ["SKU-123"]}), [])
+        self.assertEqual(self.vectorstore.client.indices.get.call_count, 2)
+        self.vectorstore.client.search.assert_called_once()
+
+    def test_warm_index_cache(self):
+        self.storage.index_cache.warm(["index_test"])
+        self.vectorstore.client.search.return_value = {"hits": {"hits": []}}
+
+        self.storage.query_search({"doc_generic_id": "123", "metadata.sku": ["SKU-123"]})
+
+        self.vectorstore.client.indices.get.assert_called_once_with(index="index_test")
+
 
 class ContentBaseElasticsearchVectorStoreIndexTest(unittest.TestCase):
     def setUp(self):
@@ -102,22 +358,48 @@ class ContentBaseElasticsearchVectorStoreIndexTest(unittest.TestCase):
             }
         )
 
-    def test_save(self):
-        self.vectorstore.from_documents.return_value = [
-            "f40a4707-549e-4847-8f48-19b1987b8149"
-        ]
-        doc = Document(
-            page_content="test doc",
-            metadata={
-                "full_page": "test document index",
-                "content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"
-            }
-        )
-        result = self.storage.save(doc)
-        self.vectorstore.from_documents(
-            [self.doc], self.vectorstore.embeddings, self.vectorstore.index_name
+    @patch("app.store.bulk.helpers.parallel_bulk")
+    def test_save(self, mock_parallel_bulk):
+        vectorstore = Mock(spec=ElasticsearchStore)
+        vectorstore.index_name = "index_test"
+        vectorstore.client = Mock()
+        vectorstore.embeddings = Mock()
+        vectorstore.embeddings.embed_documents.side_effect = lambda texts: [[0.6, 0.8] for _ in texts]
+        storage = ContentBaseElasticsearchVectorStoreIndex(vectorstore, bulk_options={"chunk_size": 2})
+        docs = [Document(page_content=f"doc {i}", metadata=self.doc.metadata) for i in range(3)]
+
+        def parallel_bulk(client, actions, **kwargs):
+            return [(True, {"index": {"_id": action["_id"]}}) for action in actions]
+
+        mock_parallel_bulk.side_effect = parallel_bulk
+
+        result = storage.save(docs)
+
+        self.assertIs(mock_parallel_bulk.call_args.args[0], vectorstore.client)
+        self.assertEqual(mock_parallel_bulk.call_args.kwargs["chunk_size"], 2)
+        self.assertFalse(mock_parallel_bulk.call_args.kwargs["raise_on_error"])
+        self.assertEqual(len(result), 3)
+        self.assertEqual(
+            [call.args[0] for call in vectorstore.embeddings.embed_documents.call_args_list],
+            [["doc 0", "doc 1"], ["doc 2"]],
         )
-        self.assertEqual(result, ["f40a4707-549e-4847-8f48-19b1987b8149"])
+        vectorstore._create_index_if_not_exists.assert_called_once_with("index_test", 2)
+        vectorstore.client.indices.refresh.assert_called_once_with(index="index_test")
+        vectorstore.from_documents.assert_not_called()
+
+    @patch("app.store.bulk.helpers.parallel_bulk")
+    def test_save_reports_failed_items(self, mock_parallel_bulk):
+        mock_parallel_bulk.return_value = [
+            (True, {"index": {"_id": "1"}}),
+            (False, {"index": {"_id": "2", "status": 400, "error": {"type": "mapper_parsing_exception"}}}),
+        ]
+        self.vectorstore.embeddings.embed_documents.return_value = [[0.6, 0.8]]
+
+        with self.assertRaises(BulkIndexingException) as context:
+            self.storage.save([self.doc])
+
+        self.assertEqual(context.exception.errors[0]["index"]["_id"], "2")
+        self.assertEqual(self.storage.bulk_ingester.stats(), {"indexed": 1, "failed": 1})
 
     def test_delete(self):
         self.vectorstore.delete.return_value = True
@@ -141,6 +423,313 @@ class ContentBaseElasticsearchVectorStoreIndexTest(unittest.TestCase):
         self.assertEqual(1, len(results))
         self.assertEqual(results[0].page_content, "test doc")
 
+    def test_asearch(self):
+        vectorstore = Mock(spec=ElasticsearchStore)
+        vectorstore.embedding = Mock()
+        vectorstore.embedding.aembed_query = AsyncMock(return_value=[0.1, 0.2])
+        vectorstore.similarity_search_by_vector_with_relevance_scores.return_value = [
+            (self.doc, 1.6)
+        ]
+        storage = ContentBaseElasticsearchVectorStoreIndex(vectorstore)
+        query_filter = {"content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"}
+
+        results = asyncio.run(storage.asearch(search="test", filter=query_filter, threshold=1.5))
+
+        vectorstore.similarity_search_by_vector_with_relevance_scores.assert_called_once_with(
+            embedding=[0.1, 0.2], k=5, filter={"bool": {"filter": [{"term": {"metadata.content_base_uuid.keyword": "dfff32e7-dce6-40f7-a86e-8f9618887977"}}]}}
+        )
+        self.assertEqual(results, [self.doc])
+
+    def test_delete_by_query(self):
+        self.vectorstore.client.delete_by_query.return_value = {"deleted": 3}
+
+        result = self.storage.delete_by_query(
+            {"metadata.content_base_uuid": "cb1", "metadata.file_uuid": "f1"}
+        )
+
+        self.assertEqual(result, {"deleted": 3})
+        self.vectorstore.client.delete_by_query.assert_called_once_with(
+            index="index_test",
+            query={
+                "bool": {
+                    "filter": [
+                        {"term": {"metadata.content_base_uuid.keyword": "cb1"}},
+                        {"term": {"metadata.file_uuid.keyword": "f1"}},
+                    ]
+                }
+            },
+            slices="auto",
+            conflicts="proceed",
+            refresh=True,
+            wait_for_completion=True,
+        )
+
+    def test_delete_by_query_missing_index(self):
+        self.vectorstore.client.delete_by_query.side_effect = NotFoundError("index_not_found", Mock(), {})
+        self.assertEqual(self.storage.delete_by_query({"metadata.file_uuid": "f1"}), {"deleted": 0})
+
+    def test_delete_content_base_runs_in_background(self):
+        self.vectorstore.client.delete_by_query.side_effect = [
+            {"task": "node:1"}, NotFoundError("index_not_found", Mock(), {}), {"task": "node:3"}
+        ]
+
+        result = self.storage.delete_content_base("cb1")
+
+        self.assertEqual(result, {"task": "node:1,node:3"})
+        calls = self.vectorstore.client.delete_by_query.call_args_list
+        self.assertEqual(
+            [(call.kwargs["index"], call.kwargs["wait_for_completion"]) for call in calls],
+            [("content_base_documents", False), ("content_base_pages", False), ("index_test", False)],
+        )
+
+    def test_get_task_sums_the_tasks_of_a_delete(self):
+        self.vectorstore.client.tasks.get.side_effect = [
+            {"completed": True, "response": {"deleted": 2, "total": 2}},
+            {"completed": False, "task": {"status": {"deleted": 10, "total": 25}}},
+        ]
+
+        task = self.storage.get_task("node:1,node:3")
+
+        self.assertEqual(task, {"completed": False, "response": {"deleted": 12, "total": 27}})
+        self.assertEqual(
+            [call.kwargs["task_id"] for call in self.vectorstore.client.tasks.get.call_args_list],
+            ["node:1", "node:3"],
+        )
+
+    def test_get_task_not_found(self):
+        self.vectorstore.client.tasks.get.side_effect = NotFoundError("resource_not_found", Mock(), {})
+
+        with self.assertRaises(TaskNotFoundException):
+            self.storage.get_task("node:1")
+
+    @patch("app.store.bulk.helpers.parallel_bulk")
+    def test_save_pages(self, mock_parallel_bulk):
+        mock_parallel_bulk.side_effect = lambda client, actions, **kwargs: [
+            (True, {"index": {"_id": action["_id"]}}) for action in actions
+        ]
+        self.vectorstore.client.indices.get.side_effect = NotFoundError("index_not_found", Mock(), {})
+        page = Document(page_content="test document index", metadata={"content_base_uuid": "cb1", "file_uuid": "f1"})
+
+        ids = self.storage.save_pages([page], ["f1:0"])
+
+        self.assertEqual(ids, ["f1:0"])
+        self.assertEqual(self.vectorstore.client.indices.create.call_args.kwargs["index"], "content_base_pages")
+        (action,) = list(mock_parallel_bulk.call_args.args[1])
+        self.assertEqual(action["content"], "test document index")
+        self.assertEqual(action["_index"], "content_base_pages")
+
+    def test_get_pages_in_one_mget(self):
+        self.vectorstore.client.mget.return_value = {
+            "docs": [
+                {"_id": "f1:0", "found": True, "_source": {"content": "first page"}},
+                {"_id": "f1:1", "found": False},
+            ]
+        }
+
+        pages = self.storage.get_pages(["f1:0", "f1:1"], "cb1")
+
+        self.assertEqual(pages, {"f1:0": "first page"})
+        self.vectorstore.client.mget.assert_called_once_with(
+            index="content_base_pages", docs=[{"_id": "f1:0"}, {"_id": "f1:1"}], source=["content"]
+        )
+
+    def _preview_storage(self):
+        storage = ContentBaseElasticsearchVectorStoreIndex(self.vectorstore, preview_segment_size=4)
+        documents = {}
+
+        def ingest(actions):
+            for action in actions:
+                documents[action["_id"]] = {
+                    key: value for key, value in action.items() if not key.startswith("_")
+                }
+            return list(documents)
+
+        def mget(index, ids, source):
+            return {
+                "docs": [
+                    {"_id": doc_id, "found": doc_id in documents, "_source": documents.get(doc_id)}
+                    for doc_id in ids
+                ]
+            }
+
+        storage._bulk_ingester = Mock()
+        storage._bulk_ingester.ingest.side_effect = ingest
+        self.vectorstore.client.mget.side_effect = mget
+        return storage, documents
+
+    def test_save_doc_content_upserts_compressed_segments(self):
+        storage, documents = self._preview_storage()
+
+        storage.save_doc_content("first version", "cb1", "file.pdf", "f1")
+        storage.save_doc_content("second", "cb1", "file.pdf", "f1")
+
+        header = documents["cb1:f1"]
+        self.assertEqual((header["length"], header["segments"]), (6, 2))
+        self.assertNotIn("content", documents["cb1:f1:0"])
+        query = self.vectorstore.client.delete_by_query.call_args.kwargs["query"]
+        self.assertEqual(
+            query["bool"]["must_not"], [{"ids": {"values": ["cb1:f1", "cb1:f1:0", "cb1:f1:1"]}}]
+        )
+        self.assertEqual(
+            storage.search_doc_content("f1", "cb1"), {"content": "second", "total_length": 6}
+        )
+
+    def test_search_doc_content_reads_a_slice(self):
+        storage, documents = self._preview_storage()
+        storage.save_doc_content("abcdefghijklmnopqrstuvwxyz", "cb1", "file.pdf", "f1")
+        self.vectorstore.client.mget.reset_mock()
+
+        result = storage.search_doc_content("f1", "cb1", offset=6, length=5)
+
+        self.assertEqual(result, {"content": "ghijk", "total_length": 26})
+        self.vectorstore.client.mget.assert_called_once_with(
+            index="content_base_documents",
+            ids=["cb1:f1", "cb1:f1:1", "cb1:f1:2"],
+            source=["length", "segment_size", "segment", "data"],
+        )
+
+    def test_iter_doc_content_streams_segments(self):
+        storage, documents = self._preview_storage()
+        storage.save_doc_content("abcdefghijklmnopqrstuvwxyz", "cb1", "file.pdf", "f1")
+        self.vectorstore.client.mget.reset_mock()
+
+        chunks = list(storage.iter_doc_content("f1", "cb1", offset=6, length=15))
+
+        self.assertEqual(
+            [(chunk["offset"], chunk["content"]) for chunk in chunks],
+            [(6, "gh"), (8, "ijkl"), (12, "mnop"), (16, "qrst"), (20, "u")],
+        )
+        self.assertEqual({chunk["total_length"] for chunk in chunks}, {26})
+        # the header, then the segments 1 to 5 in reads of at most four
+        self.assertEqual(self.vectorstore.client.mget.call_count, 3)
+
+    @patch("app.store.elasticsearch_vector_store.sentry_sdk")
+    def test_missing_preview_segment_is_reported(self, mock_sentry):
+        storage, documents = self._preview_storage()
+        storage.save_doc_content("abcdefghijklmnopqrstuvwxyz", "cb1", "file.pdf", "f1")
+        del documents["cb1:f1:3"]
+
+        result = storage.search_doc_content("f1", "cb1", offset=6, length=10)
+        chunks = list(storage.iter_doc_content("f1", "cb1", offset=6, length=10))
+
+        self.assertEqual(result, {"content": "", "total_length": 0})
+        self.assertEqual(
+            [chunk.get("content") for chunk in chunks[:-1]], ["gh", "ijkl"]
+        )
+        self.assertEqual(chunks[-1], {"error": "Segment 3 of the preview of f1 was not found"})
+        self.assertEqual(mock_sentry.capture_message.call_count, 2)
+        mock_sentry.capture_message.assert_called_with(
+            "Segment 3 of the preview of f1 was not found"
+        )
+
+    @patch("app.store.elasticsearch_vector_store.sentry_sdk")
+    def test_iter_doc_content_failing_partway_ends_with_error(self, mock_sentry):
+        storage, documents = self._preview_storage()
+        storage.save_doc_content("abcdefghijklmnopqrstuvwxyz", "cb1", "file.pdf", "f1")
+        mget = self.vectorstore.client.mget.side_effect
+
+        def failing_mget(index, ids, source):
+            if "cb1:f1:5" in ids:
+                raise ConnectionError("connection reset")
+            return mget(index, ids, source)
+
+        self.vectorstore.client.mget.side_effect = failing_mget
+
+        chunks = list(storage.iter_doc_content("f1", "cb1", offset=6, length=15))
+
+        self.assertEqual(
+            [chunk.get("content") for chunk in chunks[:-1]], ["gh", "ijkl", "mnop", "qrst"]
+        )
+        self.assertEqual(chunks[-1], {"error": "connection reset"})
+        mock_sentry.capture_message.assert_called_once_with("connection reset")
+
+    def test_iter_doc_content_legacy_document(self):
+        storage = ContentBaseElasticsearchVectorStoreIndex(self.vectorstore, preview_segment_size=4)
+        self.vectorstore.client.mget.return_value = {"docs": [{"_id": "cb1:f1", "found": False}]}
+        self.vectorstore.client.search.return_value = {
+            "hits": {"hits": [{"_source": {"content": "legacy document"}}]}
+        }
+
+        chunks = list(storage.iter_doc_content("f1", "cb1", offset=7))
+
+        self.assertEqual(
+            [(chunk["offset"], chunk["content"]) for chunk in chunks],
+            [(7, "docu"), (11, "ment")],
+        )
+
+    def test_search_doc_content_legacy_document(self):
+        self.vectorstore.client.mget.return_value = {"docs": [{"_id": "cb1:f1", "found": False}]}
+        self.vectorstore.client.search.return_value = {
+            "hits": {"hits": [{"_source": {"content": "legacy document"}}]}
+        }
+
+        result = self.storage.search_doc_content("f1", "cb1", offset=7)
+
+        self.assertEqual(result, {"content": "document", "total_length": 15})
+
+    def _knn_storage(self, doc_count):
+        vectorstore = Mock(spec=ElasticsearchStore)
+        vectorstore.index_name = "index_test"
+        vectorstore.vector_query_field = "vector"
+        vectorstore.query_field = "text"
+        vectorstore.client = Mock()
+        vectorstore.client.count.return_value = {"count": doc_count}
+        vectorstore.client.search.return_value = {
+            "hits": {
+                "hits": [
+                    {"_score": 0.9, "_source": {"text": "test doc", "metadata": self.doc.metadata}},
+                    {"_score": 0.7, "_source": {"text": "far doc", "metadata": self.doc.metadata}},
+                ]
+            }
+        }
+        vectorstore.similarity_search_by_vector_with_relevance_scores.return_value = []
+        storage = ContentBaseElasticsearchVectorStoreIndex(
+            vectorstore, knn_num_candidates=50, exact_search_max_docs=100
+        )
+        return storage, vectorstore
+
+    def test_search_by_vector_uses_knn_for_big_content_bases(self):
+        storage, vectorstore = self._knn_storage(doc_count=1000)
+        query_filter = {"content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"}
+
+        results = storage.search_by_vector([0.6, 0.8], filter=query_filter, threshold=1.5)
+
+        knn = vectorstore.client.search.call_args.kwargs["knn"]
+        self.assertEqual(knn["filter"], [{"term": {"metadata.content_base_uuid.keyword": "dfff32e7-dce6-40f7-a86e-8f9618887977"}}])
+        self.assertEqual((knn["k"], knn["num_candidates"], knn["similarity"]), (5, 50, 0.5))
+        self.assertEqual([doc.page_content for doc in results], ["test doc"])
+        vectorstore.similarity_search_by_vector_with_relevance_scores.assert_not_called()
+
+    def test_routing_searches_and_deletes_one_content_base_shard(self):
+        storage, vectorstore = self._knn_storage(doc_count=10)
+        storage.routing = True
+        vectorstore.client.delete_by_query.return_value = {"deleted": 1}
+        query_filter = {"content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"}
+
+        storage.search_by_vector([0.6, 0.8], filter=query_filter, threshold=1.5)
+        storage.delete_by_query({"metadata.content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"})
+
+        vectorstore.similarity_search_by_vector_with_relevance_scores.assert_not_called()
+        self.assertEqual(vectorstore.client.count.call_args.kwargs["routing"], "dfff32e7-dce6-40f7-a86e-8f9618887977")
+        search = vectorstore.client.search.call_args.kwargs
+        self.assertEqual(search["routing"], "dfff32e7-dce6-40f7-a86e-8f9618887977")
+        self.assertIn("script_score", search["query"])
+        self.assertEqual(
+            vectorstore.client.delete_by_query.call_args.kwargs["routing"],
+            "dfff32e7-dce6-40f7-a86e-8f9618887977",
+        )
+
+    def test_search_by_vector_keeps_exact_search_for_small_content_bases(self):
+        storage, vectorstore = self._knn_storage(doc_count=10)
+        query_filter = {"content_base_uuid": "dfff32e7-dce6-40f7-a86e-8f9618887977"}
+
+        storage.search_by_vector([0.6, 0.8], filter=query_filter)
+        storage.search_by_vector([0.6, 0.8], filter=query_filter)
+
+        vectorstore.client.search.assert_not_called()
+        self.assertEqual(vectorstore.similarity_search_by_vector_with_relevance_scores.call_count, 2)
+        vectorstore.client.count.assert_called_once()
+
     def test_query_search(self):
         self.vectorstore.client.indices.get.return_value = True
         mock_search_hits = [{"_id": "53899082-cf01-41d1-ba9b-320a90670755"}]
@@ -0,0 +1,478 @@
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from app.embedders.batching import AdaptiveBatchSizer, BatchedEmbeddings, batch_texts
+from app.embedders.coalescer import QueryCoalescer
+from app.embedders.embedders import (
+    DeterministicFakeEmbeddings,
+    SagemakerEndpointEmbeddingsKeys,
+)
+from app.embedders.normalized import NormalizedEmbeddings
+from app.embedders.exceptions import (
+    CircuitOpenException,
+    EmbeddingEndpointException,
+    InvalidEmbeddingRequestException,
+)
+from app.embedders.resilience import CircuitBreaker, RetryPolicy, is_retryable_error
+from app.util import ContentHandler, decode_vectors
+
+
+def endpoint_response(vectors):
+    return {"Body": io.BytesIO(json.dumps({"vectors": vectors}).encode("utf-8"))}
+
+
+def as_lists(vectors):
+    return [np.asarray(vector).tolist() for vector in vectors]
+
+
+def client_error(code, status):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "InvokeEndpoint",
+    )
+
+
+def echo_endpoint(**kwargs):
+    """Returns one vector per input holding the input's numeric value."""
+    inputs = json.loads(kwargs["Body"])["inputs"]
+    return endpoint_response([[float(text), 1.0] for text in inputs])
+
+
+class TestSagemakerEndpointEmbeddingsKeys(unittest.TestCase):
+    def _embeddings(self, **kwargs):
+        embeddings = SagemakerEndpointEmbeddingsKeys(
+            endpoint_name="test-endpoint",
+            region_name="us-east-1",
+            content_handler=ContentHandler(),
+            circuit_breaker=kwargs.pop("circuit_breaker", CircuitBreaker()),
+            **kwargs,
+        )
+        embeddings.client = Mock()
+        embeddings.client.invoke_endpoint.side_effect = echo_endpoint
+        embeddings.query_client = embeddings.client
+        return embeddings
+
+    def test_clients_time_out_within_the_retry_deadline(self):
+        embeddings = SagemakerEndpointEmbeddingsKeys(
+            endpoint_name="test-endpoint",
+            region_name="us-east-1",
+            content_handler=ContentHandler(),
+            circuit_breaker=CircuitBreaker(),
+            connect_timeout=2.0,
+            query_retry_policy=RetryPolicy(max_attempts=2, deadline=1.5),
+        )
+
+        config = embeddings.client.meta.config
+        query_config = embeddings.query_client.meta.config
+        self.assertEqual((config.connect_timeout, config.read_timeout), (2.0, 60.0))
+        self.assertEqual((query_config.connect_timeout, query_config.read_timeout), (1.5, 1.5))
+
+    def test_embed_documents(self):
+        embeddings = self._embeddings()
+        texts = [str(i) for i in range(5)]
+
+        result = embeddings.embed_documents(texts, chunk_size=2)
+
+        self.assertEqual(as_lists(result), [[float(i), 1.0] for i in range(5)])
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 3)
+
+    def test_embed_documents_sends_repeated_texts_once(self):
+        embeddings = self._embeddings()
+
+        result = embeddings.embed_documents(["1", "2", "1", "1\n", "2"])
+
+        self.assertEqual(as_lists(result), [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+        sent = json.loads(embeddings.client.invoke_endpoint.call_args.kwargs["Body"])["inputs"]
+        self.assertEqual(sent, ["1", "2", "1 "])
+        self.assertEqual(embeddings.stats()["duplicates_skipped"], 2)
+
+    def test_embed_queries_in_batches(self):
+        embeddings = self._embeddings(batch_size=2)
+
+        result = embeddings.embed_queries(["1", "2", "1", "3"])
+
+        self.assertEqual(as_lists(result), [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [3.0, 1.0]])
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 2)
+
+    def test_embed_documents_empty(self):
+        embeddings = self._embeddings()
+        self.assertEqual(embeddings.embed_documents([]), [])
+        embeddings.client.invoke_endpoint.assert_not_called()
+
+    def test_embed_documents_concurrently_keeps_order(self):
+        embeddings = self._embeddings(max_concurrency=3)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_endpoint(**kwargs):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+            return echo_endpoint(**kwargs)
+
+        embeddings.client.invoke_endpoint.side_effect = slow_endpoint
+        texts = [str(i) for i in range(20)]
+
+        result = embeddings.embed_documents(texts, chunk_size=2)
+
+        self.assertEqual(as_lists(result), [[float(i), 1.0] for i in range(20)])
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 10)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_embed_documents_respects_byte_budget(self):
+        embeddings = self._embeddings(max_batch_bytes=4)
+        texts = ["10", "11", "12", "12345"]
+
+        result = embeddings.embed_documents(texts)
+
+        self.assertEqual(as_lists(result), [[float(text), 1.0] for text in texts])
+        sent = [
+            json.loads(call.kwargs["Body"])["inputs"]
+            for call in embeddings.client.invoke_endpoint.call_args_list
+        ]
+        self.assertEqual(sent, [["10", "11"], ["12"], ["12345"]])
+
+    def test_embed_documents_uses_adaptive_batch_size(self):
+        sizer = AdaptiveBatchSizer(initial_size=2, max_size=4, step=2)
+        embeddings = self._embeddings(batch_sizer=sizer)
+
+        embeddings.embed_documents([str(i) for i in range(4)])
+
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 2)
+        self.assertEqual(sizer.size, 4)
+
+    def test_concurrent_queries_share_one_request(self):
+        embeddings = self._embeddings(query_batch_window=0.05)
+        results = {}
+
+        def search(i):
+            results[i] = embeddings.embed_query(str(i))
+
+        threads = [threading.Thread(target=search, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            {i: vector.tolist() for i, vector in results.items()},
+            {i: [float(i), 1.0] for i in range(5)},
+        )
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 1)
+        self.assertEqual(embeddings.stats()["query_batching"]["batches"], 1)
+
+    def test_aembed_query(self):
+        embeddings = self._embeddings()
+
+        async def search():
+            return await asyncio.gather(*(embeddings.aembed_query(str(i)) for i in range(3)))
+
+        self.assertEqual(as_lists(asyncio.run(search())), [[float(i), 1.0] for i in range(3)])
+        self.assertEqual(as_lists(asyncio.run(embeddings.aembed_documents(["4", "5"]))), [[4.0, 1.0], [5.0, 1.0]])
+
+    def test_aembed_query_is_coalesced(self):
+        embeddings = self._embeddings(query_batch_window=0.05)
+
+        async def search():
+            return await asyncio.gather(*(embeddings.aembed_query(str(i)) for i in range(5)))
+
+        result = asyncio.run(search())
+
+        self.assertEqual(as_lists(result), [[float(i), 1.0] for i in range(5)])
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 1)
+
+    @patch("app.embedders.embedders.time.sleep")
+    def test_retries_throttling_with_backoff(self, mock_sleep):
+        embeddings = self._embeddings()
+        embeddings.client.invoke_endpoint.side_effect = [
+            client_error("ThrottlingException", 400),
+            client_error("InternalFailure", 500),
+            endpoint_response([[1.0, 1.0]]),
+        ]
+
+        result = embeddings.embed_documents(["1"])
+
+        self.assertEqual(as_lists(result), [[1.0, 1.0]])
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(embeddings.stats()["retries"], 2)
+        self.assertEqual(embeddings.circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    @patch("app.embedders.embedders.time.sleep")
+    def test_permanent_error_is_not_retried(self, mock_sleep):
+        embeddings = self._embeddings()
+        embeddings.client.invoke_endpoint.side_effect = client_error(
+            "ValidationError", 400
+        )
+
+        with self.assertRaises(InvalidEmbeddingRequestException):
+            embeddings.embed_documents(["1"])
+
+        mock_sleep.assert_not_called()
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 1)
+
+    @patch("app.embedders.embedders.time.sleep")
+    def test_gives_up_after_max_attempts(self, mock_sleep):
+        embeddings = self._embeddings(
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01)
+        )
+        embeddings.client.invoke_endpoint.side_effect = client_error(
+            "ServiceUnavailable", 503
+        )
+
+        with self.assertRaises(EmbeddingEndpointException):
+            embeddings.embed_documents(["1"])
+
+        self.assertEqual(embeddings.client.invoke_endpoint.call_count, 3)
+        self.assertEqual(embeddings.stats()["failures"], 1)
+
+    def test_query_fails_fast_when_circuit_is_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        embeddings = self._embeddings(circuit_breaker=breaker)
+
+        with self.assertRaises(CircuitOpenException):
+            embeddings.embed_query("1")
+
+        embeddings.client.invoke_endpoint.assert_not_called()
+        self.assertEqual(embeddings.stats()["rejected"], 1)
+
+    def test_waits_for_the_probe_of_a_half_open_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01, probe_interval=0.005)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow_request())
+        embeddings = self._embeddings(circuit_breaker=breaker)
+
+        with patch("app.embedders.embedders.time.sleep") as mock_sleep:
+            mock_sleep.side_effect = lambda seconds: breaker.record_success()
+            result = embeddings.embed_documents(["1"])
+
+        self.assertEqual(as_lists(result), [[1.0, 1.0]])
+        mock_sleep.assert_called_once_with(0.005)
+
+    def test_invalid_request_does_not_close_a_half_open_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        embeddings = self._embeddings(circuit_breaker=breaker)
+        embeddings.client.invoke_endpoint.side_effect = client_error(
+            "ValidationError", 400
+        )
+
+        with self.assertRaises(EmbeddingEndpointException):
+            embeddings.embed_documents(["1"])
+
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+
+
+class TestDeterministicFakeEmbeddings(unittest.TestCase):
+    def test_vectors_are_deterministic_unit_vectors(self):
+        embeddings = DeterministicFakeEmbeddings(dimensions=16)
+
+        first, second = embeddings.embed_documents(["a", "b"])
+
+        np.testing.assert_array_equal(first, DeterministicFakeEmbeddings(16).embed_query("a"))
+        self.assertEqual(first.shape, (16,))
+        self.assertAlmostEqual(float(np.linalg.norm(first)), 1.0, places=5)
+        self.assertFalse(np.array_equal(first, second))
+
+    def test_aembed_query_matches_embed_query(self):
+        embeddings = DeterministicFakeEmbeddings(dimensions=8, latency=0.001)
+        np.testing.assert_array_equal(asyncio.run(embeddings.aembed_query("a")), embeddings.embed_query("a"))
+
+    @patch("app.embedders.embedders.time.sleep")
+    def test_latency(self, mock_sleep):
+        DeterministicFakeEmbeddings(dimensions=4, latency=0.2).embed_documents(["a", "b"])
+        mock_sleep.assert_called_once_with(0.2)
+
+
+class TestNormalizedEmbeddings(unittest.TestCase):
+    def test_returns_unit_vectors(self):
+        inner = Mock()
+        inner.embed_documents.return_value = [[3.0, 4.0], [0.0, 0.0]]
+        inner.embed_query.return_value = [0.0, 2.0]
+        embeddings = NormalizedEmbeddings(inner)
+
+        np.testing.assert_allclose(embeddings.embed_documents(["a", "b"]), [[0.6, 0.8], [0.0, 0.0]], rtol=1e-6)
+        self.assertEqual(embeddings.embed_query("a").tolist(), [0.0, 1.0])
+        inner.embed_documents.return_value = []
+        self.assertEqual(embeddings.embed_documents([]), [])
+
+
+class TestContentHandler(unittest.TestCase):
+    def test_transform_output_json(self):
+        vectors = ContentHandler().transform_output(
+            endpoint_response([[0.5, 1.0], [2.0, 3.0]])["Body"]
+        )
+        self.assertEqual(vectors.dtype, np.float32)
+        self.assertEqual(vectors.tolist(), [[0.5, 1.0], [2.0, 3.0]])
+
+    def test_decode_base64_vectors(self):
+        matrix = np.array([[0.5, 1.0, 1.5], [2.0, 3.0, 4.0]], dtype="<f4")
+        response = {
+            "vectors": base64.b64encode(matrix.tobytes()).decode("ascii"),
+            "shape": [2, 3],
+        }
+        np.testing.assert_array_equal(decode_vectors(response), matrix)
+
+    def test_transform_input_asks_for_vector_format(self):
+        body = ContentHandler(vector_format="base64").transform_input(["a"], {})
+        self.assertEqual(
+            json.loads(body), {"inputs": ["a"], "vector_format": "base64"}
+        )
+        self.assertEqual(json.loads(ContentHandler().transform_input(["a"], {})), {"inputs": ["a"]})
+
+
+class TestBatching(unittest.TestCase):
+    def test_batch_texts_by_count(self):
+        self.assertEqual(
+            batch_texts(["a", "b", "c"], max_count=2), [["a", "b"], ["c"]]
+        )
+
+    def test_adaptive_batch_sizer(self):
+        sizer = AdaptiveBatchSizer(
+            initial_size=8, min_size=2, max_size=12, target_latency=1.0, step=4
+        )
+        sizer.observe(8, 0.5)
+        self.assertEqual(sizer.size, 12)
+        sizer.observe(12, 0.5)
+        self.assertEqual(sizer.size, 12)
+        sizer.observe(3, 2.0)
+        self.assertEqual(sizer.size, 6)
+        sizer.observe(6, 2.0)
+        sizer.observe(3, 2.0)
+        self.assertEqual(sizer.size, 2)
+
+    def test_batched_embeddings(self):
+        inner = Mock()
+        inner.embed_documents.side_effect = lambda texts: [[1.0] for _ in texts]
+        batched = BatchedEmbeddings(inner, batch_size=2)
+
+        result = batched.embed_documents(["a", "b", "c"])
+
+        self.assertEqual(result, [[1.0], [1.0], [1.0]])
+        self.assertEqual(inner.embed_documents.call_count, 2)
+
+    def test_batched_embeddings_embed_queries(self):
+        inner = Mock()
+        inner.embed_queries.side_effect = lambda texts: [[float(len(t))] for t in texts]
+        batched = BatchedEmbeddings(inner, batch_size=2)
+
+        result = batched.embed_queries(["a", "bb", "a", "ccc"])
+
+        self.assertEqual(result, [[1.0], [2.0], [1.0], [3.0]])
+        self.assertEqual(inner.embed_queries.call_count, 2)
+
+    def test_batched_embeddings_skips_duplicates(self):
+        inner = Mock()
+        inner.embed_documents.side_effect = lambda texts: [[float(len(t))] for t in texts]
+        batched = BatchedEmbeddings(inner)
+
+        result = batched.embed_documents(["a", "bb", "a"])
+
+        self.assertEqual(result, [[1.0], [2.0], [1.0]])
+        inner.embed_documents.assert_called_once_with(["a", "bb"])
+        self.assertEqual(batched.stats(), {"duplicates_skipped": 1})
+
+
+class TestQueryCoalescer(unittest.TestCase):
+    def test_dispatches_when_batch_is_full(self):
+        batch_func = Mock(side_effect=lambda texts: [[float(t)] for t in texts])
+        coalescer = QueryCoalescer(batch_func, window=10, max_batch_size=2)
+
+        futures = [coalescer.submit("1"), coalescer.submit("2")]
+
+        self.assertEqual([f.result(timeout=1) for f in futures], [[1.0], [2.0]])
+        batch_func.assert_called_once_with(["1", "2"])
+
+    def test_invalid_text_fails_only_its_caller(self):
+        def batch_func(texts):
+            if "bad" in texts:
+                raise InvalidEmbeddingRequestException("input is too long")
+            return [[float(t)] for t in texts]
+
+        batch_func = Mock(side_effect=batch_func)
+        coalescer = QueryCoalescer(batch_func, window=10, max_batch_size=4)
+
+        futures = [coalescer.submit(text) for text in ["1", "2", "bad", "4"]]
+
+        self.assertEqual([futures[i].result(timeout=1) for i in (0, 1, 3)], [[1.0], [2.0], [4.0]])
+        with self.assertRaises(InvalidEmbeddingRequestException):
+            futures[2].result(timeout=1)
+        self.assertEqual(
+            [call.args[0] for call in batch_func.call_args_list],
+            [["1", "2", "bad", "4"], ["1", "2"], ["bad", "4"], ["bad"], ["4"]],
+        )
+        self.assertEqual(coalescer.stats()["splits"], 2)
+
+    def test_missing_vectors_fail_every_caller(self):
+        coalescer = QueryCoalescer(Mock(return_value=[[1.0]]), window=10, max_batch_size=2)
+
+        futures = [coalescer.submit("1"), coalescer.submit("2")]
+
+        for future in futures:
+            with self.assertRaises(EmbeddingEndpointException):
+                future.result(timeout=1)
+
+    def test_errors_reach_every_caller(self):
+        coalescer = QueryCoalescer(Mock(side_effect=RuntimeError("down")), window=0.01)
+
+        future = coalescer.submit("1")
+
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_threshold_and_probes_after_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.01)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()["times_opened"], 1)
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_retry_after_while_probing(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01, probe_interval=0.5)
+        breaker.record_failure()
+        self.assertGreater(breaker.retry_after(), 0.0)
+
+        time.sleep(0.02)
+        self.assertEqual(breaker.retry_after(), 0.0)
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.retry_after(), 0.01)
+
+    def test_is_retryable_error(self):
+        self.assertTrue(is_retryable_error(client_error("ThrottlingException", 400)))
+        self.assertTrue(is_retryable_error(client_error("ModelError", 503)))
+        self.assertFalse(is_retryable_error(client_error("ValidationError", 400)))
+        self.assertFalse(is_retryable_error(ValueError("bad json")))
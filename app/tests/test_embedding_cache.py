@@ -0,0 +1,112 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from langchain.embeddings.base import Embeddings
+
+from app.cache import LRUCache, RedisCache
+from app.embedders.cache import (
+    CachedEmbeddings,
+    embedding_cache_key,
+    encode_vector,
+)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expires_entries(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+class TestCachedEmbeddings(unittest.TestCase):
+    def setUp(self):
+        self.embeddings = Mock(spec=Embeddings)
+        self.embeddings.embed_documents.side_effect = lambda texts: [
+            [float(len(text)), 1.0] for text in texts
+        ]
+        self.embeddings.embed_query.side_effect = lambda text: [float(len(text)), 2.0]
+        self.cached = CachedEmbeddings(
+            self.embeddings, namespace="test", local=LRUCache(max_size=100)
+        )
+
+    def test_embed_documents_calls_only_for_missing_texts(self):
+        self.cached.embed_documents(["one", "three"])
+        result = self.cached.embed_documents(["three", "four", "four"])
+
+        self.assertEqual(result, [[5.0, 1.0], [4.0, 1.0], [4.0, 1.0]])
+        self.embeddings.embed_documents.assert_called_with(["four"])
+        self.assertEqual(self.cached.hits, 1)
+        self.assertEqual(self.cached.misses, 4)
+
+    def test_embed_queries_shares_query_cache(self):
+        self.cached.embed_query("hello")
+
+        result = self.cached.embed_queries(["hello", "hi", "hi"])
+
+        self.assertEqual(result, [[5.0, 2.0], [2.0, 2.0], [2.0, 2.0]])
+        self.assertEqual(self.embeddings.embed_query.call_count, 2)
+        self.embeddings.embed_documents.assert_not_called()
+
+    def test_query_and_document_keys_are_separate(self):
+        self.cached.embed_documents(["hello"])
+        result = self.cached.embed_query("hello")
+
+        self.assertEqual(result, [5.0, 2.0])
+        self.embeddings.embed_query.assert_called_once_with("hello")
+        self.assertNotEqual(
+            embedding_cache_key("test", "query", "hello"),
+            embedding_cache_key("test", "document", "hello"),
+        )
+
+    def test_shared_tier_hit_populates_local(self):
+        shared = Mock(spec=RedisCache)
+        key = embedding_cache_key("test", "document", "cached")
+        shared.get_many.return_value = [encode_vector([0.5, 0.25])]
+        cached = CachedEmbeddings(
+            self.embeddings, namespace="test", local=LRUCache(), shared=shared
+        )
+
+        result = cached.embed_documents(["cached"])
+
+        self.assertEqual(result[0].tolist(), [0.5, 0.25])
+        self.embeddings.embed_documents.assert_not_called()
+        self.assertEqual(cached.local.get(key).tolist(), [0.5, 0.25])
+        self.assertEqual(cached.stats()["shared_hits"], 1)
+
+    def test_misses_are_written_to_shared_tier(self):
+        shared = Mock(spec=RedisCache)
+        shared.get_many.return_value = [None]
+        cached = CachedEmbeddings(
+            self.embeddings, namespace="test", local=LRUCache(), shared=shared
+        )
+
+        cached.embed_documents(["new"])
+
+        shared.set_many.assert_called_once_with(
+            {embedding_cache_key("test", "document", "new"): encode_vector([3.0, 1.0])}
+        )
+
+    def test_aembed_query_uses_local_tier(self):
+        self.embeddings.aembed_query = AsyncMock(return_value=[1.0, 2.0])
+
+        first = asyncio.run(self.cached.aembed_query("hello"))
+        second = asyncio.run(self.cached.aembed_query("hello"))
+
+        self.assertEqual(first, second)
+        self.embeddings.aembed_query.assert_awaited_once_with("hello")
+        self.assertEqual(self.cached.embed_query("hello"), [1.0, 2.0])
+        self.assertEqual((self.cached.hits, self.cached.misses), (2, 1))
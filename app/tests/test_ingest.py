@@ -0,0 +1,82 @@
+import unittest
+from unittest.mock import Mock
+
+from elasticsearch import NotFoundError
+
+from app.store.ingest import IngestSessions
+
+
+def not_found():
+    return NotFoundError("index_not_found_exception", Mock(status=404), {})
+
+
+class TestIngestSessions(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.indices.get_settings.return_value = {
+            "products": {"settings": {"index": {"refresh_interval": "5s"}}}
+        }
+        self.sessions = IngestSessions(self.client, "products")
+
+    def _refresh_intervals(self):
+        return [
+            call.kwargs["settings"]["index"]["refresh_interval"]
+            for call in self.client.indices.put_settings.call_args_list
+        ]
+
+    def test_relaxes_and_restores_refresh_interval(self):
+        with self.sessions.session():
+            self.assertTrue(self.sessions.active)
+            self.assertEqual(self._refresh_intervals(), ["-1"])
+            self.client.indices.refresh.assert_not_called()
+
+        self.assertFalse(self.sessions.active)
+        self.assertEqual(self._refresh_intervals(), ["-1", "5s"])
+        self.client.indices.refresh.assert_called_once_with(index="products")
+
+    def test_restores_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            with self.sessions.session():
+                raise RuntimeError("bulk failed")
+
+        self.assertFalse(self.sessions.active)
+        self.assertEqual(self._refresh_intervals(), ["-1", "5s"])
+        self.client.indices.refresh.assert_called_once_with(index="products")
+
+    def test_nested_sessions_refresh_once(self):
+        with self.sessions.session():
+            with self.sessions.session():
+                pass
+            self.assertTrue(self.sessions.active)
+
+        self.assertEqual(self._refresh_intervals(), ["-1", "5s"])
+        self.client.indices.refresh.assert_called_once()
+
+    def test_default_interval_restored_when_unset_or_left_relaxed(self):
+        for settings in ({}, {"index": {"refresh_interval": "-1"}}):
+            self.client.reset_mock()
+            self.client.indices.get_settings.return_value = {"products": {"settings": settings}}
+
+            with self.sessions.session():
+                pass
+
+            self.assertEqual(self._refresh_intervals(), ["-1", None])
+
+    def test_missing_index_is_not_relaxed(self):
+        self.client.indices.get_settings.side_effect = not_found()
+
+        with self.sessions.session():
+            pass
+
+        self.client.indices.put_settings.assert_not_called()
+        self.client.indices.refresh.assert_called_once_with(index="products")
+
+    def test_without_refresh_interval_only_merges_refreshes(self):
+        sessions = IngestSessions(self.client, "products", refresh_interval=None)
+
+        with sessions.session():
+            pass
+
+        self.client.indices.get_settings.assert_not_called()
+        self.client.indices.put_settings.assert_not_called()
+        self.client.indices.refresh.assert_called_once_with(index="products")
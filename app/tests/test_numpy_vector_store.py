@@ -0,0 +1,287 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from app.embedders.embedders import DeterministicFakeEmbeddings
+from app.handlers.products import Product
+from app.indexer.content_bases import ContentBaseIndexer
+from app.indexer.products import ProductsIndexer
+from app.store.numpy_vector_store import (
+    ContentBaseNumpyVectorStore,
+    NumpyVectorStore,
+    Segment,
+)
+
+
+def product(catalog_id, retailer_id, title):
+    return Product(
+        facebook_id="123456789",
+        title=title,
+        org_id="123",
+        channel_id="456",
+        catalog_id=catalog_id,
+        product_retailer_id=retailer_id,
+    )
+
+
+class NumpyVectorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.embeddings = DeterministicFakeEmbeddings(dimensions=16)
+        self.storage = NumpyVectorStore(self.embeddings)
+        self.indexer = ProductsIndexer(self.storage)
+
+    def test_search_within_catalog(self):
+        self.indexer.index_batch("c1", [product("c1", "1", "blue shirt"), product("c1", "2", "red shoes")])
+        self.indexer.index("c2", product("c2", "3", "blue shirt"))
+
+        results = self.indexer.search("blue shirt", {"catalog_id": "c1"}, threshold=1.5)
+
+        self.assertEqual([(p.catalog_id, p.product_retailer_id) for p in results], [("c1", "1")])
+
+    def test_scores_match_script_score(self):
+        self.storage.save_batch(
+            [Document(page_content=text, metadata={"catalog_id": "c1"}) for text in ["a", "b", "c"]]
+        )
+        query = np.asarray(self.embeddings.embed_query("a"))
+
+        documents = self.storage.search_by_vector(query, {"catalog_id": "c1"}, threshold=0.0)
+
+        vectors = np.asarray(self.embeddings.embed_documents([doc.page_content for doc in documents]))
+        scores = vectors @ query + 1.0
+        self.assertEqual(documents[0].page_content, "a")
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_top_k(self):
+        self.storage.search_k = 2
+        self.storage.save_batch(
+            [Document(page_content=str(i), metadata={"catalog_id": "c1"}) for i in range(10)]
+        )
+
+        self.assertEqual(len(self.storage.search("1", {"catalog_id": "c1"}, threshold=0.0)), 2)
+
+    def test_index_replaces_product_and_delete(self):
+        self.indexer.index("c1", product("c1", "1", "blue shirt"))
+        self.indexer.index("c1", product("c1", "1", "green shirt"))
+
+        self.assertEqual(self.indexer.search("blue shirt", {"catalog_id": "c1"}, threshold=1.5), [])
+        self.assertEqual(len(self.indexer.search("green shirt", {"catalog_id": "c1"}, threshold=1.5)), 1)
+        self.assertEqual(self.indexer.delete("c1", "1"), ["c1:1"])
+        self.assertEqual(self.indexer.search("green shirt", {"catalog_id": "c1"}, threshold=1.5), [])
+
+    def test_search_batch_and_asearch(self):
+        self.indexer.index_batch("c1", [product("c1", "1", "blue shirt"), product("c1", "2", "red shoes")])
+
+        results = self.indexer.search_batch(
+            ["red shoes", "blue shirt"], [{"catalog_id": "c1"}, None], [1.5, 1.5]
+        )
+        async_results = asyncio.run(self.indexer.asearch("red shoes", {"catalog_id": "c1"}, 1.5))
+
+        self.assertEqual([[p.product_retailer_id for p in ps] for ps in results], [["2"], ["1"]])
+        self.assertEqual([p.product_retailer_id for p in async_results], ["2"])
+
+    def test_persisted_segments_are_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage = NumpyVectorStore(self.embeddings, path=path)
+            ProductsIndexer(storage).index_batch(
+                "c1", [product("c1", "1", "blue shirt"), product("c1", "2", "red shoes")]
+            )
+
+            reloaded = NumpyVectorStore(self.embeddings, path=path)
+            results = ProductsIndexer(reloaded).search("red shoes", None, threshold=1.5)
+
+            self.assertEqual([p.product_retailer_id for p in results], ["2"])
+            (segment,) = reloaded._segments.values()
+            self.assertIsInstance(segment._matrix, np.memmap)
+            (directory,) = os.listdir(os.path.join(path, "products"))
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(path, "products", directory))),
+                [".lock", "documents.json", "files", "vectors-1.npy"],
+            )
+
+    def test_reloads_segments_written_by_another_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            reader = NumpyVectorStore(self.embeddings, path=path)
+            writer = NumpyVectorStore(self.embeddings, path=path)
+            writer.save(Document(page_content="first", metadata={"catalog_id": "c1"}))
+            self.assertEqual(len(reader.search("first", {"catalog_id": "c1"}, 1.5)), 1)
+
+            writer.save(Document(page_content="second", metadata={"catalog_id": "c1"}))
+
+            self.assertEqual(len(reader.search("second", {"catalog_id": "c1"}, 1.5)), 1)
+
+    def test_writes_of_stores_sharing_a_path_are_kept(self):
+        with tempfile.TemporaryDirectory() as path:
+            first = NumpyVectorStore(self.embeddings, path=path)
+            second = NumpyVectorStore(self.embeddings, path=path)
+            first.save(Document(page_content="a", metadata={"catalog_id": "c1"}))
+            second.search("a", {"catalog_id": "c1"}, 0.0)
+
+            writer = threading.Thread(
+                target=second.save, args=(Document(page_content="c", metadata={"catalog_id": "c1"}),)
+            )
+            with first.ingest_session():
+                first.save(Document(page_content="b", metadata={"catalog_id": "c1"}))
+                writer.start()
+                writer.join(0.2)
+                self.assertTrue(writer.is_alive())
+            writer.join()
+
+            documents = first.search("a", {"catalog_id": "c1"}, 0.0)
+            self.assertEqual(sorted(doc.page_content for doc in documents), ["a", "b", "c"])
+
+    def test_ingest_session_persists_once(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage = NumpyVectorStore(self.embeddings, path=path)
+            with storage.ingest_session():
+                for i in range(3):
+                    storage.save(Document(page_content=str(i), metadata={"catalog_id": "c1"}))
+                (directory,) = os.listdir(os.path.join(path, "products"))
+                self.assertEqual(os.listdir(os.path.join(path, "products", directory)), [".lock"])
+
+            (segment,) = storage._segments.values()
+            self.assertEqual(segment.version, 1)
+            self.assertEqual(len(segment.ids), 3)
+
+
+class SegmentTest(unittest.TestCase):
+    def test_upsert_grows_and_remove_compacts(self):
+        segment = Segment("c1")
+        vectors = np.eye(4, dtype=np.float32)
+        segment.upsert(["a", "b", "c"], ["a", "b", "c"], [{}, {}, {}], vectors[:3])
+        segment.upsert(["b", "d"], ["b2", "d"], [{}, {}], vectors[[3, 0]])
+
+        self.assertEqual(segment.remove([segment.positions["a"]]), 1)
+
+        self.assertEqual(segment.ids, ["b", "c", "d"])
+        self.assertEqual(segment.texts, ["b2", "c", "d"])
+        np.testing.assert_array_equal(segment.vectors, vectors[[3, 2, 0]])
+        self.assertTrue(segment.vectors.flags.c_contiguous)
+
+
+class ContentBaseNumpyVectorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = ContentBaseNumpyVectorStore(
+            DeterministicFakeEmbeddings(dimensions=16), preview_segment_size=4
+        )
+        self.indexer = ContentBaseIndexer(self.storage)
+
+    def _chunk(self, text, file_uuid="f1", content_base_uuid="cb1", page="page one"):
+        return Document(
+            page_content=text,
+            metadata={
+                "file_uuid": file_uuid,
+                "content_base_uuid": content_base_uuid,
+                "filename": "file.pdf",
+                "source": "file.pdf",
+                "full_page": page,
+            },
+        )
+
+    def test_index_documents_and_search_pages(self):
+        self.indexer.index_documents([self._chunk("hello"), self._chunk("world", page="page two")])
+        self.indexer.index_documents([self._chunk("other", content_base_uuid="cb2")])
+
+        results = self.indexer.search("hello", {"content_base_uuid": "cb1"}, threshold=1.5)
+
+        self.assertEqual(results, [{"full_page": "page one", "filename": "file.pdf", "file_uuid": "f1"}])
+        self.assertTrue(self.indexer.check_if_doc_was_embedded_document("f1", "cb1"))
+
+    def test_index_documents_replaces_file(self):
+        self.indexer.index_documents([self._chunk("hello")])
+        self.indexer.index_documents([self._chunk("world", page="new page")])
+
+        self.assertEqual(self.indexer.search("hello", {"content_base_uuid": "cb1"}, threshold=1.5), [])
+        self.assertEqual(
+            self.indexer.search("world", {"content_base_uuid": "cb1"}, threshold=1.5)[0]["full_page"],
+            "new page",
+        )
+
+    def test_delete_file_and_content_base(self):
+        self.indexer.index_documents([self._chunk("hello"), self._chunk("bye", file_uuid="f2")])
+
+        self.indexer.delete("cb1", "file.pdf", "f1")
+        self.assertFalse(self.indexer.check_if_doc_was_embedded_document("f1", "cb1"))
+        task_id = self.indexer.delete_content_base("cb1")
+
+        self.assertFalse(self.indexer.check_if_doc_was_embedded_document("f2", "cb1"))
+        self.assertEqual(
+            self.indexer.get_delete_task(task_id), {"completed": True, "deleted": 1, "total": 1}
+        )
+
+    def test_document_content_slices_and_stream(self):
+        self.indexer.index_doc_content("abcdefghij", "cb1", "file.pdf", "f1")
+
+        self.assertEqual(
+            self.indexer.search_document_content("f1", "cb1", offset=2, length=5),
+            {"content": "cdefg", "total_length": 10},
+        )
+        self.assertEqual(
+            [chunk["content"] for chunk in self.indexer.iter_document_content("f1", "cb1", offset=1)],
+            ["bcde", "fghi", "j"],
+        )
+        self.assertEqual(
+            self.indexer.search_document_content("missing", "cb1"), {"content": "", "total_length": 0}
+        )
+
+    def test_deleted_content_base_is_not_restored_by_another_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            embeddings = DeterministicFakeEmbeddings(dimensions=16)
+            first = ContentBaseNumpyVectorStore(embeddings, path=path)
+            second = ContentBaseNumpyVectorStore(embeddings, path=path)
+            first.save([self._chunk("old")])
+            self.assertEqual(len(second.search("old", {"content_base_uuid": "cb1"}, 0.0)), 1)
+
+            first.delete_content_base("cb1")
+            second.save([self._chunk("new")])
+
+            for storage in (first, second):
+                documents = storage.search("new", {"content_base_uuid": "cb1"}, 0.0)
+                self.assertEqual([doc.page_content for doc in documents], ["new"])
+
+    def test_removed_segment_is_dropped(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage = ContentBaseNumpyVectorStore(DeterministicFakeEmbeddings(dimensions=16), path=path)
+            storage.save([self._chunk("old")])
+
+            shutil.rmtree(os.path.join(path, "content_bases"))
+
+            self.assertEqual(storage.search("old", None, 0.0), [])
+            self.assertFalse(storage.check_if_doc_was_embedded_document("f1", "cb1"))
+
+    def test_pages_and_previews_are_persisted_per_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage = ContentBaseNumpyVectorStore(DeterministicFakeEmbeddings(dimensions=16), path=path)
+            indexer = ContentBaseIndexer(storage)
+            with indexer.grouped_writes():
+                indexer.index_documents([self._chunk("hello")])
+                indexer.index_doc_content("the whole file", "cb1", "file.pdf", "f1")
+            self.assertEqual(storage._segment("cb1").version, 1)
+            directory = storage._directory("cb1")
+            (entry,) = os.listdir(os.path.join(directory, "files"))
+            stamp = os.stat(os.path.join(directory, "files", entry)).st_mtime_ns
+
+            indexer.index_documents([self._chunk("bye", file_uuid="f2", page="page two")])
+
+            self.assertEqual(os.stat(os.path.join(directory, "files", entry)).st_mtime_ns, stamp)
+            with open(os.path.join(directory, "documents.json"), encoding="utf-8") as f:
+                documents = f.read()
+            self.assertNotIn("page one", documents)
+            self.assertNotIn("the whole file", documents)
+            reader = ContentBaseIndexer(
+                ContentBaseNumpyVectorStore(DeterministicFakeEmbeddings(dimensions=16), path=path)
+            )
+            self.assertEqual(
+                reader.search("hello", {"content_base_uuid": "cb1"}, threshold=1.5)[0]["full_page"], "page one"
+            )
+            self.assertEqual(reader.search_document_content("f1", "cb1")["content"], "the whole file")
+
+            indexer.delete_content_base("cb1")
+
+            self.assertEqual(os.listdir(os.path.join(directory, "files")), [])
+            self.assertEqual(reader.search_document_content("f1", "cb1")["content"], "")
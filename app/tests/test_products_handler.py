@@ -1,10 +1,12 @@
+import asyncio
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 from app.handlers.products import (
     ProductsHandler,
     Product,
     ProductSearchRequest,
     ProductSearchResponse,
+    ProductBatchSearchRequest,
     ProductIndexRequest,
     ProductBatchIndexRequest,
     ProductIndexResponse,
@@ -145,17 +147,41 @@ class TestProductsHandler(unittest.TestCase):
             catalog_id="789",
             product_retailer_id="999",
         )
-        self.mock_indexer.search.return_value = [mock_product]
+        self.mock_indexer.asearch.return_value = [mock_product]
 
-        result = self.handler.search(mock_request)
+        result = asyncio.run(self.handler.search(mock_request))
 
         self.assertIsInstance(result, ProductSearchResponse)
         self.assertEqual(len(result.products), 1)
         self.assertEqual(result.products[0], mock_product)
-        self.mock_indexer.search.assert_called_once_with(
+        self.mock_indexer.asearch.assert_awaited_once_with(
             mock_request.search, mock_request.filter, mock_request.threshold
         )
 
+    def test_search_batch(self):
+        mock_product = Product(
+            facebook_id="123456789",
+            title="Test Product",
+            org_id="123",
+            channel_id="456",
+            catalog_id="789",
+            product_retailer_id="999",
+        )
+        self.mock_indexer.asearch_batch = AsyncMock(return_value=[[mock_product], []])
+        mock_request = ProductBatchSearchRequest(
+            searches=[
+                ProductSearchRequest(search="Test", filter={"catalog_id": "789"}, threshold=0.5),
+                ProductSearchRequest(search="Other", filter={"catalog_id": "789"}),
+            ]
+        )
+
+        result = asyncio.run(self.handler.search_batch(mock_request))
+
+        self.assertEqual([len(response.products) for response in result.responses], [1, 0])
+        self.mock_indexer.asearch_batch.assert_awaited_once_with(
+            ["Test", "Other"], [{"catalog_id": "789"}, {"catalog_id": "789"}], [0.5, 1.5]
+        )
+
     def test_search_with_exception(self):
         mock_request = ProductSearchRequest(
             search="Test", filter={"catalog_id": "789"}, threshold=0.5
@@ -168,10 +194,10 @@ class TestProductsHandler(unittest.TestCase):
             catalog_id="789",
             product_retailer_id="999",
         )
-        self.mock_indexer.search.side_effect = RuntimeError("some error")
+        self.mock_indexer.asearch.side_effect = RuntimeError("some error")
 
         with self.assertRaises(HTTPException) as context:
-            self.handler.search(mock_request)
+            asyncio.run(self.handler.search(mock_request))
         self.assertEqual(context.exception.detail[0]["msg"], "some error")
 
     def test_delete(self):
@@ -1,3 +1,4 @@
+import asyncio
 import unittest
 from unittest.mock import Mock
 from langchain.docstore.document import Document
@@ -24,17 +25,11 @@ class TestProductsIndexer(unittest.TestCase):
         mock_document = Document(page_content=mock_product.title, metadata=mock_product)
 
         self.mock_storage.save.return_value = mock_document
-        self.mock_storage.query_search.return_value = []
 
         result = self.indexer.index(catalog_id, mock_product)
 
-        self.mock_storage.save.assert_called_once_with(mock_document)
-        self.mock_storage.query_search.assert_called_once_with(
-            {
-                "metadata.catalog_id": catalog_id,
-                "metadata.product_retailer_id": [mock_product.product_retailer_id],
-            }
-        )
+        self.mock_storage.save.assert_called_once_with(mock_document, ids=["789:999"])
+        self.mock_storage.query_search.assert_not_called()
         self.assertEqual(result, mock_document)
 
     def test_index_updating(self):
@@ -55,13 +50,9 @@ class TestProductsIndexer(unittest.TestCase):
 
         result = self.indexer.index(catalog_id, mock_product)
 
-        self.mock_storage.save.assert_called_once_with(mock_document)
-        self.mock_storage.query_search.assert_called_once_with(
-            {
-                "metadata.catalog_id": catalog_id,
-                "metadata.product_retailer_id": [mock_product.product_retailer_id],
-            }
-        )
+        # the new version replaces the document with the same id
+        self.mock_storage.save.assert_called_once_with(mock_document, ids=["789:999"])
+        self.mock_storage.delete.assert_not_called()
         self.assertEqual(result, mock_document)
 
     def test_index_batch(self):
@@ -89,11 +80,13 @@ class TestProductsIndexer(unittest.TestCase):
             for product in mock_products
         ]
         self.mock_storage.save_batch.return_value = mock_documents
-        self.mock_storage.query_search.return_value = []
 
         result = self.indexer.index_batch(catalog_id, mock_products)
 
-        self.mock_storage.save_batch.assert_called_once_with(mock_documents)
+        self.mock_storage.save_batch.assert_called_once_with(
+            mock_documents, ids=["789:998", "789:999"]
+        )
+        self.mock_storage.query_search.assert_not_called()
         self.assertEqual(result, mock_documents)
 
     def test_index_batch_updating(self):
@@ -126,9 +119,31 @@ class TestProductsIndexer(unittest.TestCase):
 
         result = self.indexer.index_batch(catalog_id, mock_products)
 
-        self.mock_storage.save_batch.assert_called_once_with(mock_documents)
+        self.mock_storage.save_batch.assert_called_once_with(
+            mock_documents, ids=["789:998", "789:999"]
+        )
+        self.mock_storage.delete.assert_not_called()
         self.assertEqual(result, mock_documents)
 
+    def test_index_batch_keeps_last_version_of_repeated_product(self):
+        catalog_id = "789"
+        old, new = [
+            Product(
+                facebook_id="1234567891",
+                title=title,
+                org_id="123",
+                channel_id="456",
+                catalog_id=catalog_id,
+                product_retailer_id="998",
+            )
+            for title in ["Old Title", "New Title"]
+        ]
+        self.indexer.index_batch(catalog_id, [old, new])
+
+        self.mock_storage.save_batch.assert_called_once_with(
+            [Document(page_content=new.title, metadata=new)], ids=["789:998"]
+        )
+
     def test_search(self):
         mock_search_query = "Test Query"
         mock_document = Document(
@@ -150,6 +165,25 @@ class TestProductsIndexer(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].title, mock_document.metadata["title"])
 
+    def test_asearch(self):
+        mock_document = Document(
+            page_content="Title 1",
+            metadata={
+                "facebook_id": "123456789",
+                "title": "Title 1",
+                "org_id": "123",
+                "channel_id": "456",
+                "catalog_id": "789",
+                "product_retailer_id": "999",
+            },
+        )
+        self.mock_storage.asearch.return_value = [mock_document]
+
+        result = asyncio.run(self.indexer.asearch("Test Query", {"catalog_id": "789"}, 1.5))
+
+        self.mock_storage.asearch.assert_awaited_once_with("Test Query", {"catalog_id": "789"}, 1.5)
+        self.assertEqual(result[0].product_retailer_id, "999")
+
     def test_delete(self):
         catalog_id = "789"
         product_retailer_id = "pd123"
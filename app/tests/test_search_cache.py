@@ -0,0 +1,162 @@
+import asyncio
+import unittest
+from contextlib import nullcontext
+from unittest.mock import AsyncMock, Mock
+
+from langchain.docstore.document import Document
+
+from app.cache import LRUCache, RedisCache
+from app.indexer.content_bases import ContentBaseIndexer
+from app.indexer.products import ProductsIndexer
+from app.indexer.search_cache import SearchResultCache
+from app.store.elasticsearch_vector_store import (
+    ContentBaseElasticsearchVectorStoreIndex,
+    ElasticsearchVectorStoreIndex,
+)
+
+
+class TestSearchResultCache(unittest.TestCase):
+    def setUp(self):
+        self.storage = Mock(spec=ContentBaseElasticsearchVectorStoreIndex)
+        self.storage.search_k = 5
+        self.storage.grouped_writes.return_value = nullcontext()
+        self.storage.search.return_value = [
+            Document(page_content="chunk", metadata={"full_page": "page", "file_uuid": "f1"})
+        ]
+        self.cache = SearchResultCache("content_bases", LRUCache())
+        self.indexer = ContentBaseIndexer(self.storage, search_cache=self.cache)
+
+    def test_repeated_search_hits_cache(self):
+        first = self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        second = self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+
+        self.assertEqual(first, second)
+        self.storage.search.assert_called_once()
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_search_keyed_by_threshold_and_tenant(self):
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"}, threshold=1.5)
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb2"})
+
+        self.assertEqual(self.storage.search.call_count, 3)
+
+    def test_write_invalidates_tenant(self):
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb2"})
+
+        self.indexer.index_documents(
+            [Document(page_content="new", metadata={"file_uuid": "f2", "content_base_uuid": "cb1"})]
+        )
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb2"})
+
+        self.assertEqual(self.storage.search.call_count, 3)
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_delete_invalidates_tenant(self):
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+
+        self.indexer.delete("cb1", "file.pdf", "f1")
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+
+        self.assertEqual(self.storage.search.call_count, 2)
+
+    def test_completed_content_base_delete_invalidates_tenant(self):
+        self.storage.delete_content_base.return_value = {"task": "node:1,node:2"}
+        self.storage.get_task.return_value = {"completed": False, "response": {"deleted": 0, "total": 1}}
+
+        task_id = self.indexer.delete_content_base("cb1")
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        self.indexer.get_delete_task(task_id)
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+        self.assertEqual(self.storage.search.call_count, 1)
+
+        self.storage.get_task.return_value = {"completed": True, "response": {"deleted": 1, "total": 1}}
+        self.indexer.get_delete_task(task_id)
+        self.indexer.get_delete_task(task_id)
+        self.indexer.search("What is it?", filter={"content_base_uuid": "cb1"})
+
+        self.assertEqual(self.storage.search.call_count, 2)
+        self.assertEqual(self.cache.stats()["invalidations"], 2)
+
+    def test_search_batch_runs_only_missing_searches(self):
+        self.storage.search_batch.side_effect = lambda searches, filters, thresholds: [
+            [Document(page_content=search, metadata={"full_page": search, "file_uuid": "f1"})]
+            for search in searches
+        ]
+        self.indexer.search("first", filter={"content_base_uuid": "cb1"})
+
+        results = self.indexer.search_batch(
+            ["first", "second", "third"],
+            [{"content_base_uuid": "cb1"}] * 3,
+            [0.1, 0.1, 0.1],
+        )
+        self.indexer.search_batch(["second"], [{"content_base_uuid": "cb1"}], [0.1])
+
+        self.storage.search_batch.assert_called_once_with(
+            ["second", "third"], [{"content_base_uuid": "cb1"}] * 2, [0.1, 0.1]
+        )
+        self.assertEqual(
+            [[page["full_page"] for page in pages] for pages in results],
+            [["page"], ["second"], ["third"]],
+        )
+
+    def test_asearch_hits_cache(self):
+        self.storage.asearch = AsyncMock(return_value=self.storage.search.return_value)
+
+        async def search_twice():
+            await self.indexer.asearch("What is it?", filter={"content_base_uuid": "cb1"})
+            return await self.indexer.asearch("What is it?", filter={"content_base_uuid": "cb1"})
+
+        result = asyncio.run(search_twice())
+
+        self.assertEqual(result, [{"full_page": "page", "filename": None, "file_uuid": "f1"}])
+        self.storage.asearch.assert_awaited_once()
+
+    def test_shared_tier(self):
+        shared = Mock(spec=RedisCache)
+        values = {}
+        shared.get.side_effect = values.get
+        shared.set.side_effect = values.__setitem__
+        shared.incr.side_effect = lambda key: values.__setitem__(key, int(values.get(key, 0)) + 1)
+        writer = SearchResultCache("products", LRUCache(), shared=shared)
+        reader = SearchResultCache("products", LRUCache(), shared=shared)
+        storage = Mock(spec=ElasticsearchVectorStoreIndex)
+        storage.search_k = 15
+        storage.search.return_value = [Document(page_content="Shirt", metadata={"catalog_id": "789"})]
+
+        writer.search(storage, "789", "shirt", {"catalog_id": "789"}, 1.5)
+        documents = reader.search(storage, "789", "shirt", {"catalog_id": "789"}, 1.5)
+
+        self.assertEqual(documents[0].metadata, {"catalog_id": "789"})
+        self.assertEqual(reader.stats()["shared_hits"], 1)
+        storage.search.assert_called_once()
+
+        writer.invalidate("789")
+        reader.search(storage, "789", "shirt", {"catalog_id": "789"}, 1.5)
+        self.assertEqual(storage.search.call_count, 2)
+
+        writer.watch_task("node:1", "789")
+        reader.task_completed("node:1")
+        reader.task_completed("node:1")
+        writer.search(storage, "789", "shirt", {"catalog_id": "789"}, 1.5)
+        self.assertEqual(storage.search.call_count, 3)
+        self.assertEqual(reader.stats()["invalidations"], 1)
+
+    def test_products_writes_invalidate_catalog(self):
+        storage = Mock(spec=ElasticsearchVectorStoreIndex)
+        storage.search_k = 15
+        storage.search.return_value = []
+        indexer = ProductsIndexer(storage, search_cache=SearchResultCache("products", LRUCache()))
+
+        indexer.search("shirt", filter={"catalog_id": "789"})
+        indexer.index_batch("789", [])
+        indexer.search("shirt", filter={"catalog_id": "789"})
+
+        self.assertEqual(storage.search.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
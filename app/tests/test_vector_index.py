@@ -0,0 +1,145 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from app.store.exceptions import VectorIndexMigrationException
+from app.store.migrations import migrate_vector_index
+from app.store.vector_index import (
+    FLOAT,
+    INT8,
+    NORMALIZED,
+    VectorIndexExactRetrievalStrategy,
+    script_score_source,
+    vector_mapping,
+)
+
+
+class TestVectorIndex(unittest.TestCase):
+    def test_vector_mapping(self):
+        self.assertEqual(vector_mapping(3, FLOAT), {"type": "dense_vector", "dims": 3})
+        self.assertEqual(
+            vector_mapping(3, NORMALIZED),
+            {"type": "dense_vector", "dims": 3, "index": True, "similarity": "dot_product"},
+        )
+        self.assertEqual(
+            vector_mapping(3, INT8, (8, 13))["index_options"], {"type": "int8_hnsw"}
+        )
+
+    def test_hnsw_options(self):
+        hnsw = {"m": 32, "ef_construction": 200}
+        self.assertEqual(
+            vector_mapping(3, FLOAT, hnsw_options=hnsw),
+            {
+                "type": "dense_vector",
+                "dims": 3,
+                "index": True,
+                "similarity": "cosine",
+                "index_options": {"type": "hnsw", "m": 32, "ef_construction": 200},
+            },
+        )
+        self.assertEqual(
+            vector_mapping(3, INT8, (8, 13), hnsw)["index_options"],
+            {"type": "int8_hnsw", "m": 32, "ef_construction": 200},
+        )
+
+    def test_int8_falls_back_on_old_clusters(self):
+        self.assertNotIn("index_options", vector_mapping(3, INT8, (8, 9)))
+
+    def test_script_scores_keep_the_same_scale(self):
+        self.assertEqual(
+            script_score_source(FLOAT),
+            "cosineSimilarity(params.query_vector, 'vector') + 1.0",
+        )
+        self.assertEqual(
+            script_score_source(NORMALIZED),
+            "dotProduct(params.query_vector, 'vector') + 1.0",
+        )
+
+    def test_dot_product_strategy(self):
+        strategy = VectorIndexExactRetrievalStrategy(INT8)
+        client = Mock()
+        client.info.return_value = {"version": {"number": "8.13.4"}}
+        strategy.before_index_setup(client, "text", "vector")
+
+        mapping = strategy.index(3, "vector", None)["mappings"]["properties"]["vector"]
+        query = strategy.query([0.6, 0.8], None, 5, 50, "vector", "text", [{"term": {"a": "b"}}], None)
+
+        self.assertEqual(mapping["index_options"], {"type": "int8_hnsw"})
+        script_score = query["query"]["script_score"]
+        self.assertEqual(script_score["query"], {"bool": {"filter": [{"term": {"a": "b"}}]}})
+        self.assertEqual(script_score["script"]["source"], script_score_source(INT8))
+
+
+class TestMigrateVectorIndex(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.info.return_value = {"version": {"number": "8.13.4"}}
+        self.client.indices.get_mapping.return_value = {
+            "catalog_products": {
+                "mappings": {
+                    "properties": {
+                        "vector": {"type": "dense_vector", "dims": 3},
+                        "text": {"type": "text"},
+                    }
+                }
+            }
+        }
+        self.client.reindex.return_value = {"task": "node:1"}
+
+    def test_reindexes_normalizing_and_swaps_alias(self):
+        self.client.tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+
+        target = migrate_vector_index(
+            self.client, "catalog_products", INT8, target="catalog_products_int8"
+        )
+
+        self.assertEqual(target, "catalog_products_int8")
+        properties = self.client.indices.create.call_args.kwargs["mappings"]["properties"]
+        self.assertEqual(properties["vector"], vector_mapping(3, INT8, (8, 13)))
+        self.assertEqual(properties["text"], {"type": "text"})
+        reindex = self.client.reindex.call_args.kwargs
+        self.assertEqual(reindex["dest"], {"index": "catalog_products_int8"})
+        self.assertIn("Math.sqrt", reindex["script"]["source"])
+        self.client.indices.update_aliases.assert_called_once_with(
+            actions=[
+                {"add": {"index": "catalog_products_int8", "alias": "catalog_products"}},
+                {"remove_index": {"index": "catalog_products"}},
+            ]
+        )
+
+    @patch("app.store.migrations.time.sleep")
+    def test_failed_reindex_keeps_old_index(self, mock_sleep):
+        self.client.tasks.get.side_effect = [
+            {"completed": False, "task": {"status": {"created": 1, "total": 2}}},
+            {"completed": True, "error": {"reason": "boom"}},
+        ]
+
+        with self.assertRaises(VectorIndexMigrationException):
+            migrate_vector_index(self.client, "catalog_products", NORMALIZED)
+
+        mock_sleep.assert_called_once()
+        self.client.indices.update_aliases.assert_not_called()
+
+    def test_rekey_products_keeps_mapping(self):
+        self.client.tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+
+        migrate_vector_index(self.client, "catalog_products", rekey_products=True, target="products_rekeyed")
+
+        mappings = self.client.indices.create.call_args.kwargs["mappings"]
+        self.assertEqual(mappings["properties"]["vector"], {"type": "dense_vector", "dims": 3})
+        script = self.client.reindex.call_args.kwargs["script"]["source"]
+        self.assertIn("ctx._id", script)
+        self.assertNotIn("Math.sqrt", script)
+
+    def test_route_by_tenant(self):
+        self.client.tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+
+        migrate_vector_index(
+            self.client, "content_bases", routing_field="content_base_uuid", number_of_shards=6
+        )
+
+        create = self.client.indices.create.call_args.kwargs
+        self.assertTrue(create["index"].startswith("content_bases_routed_"))
+        self.assertEqual(create["settings"], {"number_of_shards": 6})
+        script = self.client.reindex.call_args.kwargs["script"]
+        self.assertIn("ctx._routing", script["source"])
+        self.assertEqual(script["params"]["routing_field"], "content_base_uuid")
@@ -1,19 +1,46 @@
+import base64
 import json
 
+import numpy as np
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # pragma: no cover
+    from json import loads as json_loads
+
+
+def decode_vectors(response: dict) -> np.ndarray:
+    """Decodes the vectors of an embedding endpoint response into a float32
+    matrix, one row per input.
+
+    Endpoints that support it answer with the matrix as base64 encoded
+    little-endian float32 bytes plus its shape, which skips building a
+    python float for every dimension.
+    """
+    vectors = response["vectors"]
+    if isinstance(vectors, str):
+        data = np.frombuffer(base64.b64decode(vectors), dtype="<f4")
+        return data.reshape(response["shape"])
+    return np.asarray(vectors, dtype=np.float32)
+
 
 class ContentHandler(EmbeddingsContentHandler):
     content_type = "application/json"
     accepts = "application/json"
 
-    def transform_input(self, inputs: list[str], model_kwargs: dict) -> bytes:  # pragma: no cover
-        input_str = json.dumps({"inputs": inputs, **model_kwargs})
+    def __init__(self, vector_format: str = "json"):
+        self.vector_format = vector_format
+
+    def transform_input(self, inputs: list[str], model_kwargs: dict) -> bytes:
+        payload = {"inputs": inputs, **model_kwargs}
+        if self.vector_format != "json":
+            payload["vector_format"] = self.vector_format
+        input_str = json.dumps(payload)
         return input_str.encode("utf-8")
 
-    def transform_output(self, output: bytes) -> list[list[float]]:  # pragma: no cover
-        response_json = json.loads(output.read().decode("utf-8"))
-        return response_json["vectors"]
+    def transform_output(self, output: bytes) -> np.ndarray:
+        return decode_vectors(json_loads(output.read()))
 
 
 def count_words(string: str):